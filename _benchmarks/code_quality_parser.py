@@ -0,0 +1,110 @@
+"""
+Measures how quickly code_quality parses a large build log, compared to the old _extract_errors which recompiled its
+regex and normalized the path of every issue from scratch. Most of the warnings come from a few headers, like a real
+Unreal build. Checks which parser picks up a few tricky lines first.
+"""
+
+import hashlib
+import os
+import re
+import tempfile
+import time
+
+from ..utility import code_quality
+
+_warning_count = 1_000_000
+_header_count = 500
+_noise_lines_per_warning = 2
+
+
+def _legacy_extract_errors(compiler_output: str) -> list:
+    """
+    _extract_errors as it was before issues were streamed and paths were cached
+    """
+    error_pattern = re.compile(
+        r'(?P<path>.*?\(\d+\)): (?P<severity>warning|error) (?P<code>[A-Z]\d+): (?P<description>.*)')
+
+    errors = []
+    for match in error_pattern.finditer(compiler_output):
+        error = match.groupdict()
+        error['line'] = int(re.search(r'\((\d+)\)', error['path']).group(1))
+        error['path'] = re.sub(r'\(\d+\)', '', error['path']).strip()
+        error['path'] = os.path.relpath(error['path'])
+        error['path'] = error['path'].replace('\\', '/')
+        error['severity'] = 'minor'
+        fingerprint_str = error['code'] + error['description'] + error['path'] + str(error['line'])
+        error['fingerprint'] = hashlib.md5(fingerprint_str.encode()).hexdigest()
+        errors.append(error)
+
+    return errors
+
+
+def _write_log(path: str):
+    with open(path, 'w') as f:
+        for i in range(_warning_count):
+            header = f'/UE5/Engine/Source/Runtime/Core/Public/Module{i % _header_count}/Header.h'
+            f.write(f'[{i % 500}/500] Compile Module.Game.{i % 97}.cpp\n')
+            f.write(f'{header}({i % 300 + 1}): warning C4996: \'FOld\': was declared deprecated\n')
+            f.write('   Creating library Game.lib and object Game.exp\n')
+
+
+def _bench_legacy(path: str) -> float:
+    start = time.perf_counter()
+    with open(path, 'r') as f:
+        count = len(_legacy_extract_errors(f.read()))
+    assert count == _warning_count
+    return time.perf_counter() - start
+
+
+def _bench_streaming(path: str, cached: bool) -> float:
+    normalize_path = code_quality._normalize_path
+    if not cached:
+        code_quality._normalize_path = normalize_path.__wrapped__
+
+    try:
+        normalize_path.cache_clear()
+        start = time.perf_counter()
+        count = sum(1 for _ in code_quality.parse_file(path))
+        assert count == _warning_count
+        return time.perf_counter() - start
+    finally:
+        code_quality._normalize_path = normalize_path
+
+
+def _check_parsers():
+    lines = [
+        'UnrealBuildTool : error : Unable to find project\n',
+        "ERROR: Unable to instantiate module 'Foo'\n",
+        "/Project/Source/Foo.cpp:12:5: warning: unused variable 'x' [-Wunused-variable]\n",
+        # Summaries and other tools' messages without a path aren't UBT's
+        'error: 3 errors generated.\n',
+        'warning: some tool had something to say\n',
+    ]
+    issues = list(code_quality.parse_lines(lines))
+    assert [(x['path'], x['code']) for x in issues] == [
+        ('UnrealBuildTool', 'UBT'), ('UnrealBuildTool', 'UBT'),
+        (os.path.relpath('/Project/Source/Foo.cpp').replace('\\', '/'), '-Wunused-variable')]
+    print('parsers: ok')
+
+
+def main():
+    _check_parsers()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = f'{temp_dir}/build.log'
+        _write_log(path)
+        print(f'Log: {_warning_count:,} warnings, {os.path.getsize(path) / 1024 / 1024:.0f} MB')
+
+        legacy = _bench_legacy(path)
+        uncached = _bench_streaming(path, False)
+        cached = _bench_streaming(path, True)
+
+    print(f'Legacy _extract_errors:     {legacy:>8.2f}s')
+    print(f'Streaming, no path cache:   {uncached:>8.2f}s')
+    print(f'Streaming, with path cache: {cached:>8.2f}s')
+    print(f'Path cache hit rate:        {code_quality.get_path_cache_hit_rate():>8.1%}')
+    print(f'Speedup over legacy:        {legacy / cached:>8.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Stands in for UnrealEditor-Cmd in unreal_tests. Lists a fixed set of tests for 'Automation List', and for
+'Automation RunTests' runs those matching the filter, printing the lines the editor prints and writing an index.json
+report. Suite1.Test 3 always fails, and if FAKE_EDITOR_CRASH is set the editor exits with code 3 as soon as
+Suite2.Test 1 starts, without writing a report.
+"""
+
+import json
+import os
+import sys
+import time
+
+tests = ([f'Project.Suite{x}.Test {y}' for x in range(6) for y in range(5)] +
+         [f'Project.Numbered.Test{x}' for x in range(12)] + ['Project.Big.Slow', 'Other.Thing'])
+
+
+def _get_arg(name: str) -> str:
+    for arg in sys.argv[1:]:
+        if arg.startswith(f'-{name}='):
+            return arg.split('=', 1)[1].strip('"')
+    return ''
+
+
+def _normalize(test: str) -> str:
+    return test.replace(' ', '').lower()
+
+
+def main():
+    exec_cmds = _get_arg('ExecCmds')
+    if exec_cmds.startswith('Automation List'):
+        print(f'LogAutomationCommandLine: Display: Found {len(tests)} automation tests')
+        for test in tests:
+            print(f'[2024.01.01-00.00.00:000][  0]LogAutomationCommandLine: Display: \t{test}')
+        return 0
+
+    test_filter = exec_cmds.split('RunTests ', 1)[1].split(';')[0]
+    filters = [_normalize(x) for x in test_filter.split('+')]
+
+    # Like RunTests, StartsWith: matches the start of the path and anything else matches anywhere in it
+    matching = [x for x in tests if any(_normalize(x).startswith(y[len('startswith:'):]) if y.startswith('startswith:')
+                                        else y in _normalize(x) for y in filters)]
+
+    print(f"LogAutomationCommandLine: Display: Found {len(matching)} automation tests based on '{test_filter}'")
+    for test in matching:
+        print(f'[2024.01.01-00.00.00:000][  0]LogAutomationCommandLine: Display: \t{test}', flush=True)
+
+    results = []
+    for test in matching:
+        name = test.rpartition('.')[2]
+        print(f'LogAutomationController: Display: Test Started. Name={{{name}}} Path={{{test}}}', flush=True)
+        if os.environ.get('FAKE_EDITOR_CRASH') and test == 'Project.Suite2.Test 1':
+            os._exit(3)
+
+        duration = 0.5 if test == 'Project.Big.Slow' else 0.05
+        time.sleep(duration)
+
+        failed = test == 'Project.Suite1.Test 3'
+        if failed:
+            print('LogAutomationController: Error: Expected 1 to be 2', flush=True)
+
+        result = 'Fail' if failed else 'Success'
+        print(f'LogAutomationController: Display: Test Completed. Result={{{result}}} Name={{{name}}} Path={{{test}}}',
+              flush=True)
+
+        entries = [{'event': {'type': 'Error', 'message': 'Expected 1 to be 2'}}] if failed else []
+        results.append({'testDisplayName': name, 'fullTestPath': test, 'state': result, 'duration': duration,
+                        'entries': entries})
+
+    report_path = _get_arg('ReportExportPath')
+    os.makedirs(report_path, exist_ok=True)
+    with open(f'{report_path}/index.json', 'w', encoding='utf-8-sig') as file:
+        json.dump({
+            'succeeded': sum(x['state'] == 'Success' for x in results),
+            'failed': sum(x['state'] == 'Fail' for x in results),
+            'totalDuration': sum(x['duration'] for x in results),
+            'tests': results,
+        }, file)
+
+    print(f'LogAutomationCommandLine: Display: ...Automation Test Queue Empty {len(results)} tests performed.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
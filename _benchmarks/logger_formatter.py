@@ -0,0 +1,67 @@
+"""
+Measures how many records per second ColoredFormatter can format, compared to the old version which built a new
+logging.Formatter for every record.
+"""
+
+import io
+import logging
+import time
+
+from ..utility.logger import ColoredFormatter, AnsiColor
+
+_record_count = 200_000
+
+
+class _LegacyColoredFormatter(logging.Formatter):
+    """
+    ColoredFormatter as it was before the formatters were cached
+    """
+    format_str = '[%(levelname)-5s] [%(name)-8s] %(message)s'
+
+    @staticmethod
+    def _clr_fmt(msg, color: AnsiColor) -> str:
+        return f'\033[0;{str(color.value)}m{msg}\033[0m'
+
+    def format(self, record):
+        if len(record.name) > 8:
+            record.name = record.name[:8]
+
+        if len(record.levelname) > 5:
+            record.levelname = record.levelname[:5]
+
+        clr_str = self._clr_fmt(self.format_str, color=ColoredFormatter.colors.get(record.levelno))
+        formatter = logging.Formatter(clr_str)
+        return formatter.format(record)
+
+
+def _make_records() -> list[logging.LogRecord]:
+    # Similar to what PerforceHandler.outputInfo logs for every synced file
+    levels = [logging.DEBUG, logging.INFO, logging.WARNING]
+    return [logging.LogRecord('perforce', levels[i % len(levels)], __file__, 0,
+                              "{'depotFile': '//depot/Game/Content/Asset_%d.uasset', 'action': 'updated'}",
+                              (i,), None)
+            for i in range(_record_count)]
+
+
+def _bench(formatter: logging.Formatter) -> float:
+    records = _make_records()
+    handler = logging.StreamHandler(io.StringIO())
+    handler.setFormatter(formatter)
+
+    start = time.perf_counter()
+    for record in records:
+        handler.handle(record)
+    return _record_count / (time.perf_counter() - start)
+
+
+def main():
+    legacy = _bench(_LegacyColoredFormatter())
+    cached = _bench(ColoredFormatter())
+
+    print(f'Legacy formatter: {legacy:>12,.0f} records/s')
+    print(f'Cached formatter: {cached:>12,.0f} records/s')
+    print(f'Speedup:          {cached / legacy:>12.2f}x')
+
+
+if __name__ == '__main__':
+    main()
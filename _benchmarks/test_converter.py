@@ -0,0 +1,97 @@
+"""
+Measures how long ue_to_junit takes on a generated report of 100k tests and how much memory it needs at its peak,
+compared to the old version which loaded the report and built the whole XML tree in memory.
+"""
+
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+import xml.etree.ElementTree as elemTree
+
+from ..utility.test_converter import ue_to_junit
+
+_test_count = 100_000
+_entries_per_test = 10
+_tests_per_suite = 50
+
+
+def _legacy_ue_to_junit(ue_path: str, out_path: str):
+    """
+    ue_to_junit as it was before it was streamed
+    """
+    with open(ue_path, 'r', encoding='utf-8-sig') as file:
+        unreal_data = json.load(file)
+
+    junit_root = elemTree.Element('testsuites')
+    junit_root.set('time', str(unreal_data['totalDuration']))
+
+    for test in unreal_data['tests']:
+        full_test_path = test['fullTestPath']
+        test_suite_name = '.'.join(full_test_path.split('.')[:-1])
+
+        testcase = elemTree.SubElement(junit_root, 'testcase')
+        testcase.set('time', str(test['duration']))
+        testcase.set('suite_name', test_suite_name)
+        testcase.set('classname', test_suite_name)
+        testcase.set('name', test['testDisplayName'])
+
+        for entry in test['entries']:
+            event = entry['event']
+            message = event['message']
+            if event['type'] == 'Error':
+                failure = elemTree.SubElement(testcase, 'failure')
+                failure.text = message
+                failure.set('message', message)
+
+    junit_tree = elemTree.ElementTree(junit_root)
+    junit_tree.write(out_path)
+
+
+def _write_report(path: str):
+    # Written a test at a time, so generating it doesn't skew the memory numbers
+    with open(path, 'w', encoding='utf-8-sig') as f:
+        f.write('{"succeeded": 0, "failed": 0, "totalDuration": 1234.5, "tests": [')
+        for i in range(_test_count):
+            failed = i % 20 == 0
+            entries = [{'event': {'type': 'Error' if failed and x == 0 else 'Info',
+                                  'message': f'Log message {x} for test {i} with some <xml> & "quotes"'},
+                        'filename': 'Test.cpp', 'lineNumber': x}
+                       for x in range(_entries_per_test)]
+            test = {
+                'testDisplayName': f'Test {i}',
+                'fullTestPath': f'Project.Tests.Suite{i // _tests_per_suite}.Test{i}',
+                'state': 'Fail' if failed else 'Success',
+                'duration': 0.25,
+                'entries': entries,
+            }
+            f.write(('' if i == 0 else ',') + json.dumps(test))
+        f.write(']}')
+
+
+def _measure(func, ue_path: str, out_path: str) -> tuple[float, int]:
+    tracemalloc.start()
+    start = time.perf_counter()
+    func(ue_path, out_path)
+    duration = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return duration, peak
+
+
+def main():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        ue_path = f'{temp_dir}/index.json'
+        _write_report(ue_path)
+        print(f'Report: {_test_count:,} tests, {os.path.getsize(ue_path) / 1024 / 1024:.0f} MB')
+
+        legacy_time, legacy_peak = _measure(_legacy_ue_to_junit, ue_path, f'{temp_dir}/legacy.xml')
+        new_time, new_peak = _measure(ue_to_junit, ue_path, f'{temp_dir}/junit.xml')
+
+    print(f'Legacy:    {legacy_time:>8.2f}s  {legacy_peak / 1024 / 1024:>8.1f} MB peak')
+    print(f'Streaming: {new_time:>8.2f}s  {new_peak / 1024 / 1024:>8.1f} MB peak')
+
+
+if __name__ == '__main__':
+    main()
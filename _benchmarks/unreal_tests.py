@@ -0,0 +1,165 @@
+"""
+Checks filter_tests, plan_test_shards and merge_ue_reports, then runs sharded tests against fake_editor, once as
+normal and once with a shard that crashes part way through. The fake editor is run as a script, so this needs Linux
+or macOS.
+"""
+
+import json
+import os
+import stat
+import sys
+import tempfile
+
+from ..unreal.automation import filter_tests, plan_test_shards
+from ..unreal.unreal import Unreal
+from ..utility.test_converter import merge_ue_reports
+from . import fake_editor
+
+
+def _check_filter_tests():
+    tests = fake_editor.tests
+    assert filter_tests(tests, 'Project') == tests[:-1]
+    assert filter_tests(tests, 'project.suite1.test3') == ['Project.Suite1.Test 3']
+    assert filter_tests(tests, 'Project.Suite1+Other') == [x for x in tests if 'Suite1' in x] + ['Other.Thing']
+    assert filter_tests(tests, 'Nothing') == []
+    assert filter_tests(tests, 'StartsWith:Project') == tests[:-1]
+    assert filter_tests(tests, 'StartsWith:Suite1') == []
+    assert filter_tests(tests, 'Suite1.Test') == [x for x in tests if 'Suite1' in x]
+    assert filter_tests(tests, 'Numbered.Test1') == ['Project.Numbered.Test1', 'Project.Numbered.Test10',
+                                                     'Project.Numbered.Test11']
+    print('filter_tests: ok')
+
+
+def _check_plan_test_shards():
+    tests = filter_tests(fake_editor.tests, 'Project')
+    durations = {x: 0.1 for x in tests}
+    durations['Project.Big.Slow'] = 5.0
+
+    for shard_count in [1, 2, 3, 7, 100]:
+        shards = plan_test_shards(tests, shard_count, durations, fake_editor.tests)
+        assert len(shards) <= shard_count
+        assert sorted(x for y in shards for x in y.tests) == sorted(tests)
+
+        # Each shard's filters must run its tests and nothing else
+        for shard in shards:
+            assert sorted(filter_tests(fake_editor.tests, '+'.join(shard.filters))) == sorted(shard.tests)
+
+    # The suite's too long for one shard, so it's split, but Test1 runs Test10 and Test11 too wherever it goes
+    numbered = [x for x in tests if 'Numbered' in x]
+    shards = plan_test_shards(numbered, 3, durations, fake_editor.tests)
+    test1_shard = next(x for x in shards if 'Project.Numbered.Test1' in x.tests)
+    assert {'Project.Numbered.Test10', 'Project.Numbered.Test11'} <= set(test1_shard.tests)
+    for shard in shards:
+        assert sorted(filter_tests(fake_editor.tests, '+'.join(shard.filters))) == sorted(shard.tests)
+
+    # The slow test takes longer than the rest put together, so it should get a shard to itself
+    shards = plan_test_shards(tests, 3, durations, fake_editor.tests)
+    slow_shard = next(x for x in shards if 'Project.Big.Slow' in x.tests)
+    assert slow_shard.tests == ['Project.Big.Slow']
+    print(f'plan_test_shards: ok, 3 shards take {", ".join(f"{x.duration:.2f}s" for x in shards)}')
+
+
+def _check_merge_ue_reports(temp_dir: str):
+    paths = []
+    for i, states in enumerate([['Success', 'Fail'], ['Success', 'NotRun', 'InProcess']]):
+        tests = [{'testDisplayName': f'Test {x}', 'fullTestPath': f'Project.Report{i}.Test {x}', 'state': y,
+                  'duration': 1.0, 'entries': []} for x, y in enumerate(states)]
+        paths.append(f'{temp_dir}/Report{i}')
+        os.makedirs(paths[-1])
+        with open(f'{paths[-1]}/index.json', 'w', encoding='utf-8-sig') as file:
+            json.dump({'succeeded': states.count('Success'), 'failed': states.count('Fail'),
+                       'notRun': states.count('NotRun'), 'totalDuration': float(len(states)), 'tests': tests}, file)
+
+    merge_ue_reports(paths, f'{temp_dir}/Merged/index.json')
+    with open(f'{temp_dir}/Merged/index.json', encoding='utf-8-sig') as file:
+        merged = json.load(file)
+
+    assert [x['fullTestPath'] for x in merged['tests']] == [
+        'Project.Report0.Test 0', 'Project.Report0.Test 1',
+        'Project.Report1.Test 0', 'Project.Report1.Test 1', 'Project.Report1.Test 2']
+    assert (merged['succeeded'], merged['failed'], merged['notRun']) == (2, 1, 1)
+    assert merged['totalDuration'] == 3.0
+    print('merge_ue_reports: ok')
+
+
+def _write_fake_engine(root: str) -> Unreal:
+    os.makedirs(f'{root}/Engine/Build/BatchFiles')
+    for name in ['RunUAT.bat', 'RunUBT.bat']:
+        open(f'{root}/Engine/Build/BatchFiles/{name}', 'w').close()
+
+    editor_path = f'{root}/Engine/Binaries/Win64/UnrealEditor-Cmd'
+    os.makedirs(os.path.dirname(editor_path))
+    with open(fake_editor.__file__) as source, open(editor_path, 'w') as file:
+        file.write(f'#!{sys.executable}\n')
+        file.write(source.read())
+    os.chmod(editor_path, os.stat(editor_path).st_mode | stat.S_IEXEC)
+
+    return Unreal.source_build(root)
+
+
+def _check_run_tests(temp_dir: str):
+    editor = _write_fake_engine(f'{temp_dir}/UE').editor()
+    tests = filter_tests(fake_editor.tests, 'Project')
+
+    code, _, _ = editor.run_tests('Project.uproject', 'StartsWith:Project', f'{temp_dir}/Run', shards=3)
+    with open(f'{temp_dir}/Run/index.json', encoding='utf-8-sig') as file:
+        report = json.load(file)
+    assert code == 0
+    # Each test runs exactly once across the shards
+    assert sorted(x['fullTestPath'] for x in report['tests']) == sorted(tests)
+    assert (report['succeeded'], report['failed']) == (len(tests) - 1, 1)
+    print('run_tests: ok')
+
+    os.environ['FAKE_EDITOR_CRASH'] = '1'
+    try:
+        editor.run_tests('Project.uproject', 'Project', f'{temp_dir}/Crash', shards=3)
+        crashed = False
+    except Exception:
+        crashed = True
+    finally:
+        del os.environ['FAKE_EDITOR_CRASH']
+    assert crashed, 'run_tests should fail when a shard crashes'
+
+    with open(f'{temp_dir}/Crash/index.json', encoding='utf-8-sig') as file:
+        report = json.load(file)
+    states = {x['fullTestPath']: x['state'] for x in report['tests']}
+    assert sorted(states) == sorted(tests)
+    assert states['Project.Suite2.Test 1'] == 'InProcess'
+    assert states['Project.Suite2.Test 2'] == 'NotRun'
+    print(f'run_tests with a crashed shard: ok, {report["notRun"]} tests not run')
+
+    # Without shards the report should come out the same shape, with the tests the editor never got to as NotRun
+    os.environ['FAKE_EDITOR_CRASH'] = '1'
+    try:
+        editor.run_tests('Project.uproject', 'Project.Suite2', f'{temp_dir}/CrashUnsharded')
+        crashed = False
+    except Exception:
+        crashed = True
+    finally:
+        del os.environ['FAKE_EDITOR_CRASH']
+    assert crashed, 'run_tests should fail when the editor crashes'
+
+    with open(f'{temp_dir}/CrashUnsharded/index.json', encoding='utf-8-sig') as file:
+        report = json.load(file)
+    states = {x['fullTestPath']: x['state'] for x in report['tests']}
+    assert sorted(states) == sorted(filter_tests(tests, 'Project.Suite2'))
+    assert states['Project.Suite2.Test 0'] == 'Success'
+    assert states['Project.Suite2.Test 1'] == 'InProcess'
+    assert states['Project.Suite2.Test 2'] == 'NotRun'
+    print(f'run_tests with a crashed editor: ok, {report["notRun"]} tests not run')
+
+
+def main():
+    _check_filter_tests()
+    _check_plan_test_shards()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        _check_merge_ue_reports(temp_dir)
+        if sys.platform == 'win32':
+            print('run_tests: skipped, the fake editor can only be run as a script on Linux and macOS')
+        else:
+            _check_run_tests(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
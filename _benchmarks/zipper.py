@@ -0,0 +1,97 @@
+"""
+Measures how long zip_files takes to zip a generated staged build with the built in writer, on one thread and on
+every core, compared to 7z and to Python's zipfile. zipfile stores the same files zip_files does, like the paks, so
+each of them deflates the same data. 7z is skipped if it isn't on PATH.
+"""
+
+import os
+import random
+import shutil
+import tempfile
+import time
+import zipfile
+
+from ..utility.zipper import zip_files, _stored_extensions
+
+_pak_size = 512 * 1024 * 1024
+_binary_count = 8
+_binary_size = 64 * 1024 * 1024
+_small_file_count = 5_000
+
+
+def _compressible_data(rng: random.Random, size: int) -> bytes:
+    # Roughly how well executables and debug info deflate, repeated blocks with some noise between them
+    block = rng.randbytes(4096)
+    parts = []
+    while sum(len(x) for x in parts) < size:
+        parts.append(block)
+        parts.append(rng.randbytes(1024))
+    return b''.join(parts)[:size]
+
+
+def _write_staged_build(root: str):
+    rng = random.Random(1234)
+
+    paks = f'{root}/Game/Content/Paks'
+    os.makedirs(paks)
+    with open(f'{paks}/pakchunk0-Windows.pak', 'wb') as f:
+        for _ in range(_pak_size // (64 * 1024 * 1024)):
+            f.write(rng.randbytes(64 * 1024 * 1024))
+    with open(f'{paks}/pakchunk0-Windows.ucas', 'wb') as f:
+        f.write(rng.randbytes(_pak_size // 4))
+    with open(f'{paks}/pakchunk0-Windows.utoc', 'wb') as f:
+        f.write(rng.randbytes(1024 * 1024))
+
+    binaries = f'{root}/Game/Binaries/Win64'
+    os.makedirs(binaries)
+    for i in range(_binary_count):
+        extension = 'pdb' if i % 2 else 'dll'
+        with open(f'{binaries}/Module{i}.{extension}', 'wb') as f:
+            f.write(_compressible_data(rng, _binary_size))
+
+    for i in range(_small_file_count):
+        folder = f'{root}/Engine/Config/Folder{i % 50}'
+        os.makedirs(folder, exist_ok=True)
+        with open(f'{folder}/Config{i}.ini', 'w') as f:
+            f.write(''.join(f'Setting{x}=Value{rng.randint(0, 100)}\n' for x in range(rng.randint(10, 200))))
+
+
+def _zipfile_zip(zip_path: str, root: str):
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=5) as z:
+        for folder, _, filenames in os.walk(root):
+            for name in filenames:
+                path = os.path.join(folder, name)
+                stored = os.path.splitext(name)[1].lower() in _stored_extensions
+                z.write(path, os.path.relpath(path, os.path.dirname(root)),
+                        zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED)
+
+
+def _measure(name: str, func, zip_path: str):
+    start = time.perf_counter()
+    func()
+    duration = time.perf_counter() - start
+    print(f'{name:<20} {duration:>8.2f}s  {os.path.getsize(zip_path) / 1024 / 1024:>8.1f} MB')
+    os.remove(zip_path)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        root = f'{temp_dir}/Windows'
+        _write_staged_build(root)
+
+        size = sum(os.path.getsize(os.path.join(x, y)) for x, _, files in os.walk(root) for y in files)
+        print(f'Staged build: {size / 1024 / 1024:.0f} MB, {os.cpu_count()} cores')
+
+        zip_path = f'{temp_dir}/build.zip'
+        _measure('zipfile', lambda: _zipfile_zip(zip_path, root), zip_path)
+        _measure('builtin, 1 thread', lambda: zip_files(zip_path, [root], backend='builtin', max_workers=1), zip_path)
+        _measure('builtin', lambda: zip_files(zip_path, [root], backend='builtin'), zip_path)
+
+        if shutil.which('7z'):
+            _measure('7z', lambda: zip_files(zip_path, [root], backend='7z'), zip_path)
+        else:
+            print(f'{"7z":<20} not on PATH, no result')
+
+
+if __name__ == '__main__':
+    main()
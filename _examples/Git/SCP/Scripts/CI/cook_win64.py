@@ -20,9 +20,9 @@ if steam_branch in shipping_only_branches:
 else:
     configs_to_build = branch_configurations
 
-for config in configs_to_build:
-    ci.gl_open_block(f'CookGame_{config}', f'Cook and stage game files | {config}')
-    uat.build_cook_run(
+
+def cook(config: str):
+    return uat.build_cook_run(
         project,
         ci.BuildCookRunArguments(
             configuration=config,
@@ -35,4 +35,11 @@ for config in configs_to_build:
             stagingdirectory=f'"{cwd}/Build/{config}"'
         )
     )
-    ci.gl_close_block(f'CookGame_{config}')
+
+
+# One at a time, UBT only lets one instance build at once and every config cooks into the same Saved/Cooked/Win64
+ci.run_jobs(
+    [ci.Job(f'CookGame_{config}', lambda config=config: cook(config),
+            section_header=f'Cook and stage game files | {config}') for config in configs_to_build],
+    max_concurrency=1
+)
@@ -1,7 +1,6 @@
 import platform
 import subprocess
 import os
-import re
 import json
 from typing import List, Tuple, Any
 from pathlib import Path
@@ -51,18 +50,14 @@ class GLab:
 
         raise Exception('Error occurred while executing glab! Please read the logs above.')
 
-    def exec(self, args: list[str], display_console_stdout=False, display_console_stderr=False,
-             log_to_file=True) -> (int, str, str):
+    def _build_exec_cmd(self, args: list[str]) -> list[str]:
         cmd = [
             'glab'
         ]
 
         cmd.extend(args)
 
-        is_calling_api = False
         if args[0] == 'api':
-            is_calling_api = True
-
             # Try to get the index of -X, if it doesn't exist
             # we can assume it's a GET request
             # @todo This seems to have a perf impact so lets just make the user do it themselves, but revisit this later
@@ -82,11 +77,23 @@ class GLab:
                 cmd[2] = replaced_args
 
         self._logger.debug(f'Executing command: {cmd}')
+        return cmd
 
-        ret, stdout, stderr = run_process(cmd, sup_con_stdout=not display_console_stdout,
-                                          sup_con_stderr=not display_console_stderr, log_to_file=log_to_file,
-                                          allow_fail=True)
+    def _create_api_error_watcher(self, args: list[str]) -> OutputWatcher:
+        """
+        When calling endpoints, glab will return 0 even if there's an HTTP error message in stderr, so we watch
+        stderr for it while the command runs
+        """
+        if args[0] != 'api':
+            return None
+
+        return OutputWatcher(self._glab_api_error_regex, stream='stderr')
 
+    def _check_exec_result(self, args: list[str], ret: int, stdout: str, stderr: str,
+                           api_error_watcher: OutputWatcher):
+        """
+        Throws if glab failed, including API calls that returned 0 with an HTTP error
+        """
         self._logger.debug(f'Executed glab. Returned {ret}.')
         self._logger.debug(stdout)
         self._logger.debug(stderr)
@@ -95,17 +102,41 @@ class GLab:
             self._throw_exec_exception(args, ret, stdout, stderr)
 
         # Handle certain cases for the API command
-        if is_calling_api:
-            # When calling endpoints, it will return 0 even if there's HTTP error message in stderr
-            if len(stderr) > 0:
-                match = re.match(self._glab_api_error_regex, stderr)
+        if api_error_watcher is not None:
+            match = api_error_watcher.first_match
+
+            # No successful HTTP codes should be inside stderr, so it's fine to
+            # throw an error if group 2 has contents.
+            # GLab reports that it needs updating here too, even on API calls
+            if match is not None and match.group(2):
+                self._throw_exec_exception(args, ret, stdout, stderr)
+
+    def exec(self, args: list[str], display_console_stdout=False, display_console_stderr=False,
+             log_to_file=True) -> (int, str, str):
+        cmd = self._build_exec_cmd(args)
+        api_error_watcher = self._create_api_error_watcher(args)
+
+        ret, stdout, stderr = run_process(cmd, sup_con_stdout=not display_console_stdout,
+                                          sup_con_stderr=not display_console_stderr, log_to_file=log_to_file,
+                                          allow_fail=True, watchers=[api_error_watcher] if api_error_watcher else None)
+
+        self._check_exec_result(args, ret, stdout, stderr, api_error_watcher)
+        return ret, stdout, stderr
+
+    async def exec_async(self, args: list[str], display_console_stdout=False, display_console_stderr=False,
+                         log_to_file=True) -> (int, str, str):
+        """
+        Awaitable version of exec. Allows several glab calls to run at the same time.
+        """
+        cmd = self._build_exec_cmd(args)
+        api_error_watcher = self._create_api_error_watcher(args)
 
-                # No successful HTTP codes should be inside stderr, so it's fine to
-                # throw an error if group 2 has contents.
-                # GLab reports that it needs updating here too, even on API calls
-                if match is not None and match.group(2):
-                    self._throw_exec_exception(args, ret, stdout, stderr)
+        ret, stdout, stderr = await run_process_async(cmd, sup_con_stdout=not display_console_stdout,
+                                                      sup_con_stderr=not display_console_stderr,
+                                                      log_to_file=log_to_file, allow_fail=True,
+                                                      watchers=[api_error_watcher] if api_error_watcher else None)
 
+        self._check_exec_result(args, ret, stdout, stderr, api_error_watcher)
         return ret, stdout, stderr
 
     def _get_project_data(self) -> dict:
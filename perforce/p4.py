@@ -8,7 +8,14 @@ class PerforceHandler(OutputHandler):
         OutputHandler.__init__(self)
         self.logger = _in_logger
 
+        # Set while syncing, so we log totals rather than a line for every file
+        self.counter: LogCounter = None
+
     def outputInfo(self, i):
+        if self.counter is not None:
+            file_size = i.get('fileSize', 0) if isinstance(i, dict) else 0
+            self.counter.add(files=1, bytes=int(file_size))
+
         self.logger.debug(i)
         return OutputHandler.HANDLED
 
@@ -23,6 +30,7 @@ class Perforce:
     """
 
     _logger = register_logger('perforce')
+    set_log_collapse('perforce')
 
     @staticmethod
     @lru_cache()
@@ -56,6 +64,7 @@ class Perforce:
 
         self.fingerprint = fingerprint
 
+    @trace('p4 login', 'p4')
     def login(self):
         self.p4.connect()
 
@@ -71,6 +80,7 @@ class Perforce:
         os.environ['P4USER'] = self.p4.user
         os.environ['P4CHARSET'] = self.p4.charset
 
+    @trace('p4 update client', 'p4')
     def update_client(self, name: str, root: str = None, view: list[str] = None):
         """
         Updates the specified client, or creates it with the given details if it doesn't already exist
@@ -113,7 +123,13 @@ class Perforce:
 
         # We have to set this here, because we can't manually set global opts
         self.p4.client = name
-        self.p4.run_sync(*args)
+        with trace('p4 sync', 'p4', {'client': name, 'dry_run': dry_run}):
+            with LogCounter(self._logger, 'Synced') as counter:
+                self.p4.handler.counter = counter
+                try:
+                    self.p4.run_sync(*args)
+                finally:
+                    self.p4.handler.counter = None
 
     def get(self) -> P4:
         """
@@ -27,11 +27,12 @@ class SteamAPI:
 
         data_with_key = {'key': self._api_key} | data
 
-        if verb == 'get':
-            req = requests.get(url=url, data=data_with_key)
-        else:
-            # Treat as post request
-            req = requests.post(url=url, data=data_with_key)
+        with trace(f'{verb.upper()} {url}', 'http', {'url': url}):
+            if verb == 'get':
+                req = requests.get(url=url, data=data_with_key)
+            else:
+                # Treat as post request
+                req = requests.post(url=url, data=data_with_key)
 
         code = req.status_code
         if code == 201:
@@ -54,15 +54,11 @@ class SteamCMD:
             self._logger.error(
                 f'Failed to obtain 2FA code from SteamCMD-2FA! Error code: {proc.returncode} {proc.stdout}')
 
-    def exec(self, args: list) -> (int, str, str):
-        """
-        Executes SteamCMD with then specified arguments
-        """
-
+    def _build_exec_cmd(self, args: list) -> list:
         code = self.generate_code(self.username, self.password, self.seed)
         if code is None:
             self._logger.fatal("Failed to obtain Steam authentication code!")
-            return
+            return None
 
         cmd = [
             f'steamcmd',
@@ -77,14 +73,51 @@ class SteamCMD:
         cmd.append('+quit')
 
         self._logger.debug(f'Executing SteamCMD with {cmd}')
+        return cmd
+
+    def exec(self, args: list, watchers: list[OutputWatcher] = None, timeout: float = None,
+             inactivity_timeout: float = None) -> (int, str, str):
+        """
+        Executes SteamCMD with then specified arguments
+        :param watchers:            Optional OutputWatchers to run against the output as it streams in
+        :param timeout:             Kills SteamCMD after this many seconds
+        :param inactivity_timeout:  Kills SteamCMD after this many seconds without output, e.g. a hung login
+        """
+
+        cmd = self._build_exec_cmd(args)
+        if cmd is None:
+            return
+
+        ret, stdout, stderr = run_process(cmd, allow_fail=True, watchers=watchers, timeout=timeout,
+                                          inactivity_timeout=inactivity_timeout)
 
-        ret, stdout, stderr = run_process(cmd, allow_fail=True)
+        # Check if we updated, if so re-run the command. Only when stdout starts with the message, steamcmd carries
+        # on running the commands after an update, and re-running them could upload a build twice.
+        match = re.match(self._update_message, stdout)
+        if match is not None:
+            self._logger.debug('Steam updated, restarting exec!')
+            return self.exec(args, watchers, timeout, inactivity_timeout)
+
+        return ret, stdout, stderr
+
+    async def exec_async(self, args: list, watchers: list[OutputWatcher] = None, timeout: float = None,
+                         inactivity_timeout: float = None) -> (int, str, str):
+        """
+        Awaitable version of exec
+        """
+
+        cmd = self._build_exec_cmd(args)
+        if cmd is None:
+            return
+
+        ret, stdout, stderr = await run_process_async(cmd, allow_fail=True, watchers=watchers, timeout=timeout,
+                                                      inactivity_timeout=inactivity_timeout)
 
-        # Check if we updated, if so re-run the command
+        # Check if we updated, if so re-run the command, see exec
         match = re.match(self._update_message, stdout)
         if match is not None:
             self._logger.debug('Steam updated, restarting exec!')
-            return self.exec(args)
+            return await self.exec_async(args, watchers, timeout, inactivity_timeout)
 
         return ret, stdout, stderr
 
@@ -112,11 +145,11 @@ class SteamCMD:
 
         self._logger.info(f'Running app build for {build_script}')
 
-        ret, stdout, stderr = self.exec([cmd])
+        build_watcher = OutputWatcher(self._build_finished_regex, stream='stdout')
+        ret, stdout, stderr = self.exec([cmd], watchers=[build_watcher])
         build_id = -1
 
-        match = re.search(self._build_finished_regex, stdout)
-        if match is not None:
-            build_id = match.group(1)
+        if build_watcher.last_match is not None:
+            build_id = build_watcher.last_match.group(1)
 
         return ret, build_id
@@ -1,3 +1,4 @@
 from .arguments import *
+from .automation import *
 from .uat import *
 from .unreal import *
@@ -0,0 +1,380 @@
+"""
+Helpers for running Unreal automation tests, used by Editor.run_tests.
+"""
+
+import os
+import re
+import json
+import time
+import heapq
+import queue
+import bisect
+import threading
+import statistics
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Iterator
+
+from ..utility import *
+
+# Each test printed by 'Automation List', e.g. LogAutomationCommandLine: Display: 	Project.Functional Tests.Maps.Foo
+_test_list_regex = re.compile(r'LogAutomationCommandLine: Display: \t(?P<test>\S.*?)\s*$')
+
+
+def _normalize_test_name(name: str) -> str:
+    # RunTests ignores case and spaces when matching its filter
+    return name.replace(' ', '').casefold()
+
+
+_starts_with_prefix = 'StartsWith:'
+
+
+def _parse_test_filter(test_filter: str) -> list[tuple[bool, str]]:
+    """
+    Splits a RunTests filter into (starts_with, name) pairs. Names are normalized, starts_with is set for the
+    StartsWith: form, the rest match anywhere in a test's path.
+    """
+    filters = []
+    for part in test_filter.split('+'):
+        part = part.strip()
+        if not part:
+            continue
+
+        if part.casefold().startswith('group:'):
+            raise Exception(f'Test groups come from the project\'s config, so {part} can\'t be split into shards!')
+
+        starts_with = part.casefold().startswith(_starts_with_prefix.casefold())
+        if starts_with:
+            part = part[len(_starts_with_prefix):]
+        filters.append((starts_with, _normalize_test_name(part)))
+    return filters
+
+
+def create_test_list_watcher() -> OutputWatcher:
+    """
+    Returns a watcher which picks out the test names the editor prints for 'Automation List'
+    """
+    return OutputWatcher(_test_list_regex, stream='stdout')
+
+
+def filter_tests(tests: list[str], test_filter: str) -> list[str]:
+    """
+    Returns the tests RunTests would run for the filter, in the same order
+    :param tests:       Full test paths
+    :param test_filter: Filters separated by '+'. Each matches tests whose path contains it, or starts with it when
+                        written as StartsWith:Name.
+    """
+    filters = _parse_test_filter(test_filter)
+
+    def matches(test: str) -> bool:
+        test = _normalize_test_name(test)
+        return any(test.startswith(y) if x else y in test for x, y in filters)
+
+    return [x for x in tests if matches(x)]
+
+
+@dataclass
+class TestShard:
+    """
+    A group of tests run by one editor. filters is what's passed to RunTests, each anchored with StartsWith:. Whole
+    suites are passed as their prefix to keep the command line short.
+    """
+    tests: list[str] = field(default_factory=list)
+    filters: list[str] = field(default_factory=list)
+    duration: float = 0.0
+
+
+def plan_test_shards(tests: list[str], shard_count: int, durations: dict[str, float] = None,
+                     all_tests: list[str] = None) -> list[TestShard]:
+    """
+    Splits the tests into shards that should take about as long as each other, using the longest processing time
+    first rule. Suites are kept together where they fit, as their tests often share a map, and only split up when
+    one suite would take longer than a shard should.
+    RunTests has no way to ask for exactly one test, so a test whose path starts with another's, e.g. Test1 and
+    Test11, is always put in the same shard as it.
+    :param tests:       Full test paths
+    :param shard_count: Number of shards to make, fewer are returned if there aren't enough tests
+    :param durations:   Expected seconds for each test, e.g. the p50 from TestHistory. Tests without one are expected
+                        to take the median of the rest, and if there are none every test counts the same.
+    :param all_tests:   Every test in the project, when tests is only some of them. A suite's prefix is only used when
+                        it doesn't match any other test.
+    """
+    durations = durations or {}
+    known = [durations[x] for x in tests if x in durations]
+    default_duration = statistics.median(known) if known else 1.0
+    test_durations = {x: durations.get(x, default_duration) for x in tests}
+
+    total = sum(test_durations.values())
+    target = total / max(shard_count, 1)
+
+    # A prefix can only stand in for a suite if it doesn't also match tests outside of it
+    sorted_names = sorted(_normalize_test_name(x) for x in (all_tests or tests))
+
+    def prefix_range(names: list[str], prefix: str) -> (int, int):
+        prefix = _normalize_test_name(prefix)
+        return bisect.bisect_left(names, prefix), bisect.bisect_left(names, prefix + '\uffff')
+
+    def count_matching(prefix: str) -> int:
+        start, end = prefix_range(sorted_names, prefix)
+        return end - start
+
+    sorted_tests = sorted(tests, key=_normalize_test_name)
+    sorted_test_names = [_normalize_test_name(x) for x in sorted_tests]
+
+    suites: dict[str, list[str]] = {}
+    for test in tests:
+        suites.setdefault(test.rpartition('.')[0], []).append(test)
+
+    # [filter, tests]
+    items = []
+    for suite, suite_tests in suites.items():
+        suite_duration = sum(test_durations[x] for x in suite_tests)
+        if suite and suite_duration <= target and count_matching(f'{suite}.') == len(suite_tests):
+            items.append((f'{suite}.', suite_tests))
+        else:
+            items.extend((x, [x]) for x in suite_tests)
+
+    # Anything a test's prefix also matches has to go in its shard. Those tests match every filter the test does, so
+    # they're always among the tests being planned.
+    item_of_test = {x: i for i, (_, item_tests) in enumerate(items) for x in item_tests}
+    groups = list(range(len(items)))
+
+    def find_group(index: int) -> int:
+        while groups[index] != index:
+            groups[index] = groups[groups[index]]
+            index = groups[index]
+        return index
+
+    for index, (test_filter, _) in enumerate(items):
+        if count_matching(test_filter) == 1:
+            continue
+        start, end = prefix_range(sorted_test_names, test_filter)
+        for test in sorted_tests[start:end]:
+            groups[find_group(item_of_test[test])] = find_group(index)
+
+    # (duration, filters, tests)
+    merged: dict[int, tuple[float, list[str], list[str]]] = {}
+    for index, (test_filter, item_tests) in enumerate(items):
+        duration, filters, group_tests = merged.setdefault(find_group(index), (0.0, [], []))
+        filters.append(f'{_starts_with_prefix}{test_filter}')
+        group_tests.extend(item_tests)
+        merged[find_group(index)] = (duration + sum(test_durations[x] for x in item_tests), filters, group_tests)
+
+    grouped = sorted(merged.values(), key=lambda x: x[0], reverse=True)
+
+    shards = [TestShard() for _ in range(min(shard_count, len(grouped)))]
+    loads = [(0.0, i) for i in range(len(shards))]
+    for duration, filters, group_tests in grouped:
+        load, index = heapq.heappop(loads)
+        shard = shards[index]
+        shard.filters.extend(filters)
+        shard.tests.extend(group_tests)
+        shard.duration += duration
+        heapq.heappush(loads, (load + duration, index))
+
+    return shards
+
+
+_automation_line_check = 'LogAutomationController: '
+_test_started_regex = re.compile(
+    r'LogAutomationController: \w+: Test Started\. Name=\{(?P<name>.*?)\} Path=\{(?P<path>.*?)\}')
+_test_completed_regex = re.compile(
+    r'LogAutomationController: \w+: Test Completed\. Result=\{(?P<result>\w+)\} Name=\{(?P<name>.*?)\} '
+    r'Path=\{(?P<path>.*?)\}')
+_test_message_regex = re.compile(r'LogAutomationController: (?P<severity>Error|Warning): (?P<message>.*?)\s*$')
+
+
+@dataclass
+class AutomationEvent:
+    """
+    Something that happened in a test run, as seen in the editor's output.
+    kind is 'started', 'completed', 'error' or 'warning'. result is set for completed, e.g. 'Success' or 'Fail', and
+    message for errors and warnings. test is None for errors logged outside of a test.
+    """
+    kind: str
+    test: str
+    result: str = None
+    message: str = None
+    time: float = field(default_factory=time.time)
+
+
+class _AutomationWatcher(OutputWatcher):
+    """
+    Feeds one editor's output to its AutomationRun. Each editor runs one test at a time, so errors belong to
+    whichever test it started last.
+    """
+
+    def __init__(self, run: 'AutomationRun'):
+        super().__init__(None, stream='stdout')
+        self._run = run
+        self.current_test: str = None
+
+    def feed(self, stream_name: str, line: str) -> bool:
+        if self.stream != stream_name:
+            return False
+        return self._run._feed(self, line)
+
+
+class AutomationRun:
+    """
+    Follows the tests of one or more editors as they run, from the automation log lines the editor prints with
+    -stdout. Events are passed to callback as they happen, and can also be read with events() from another thread.
+    Pass one to Editor.run_tests as automation_run to do that.
+
+    The results seen so far can be written out as a UE report with write_report, so there's still something to show
+    if the editor crashes before it writes its own.
+    """
+
+    def __init__(self, callback: Callable[[AutomationEvent], None] = None, max_failures: int = None,
+                 queue_events: bool = False):
+        """
+        :param callback:        Called with each AutomationEvent, on the thread reading the editor's output
+        :param max_failures:    Kill the editors once this many tests have failed
+        :param queue_events:    Keep every event for events(). They're queued until read, so only set this if
+                                something is reading them.
+        """
+        self.callback = callback
+        self.max_failures = max_failures
+
+        self.failures = 0
+        self.stopped_early = False
+
+        # UE report style test entries, keyed by full test path
+        self.tests: dict[str, dict] = {}
+
+        self._lock = threading.Lock()
+        self._watchers: list[_AutomationWatcher] = []
+        self._start_times: dict[str, float] = {}
+        self._events = queue.Queue() if queue_events else None
+
+    def create_watcher(self) -> OutputWatcher:
+        """
+        Returns a watcher to pass to run_process for one editor
+        """
+        watcher = _AutomationWatcher(self)
+        with self._lock:
+            self._watchers.append(watcher)
+        return watcher
+
+    def events(self) -> Iterator[AutomationEvent]:
+        """
+        Yields every event as it happens, until finish is called. Needs queue_events.
+        """
+        if self._events is None:
+            raise Exception('AutomationRun was created without queue_events, so there are no events to read!')
+
+        while True:
+            event = self._events.get()
+            if event is None:
+                return
+            yield event
+
+    def finish(self):
+        """
+        Ends events(), called once every editor has exited
+        """
+        if self._events is not None:
+            self._events.put(None)
+
+    def _feed(self, watcher: _AutomationWatcher, line: str) -> bool:
+        """
+        Handles a line from an editor. Returns True once it's time to stop, as the watchers are made fatal then.
+        """
+        if self.stopped_early:
+            return True
+
+        if _automation_line_check not in line:
+            return False
+
+        with self._lock:
+            event = self._parse_line(watcher, line)
+            if event is None:
+                return False
+
+            if self.max_failures is not None and self.failures >= self.max_failures:
+                self.stopped_early = True
+                for x in self._watchers:
+                    x.fatal = True
+
+        if self._events is not None:
+            self._events.put(event)
+        if self.callback is not None:
+            self.callback(event)
+
+        return self.stopped_early
+
+    def _parse_line(self, watcher: _AutomationWatcher, line: str) -> AutomationEvent:
+        match = _test_completed_regex.search(line)
+        if match is not None:
+            path = match['path']
+            test = self._get_test(path, match['name'])
+            test['state'] = match['result']
+            test['duration'] = time.time() - self._start_times.get(path, time.time())
+            if match['result'] == 'Fail':
+                self.failures += 1
+
+            watcher.current_test = None
+            return AutomationEvent('completed', path, result=match['result'])
+
+        match = _test_started_regex.search(line)
+        if match is not None:
+            path = match['path']
+            self._get_test(path, match['name'])
+            self._start_times[path] = time.time()
+
+            watcher.current_test = path
+            return AutomationEvent('started', path)
+
+        match = _test_message_regex.search(line)
+        if match is not None:
+            if watcher.current_test is not None:
+                self.tests[watcher.current_test]['entries'].append(
+                    {'event': {'type': match['severity'], 'message': match['message']}})
+
+            return AutomationEvent(match['severity'].lower(), watcher.current_test, message=match['message'])
+
+        return None
+
+    def _get_test(self, path: str, name: str) -> dict:
+        if path not in self.tests:
+            # Tests stay InProcess until they complete, which is how UE reports a test the editor crashed during
+            self.tests[path] = {'testDisplayName': name, 'fullTestPath': path, 'state': 'InProcess', 'duration': 0.0,
+                                'entries': []}
+        return self.tests[path]
+
+    @staticmethod
+    def _not_run_test(test: str) -> dict:
+        return {
+            'testDisplayName': test.rpartition('.')[2],
+            'fullTestPath': test,
+            'state': 'NotRun',
+            'duration': 0.0,
+            'entries': [],
+        }
+
+    def write_report(self, ue_path: str, tests: list[str] = None):
+        """
+        Writes the results seen so far as a UE report, which ue_to_junit can convert
+        :param ue_path: File path of the index.json to write
+        :param tests:   Only include these tests, e.g. those of one shard. Any that never started are reported as
+                        NotRun.
+        """
+        with self._lock:
+            if tests is None:
+                results = list(self.tests.values())
+            else:
+                results = [self.tests.get(x) or self._not_run_test(x) for x in tests]
+            results = [dict(x, entries=list(x['entries'])) for x in results]
+
+        report = {
+            'succeeded': sum(x['state'] == 'Success' for x in results),
+            'failed': sum(x['state'] == 'Fail' for x in results),
+            'notRun': sum(x['state'] == 'NotRun' for x in results),
+            'inProcess': sum(x['state'] == 'InProcess' for x in results),
+            'totalDuration': sum(x['duration'] for x in results),
+            'tests': results,
+        }
+
+        Path(os.path.dirname(os.path.abspath(ue_path))).mkdir(parents=True, exist_ok=True)
+        with open(ue_path, 'w', encoding='utf-8') as file:
+            json.dump(report, file)
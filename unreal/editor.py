@@ -1,6 +1,10 @@
+import os
 import subprocess
+from functools import partial
+from typing import Callable
 
 from ..utility import *
+from .automation import *
 
 # To work around circular imports
 from typing import TYPE_CHECKING
@@ -17,15 +21,7 @@ class Editor:
         self.logger.debug('Initialising Editor')
         self._unreal = unreal
 
-    def exec_cmd(self, project: str, args: list, nullrhi: bool = True) -> (int, str, str):
-        """
-        Executes UnrealEditor-Cmd with the specified arguments
-        :param project: Path to .uproject
-        :param args:    Arguments to pass to the exe
-        :param nullrhi: Whether to run with a null renderer
-        :return:        Exit code and stdout
-        """
-
+    def _build_exec_cmd(self, project: str, args: list, nullrhi: bool) -> list:
         cmd = [f'{self._unreal.binaries_path}/UnrealEditor-Cmd',
                f'{project}',
                '-unattended',
@@ -41,7 +37,33 @@ class Editor:
         cmd.extend(args)
 
         self.logger.debug(f'Executing UnrealEditor-Cmd with {cmd}')
-        return process.run_process(cmd, log_to_file=False)
+        return cmd
+
+    def exec_cmd(self, project: str, args: list, nullrhi: bool = True, timeout: float = None,
+                 inactivity_timeout: float = None, watchers: list[OutputWatcher] = None) -> (int, str, str):
+        """
+        Executes UnrealEditor-Cmd with the specified arguments
+        :param project:             Path to .uproject
+        :param args:                Arguments to pass to the exe
+        :param nullrhi:             Whether to run with a null renderer
+        :param timeout:             Kills the editor after this many seconds
+        :param inactivity_timeout:  Kills the editor after this many seconds without output, e.g. a hung shader compile
+        :param watchers:            OutputWatchers to run against the editor's output as it arrives
+        :return:                    Exit code and stdout
+        """
+
+        return process.run_process(self._build_exec_cmd(project, args, nullrhi), log_to_file=False, timeout=timeout,
+                                   inactivity_timeout=inactivity_timeout, watchers=watchers)
+
+    async def exec_cmd_async(self, project: str, args: list, nullrhi: bool = True, timeout: float = None,
+                             inactivity_timeout: float = None, watchers: list[OutputWatcher] = None) -> (int, str, str):
+        """
+        Awaitable version of exec_cmd
+        """
+
+        return await process.run_process_async(self._build_exec_cmd(project, args, nullrhi), log_to_file=False,
+                                               timeout=timeout, inactivity_timeout=inactivity_timeout,
+                                               watchers=watchers)
 
     def exec(self, project: str, args: list) -> (int, str, str):
         """
@@ -66,19 +88,137 @@ class Editor:
 
         return self.exec_cmd(project, cmd)
 
-    def run_tests(self, project: str, test_filter: str, output_path: str) -> (int, str, str):
+    def list_tests(self, project: str) -> list[str]:
         """
-        Runs tests with the specified project
-        :param project:         Path to .uproject
-        :param test_filter:     Test names separated by '+'
-        :param output_path:     Output directory for test report
-        :return:                Exit code and stdout
+        Returns the full path of every automation test in the project
+        :param project: Path to .uproject
         """
 
-        cmd = [
-            f'-ExecCmds=Automation RunTests {test_filter};quit',
-            '-TestExit="Automation Test Queue Empty"',
-            f'-ReportExportPath="{output_path}"'
-        ]
+        watcher = create_test_list_watcher()
+        tests = []
+        watcher.callback = lambda match, stream_name: tests.append(match['test'])
 
-        return self.exec_cmd(project, cmd)
+        self.exec_cmd(project, ['-ExecCmds=Automation List;quit'], watchers=[watcher])
+        return tests
+
+    def run_tests(self, project: str, test_filter: str, output_path: str, shards: int = 1,
+                  history: TestHistory = None, timeout: float = None, inactivity_timeout: float = None,
+                  on_event: Callable[[AutomationEvent], None] = None, max_failures: int = None,
+                  junit_path: str = None, automation_run: AutomationRun = None) -> (int, str, str):
+        """
+        Runs tests with the specified project
+        :param project:             Path to .uproject
+        :param test_filter:         Test names separated by '+'
+        :param output_path:         Output directory for test report
+        :param shards:              If more than 1, the tests are split between this many editors running at once.
+                                    Each shard's report and user dir are kept in output_path/Shards, and the reports
+                                    are merged into output_path/index.json.
+        :param history:             TestHistory used to give each shard a similar amount of work. Without it each
+                                    shard gets a similar number of tests.
+        :param timeout:             Kills an editor after this many seconds
+        :param inactivity_timeout:  Kills an editor after this many seconds without output
+        :param on_event:            Called with an AutomationEvent as each test starts, logs an error and completes
+        :param max_failures:        Stops every editor once this many tests have failed
+        :param junit_path:          Also converts the report to JUnit here, even if the editor crashed or was stopped
+        :param automation_run:      Follows the tests instead of on_event and max_failures, e.g. to read its events()
+                                    from another thread while the tests run
+        :return:                    Exit code and stdout
+        """
+        run = automation_run or AutomationRun(on_event, max_failures)
+
+        # Clients are reused between jobs, a report left behind by an earlier run would hide a crash in this one
+        self._remove_old_report(output_path)
+
+        try:
+            if shards > 1:
+                return self._run_tests_sharded(project, test_filter, output_path, shards, history, timeout,
+                                               inactivity_timeout, run)
+
+            cmd = [
+                f'-ExecCmds=Automation RunTests {test_filter};quit',
+                '-TestExit="Automation Test Queue Empty"',
+                f'-ReportExportPath="{output_path}"'
+            ]
+
+            # RunTests lists the tests it's going to run the same way 'Automation List' does, so a crash can report
+            # the ones it never got to as NotRun, like a crashed shard
+            planned_tests = []
+            list_watcher = create_test_list_watcher()
+            list_watcher.callback = lambda match, stream_name: planned_tests.append(match['test'])
+
+            try:
+                return self.exec_cmd(project, cmd, timeout=timeout, inactivity_timeout=inactivity_timeout,
+                                     watchers=[run.create_watcher(), list_watcher])
+            except Exception as e:
+                if run.stopped_early:
+                    raise Exception(f'Stopped tests after {run.failures} failures!') from e
+                raise
+            finally:
+                # The editor only writes its report once every test has finished
+                if not os.path.exists(f'{output_path}/index.json'):
+                    self.logger.warning('The editor did not write a test report, reporting the tests it started')
+                    run.write_report(f'{output_path}/index.json', planned_tests or None)
+        finally:
+            run.finish()
+            if junit_path is not None and os.path.exists(f'{output_path}/index.json'):
+                ue_to_junit(output_path, junit_path)
+
+    def _remove_old_report(self, report_path: str):
+        """
+        Deletes the index.json in a report folder, if there is one
+        """
+        path = f'{report_path}/index.json'
+        if os.path.exists(path):
+            self.logger.debug(f'Removing old test report {path}')
+            os.remove(path)
+
+    def _run_tests_sharded(self, project: str, test_filter: str, output_path: str, shard_count: int,
+                           history: TestHistory, timeout: float, inactivity_timeout: float,
+                           run: AutomationRun) -> (int, str, str):
+        all_tests = self.list_tests(project)
+        tests = filter_tests(all_tests, test_filter)
+        if not tests:
+            raise Exception(f'No tests found matching {test_filter}!')
+
+        durations = None
+        if history is not None:
+            durations = {x: y.p50 for x, y in history.test_durations(tests=tests).items()}
+
+        shards = plan_test_shards(tests, shard_count, durations, all_tests)
+
+        jobs = []
+        report_paths = []
+        for i, shard in enumerate(shards):
+            shard_path = f'{output_path}/Shards/{i}'
+            report_paths.append(f'{shard_path}/Report')
+            self._remove_old_report(report_paths[-1])
+
+            self.logger.info(f'Shard {i + 1}: {len(shard.tests)} tests, expected to take {shard.duration:.0f}s')
+
+            cmd = [
+                f'-ExecCmds=Automation RunTests {"+".join(shard.filters)};quit',
+                '-TestExit="Automation Test Queue Empty"',
+                f'-ReportExportPath="{shard_path}/Report"',
+                f'-UserDir="{shard_path}/UserDir"'
+            ]
+            jobs.append(Job(f'Test shard {i + 1} of {len(shards)}', partial(self.exec_cmd, project, cmd, True, timeout,
+                                                                          inactivity_timeout, [run.create_watcher()])))
+
+        results = run_jobs(jobs, max_concurrency=len(jobs), allow_fail=True)
+
+        # Shards that crashed or were stopped get a report of the tests they started, the rest are listed as NotRun
+        for shard, report_path in zip(shards, report_paths):
+            if not os.path.exists(f'{report_path}/index.json'):
+                self.logger.warning(f'{report_path} is missing, reporting the tests the shard started')
+                run.write_report(f'{report_path}/index.json', shard.tests)
+
+        merge_ue_reports(report_paths, f'{output_path}/index.json')
+
+        failed = [x for x in results if not x.success]
+        if failed and run.stopped_early:
+            raise Exception(f'Stopped tests after {run.failures} failures!') from failed[0].exception
+        if failed:
+            raise Exception(f'{len(failed)} of {len(results)} test shards failed!') from failed[0].exception
+
+        # exec_cmd raises when the editor exits with an error, so every shard that got here exited with 0
+        return (0, ''.join(x.result.stdout for x in results), ''.join(x.result.stderr for x in results))
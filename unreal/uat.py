@@ -39,15 +39,7 @@ class UAT:
 
         return f'{self._unreal.batch_path}/{uat_path}'
 
-    def exec(self, args: list) -> (int, str, str):
-        """
-        Executes RunUAT with the specified arguments
-
-        :param args:    List of arguments to pass to RunUAT.bat/sh
-        :return:        UAT exit code
-        :rtype:         int, str
-        """
-
+    def _build_exec_cmd(self, args: list) -> list:
         uat_exec = self._get_uat_executable()
 
         cmd = [uat_exec]
@@ -60,8 +52,29 @@ class UAT:
             cmd.append('-unattended')
 
         self.logger.debug(f'Executing UAT with {cmd}')
+        return cmd
+
+    def exec(self, args: list, timeout: float = None, inactivity_timeout: float = None) -> (int, str, str):
+        """
+        Executes RunUAT with the specified arguments
+
+        :param args:                List of arguments to pass to RunUAT.bat/sh
+        :param timeout:             Kills UAT and everything it started after this many seconds
+        :param inactivity_timeout:  Kills UAT and everything it started after this many seconds without output
+        :return:                    UAT exit code
+        :rtype:                     int, str
+        """
+
+        return run_process(self._build_exec_cmd(args), log_to_file=False, timeout=timeout,
+                           inactivity_timeout=inactivity_timeout)
+
+    async def exec_async(self, args: list, timeout: float = None, inactivity_timeout: float = None) -> (int, str, str):
+        """
+        Awaitable version of exec
+        """
 
-        return run_process(cmd, log_to_file=False)
+        return await run_process_async(self._build_exec_cmd(args), log_to_file=False, timeout=timeout,
+                                       inactivity_timeout=inactivity_timeout)
 
     def build_cook_run(self, project: str, args: BuildCookRunArguments) -> (int, str, str):
         """
@@ -2,9 +2,6 @@ import logging
 import os
 import sys
 
-# Locks to windows for now, eventually we should scope to allow this to work on non windows platforms
-import winreg
-
 from ..utility import *
 from .uat import UAT
 from .editor import Editor
@@ -121,6 +118,10 @@ class Unreal:
                 self.logger.debug(
                     f'Environment variable UE_{self.version}_DIR is not defined, looking inside build registry')
 
+                # Locks to windows for now, eventually we should scope to allow this to work on non windows platforms
+                # Imported here so everything else can still be used elsewhere, e.g. to test against a fake editor
+                import winreg
+
                 try:
                     with winreg.OpenKey(winreg.HKEY_CURRENT_USER, self.windows_reg_path, 0, winreg.KEY_READ) as key:
                         value, regtype = winreg.QueryValueEx(key, self.version)
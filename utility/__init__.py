@@ -1,7 +1,11 @@
 from .variables import *
+from .profiler import *
 from .logger import *
+from .process_logs import *
 from .process import *
 from .code_quality import *
 from .test_converter import *
+from .test_history import *
 from .zipper import *
+from .jobs import *
 from .debugging import *
@@ -2,93 +2,591 @@ import re
 import json
 import os
 import hashlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Union
 
 from .logger import *
+from .process import *
 
 
 _logger = register_logger('codequality')
 
 
-# noinspection PyMethodMayBeStatic
-def _extract_errors(compiler_output: str) -> list:
-    # Define a regular expression pattern to match error messages
-    error_pattern = re.compile(
-        r'(?P<path>.*?\(\d+\)): (?P<severity>warning|error) (?P<code>[A-Z]\d+): (?P<description>.*)')
-
-    errors = []
-    for match in error_pattern.finditer(compiler_output):
-        error = match.groupdict()
-        # Parse line number
-        error['line'] = int(re.search(r'\((\d+)\)', error['path']).group(1))
-        # Remove line number from path
-        error['path'] = re.sub(r'\(\d+\)', '', error['path']).strip()
-        # Make the path relative to the current folder
-        error['path'] = os.path.relpath(error['path'])
-        error['path'] = error['path'].replace('\\', '/')  # Convert Windows path to Unix path
-        # Set severity to "minor"
-        error['severity'] = 'minor'
-        # Generate fingerprint using the code and description
-        fingerprint_str = error['code'] + error['description'] + error['path'] + str(error['line'])
-        error['fingerprint'] = hashlib.md5(fingerprint_str.encode()).hexdigest()
-        errors.append(error)
-
-    return errors
+@dataclass
+class IssueParser:
+    """
+    Parses one kind of compiler or tool message. pattern is searched for in each line and can have the named groups
+    path, line, column, severity, code and description. Only lines containing one of quick_checks are searched, as
+    looking for plain strings is far cheaper than the regex and rules out nearly every line of a build log.
+    Messages without a path are reported against default_path, and without a code against default_code.
+    """
+    name: str
+    pattern: re.Pattern
+    quick_checks: tuple[str, ...]
+    default_code: str = None
+    default_path: str = None
 
 
-def _generate_code_climate_report(errors):
+# Checked in order, the first parser that matches a line wins
+_parsers: dict[str, IssueParser] = {}
+
+
+def register_parser(parser: IssueParser):
     """
-    Converts the errors list into code climate format
+    Adds a parser, replacing any existing parser with the same name.
+    Parsers used by parse_files in worker processes, the default on Linux, have to be picklable so they can be sent
+    to them.
+    """
+    _parsers[parser.name] = parser
+
+
+def get_parsers(names: list[str] = None) -> list[IssueParser]:
+    """
+    Returns the parsers with the given names, or all of them in the order they're checked
+    """
+    if names is None:
+        return list(_parsers.values())
+
+    unknown = [x for x in names if x not in _parsers]
+    if unknown:
+        raise Exception(f'Unknown code quality parsers: {", ".join(unknown)}')
+
+    return [_parsers[x] for x in names]
+
+
+# C:/Project/Source/Foo.cpp(12): warning C4996: 'x': was declared deprecated
+# C:/Project/Source/Foo.cpp(12,5): error C2065: 'y': undeclared identifier
+register_parser(IssueParser(
+    'msvc',
+    re.compile(r'(?P<path>.*?)\((?P<line>\d+)(?:,(?P<column>\d+))?\): (?P<severity>warning|error|fatal error) '
+               r'(?P<code>[A-Z]+\d+): (?P<description>.*)'),
+    ('): ',)))
+
+# C:/Project/Source/Foo.h(42): Error: Unrecognized type 'FBar'
+register_parser(IssueParser(
+    'uht',
+    re.compile(r'(?P<path>.*?)\((?P<line>\d+)\)\s*: (?P<severity>Error|Warning): (?P<description>.*)'),
+    ('): Error: ', '): Warning: '),
+    default_code='UHT'))
+
+# Foo.obj : error LNK2019: unresolved external symbol "void Bar(void)"
+register_parser(IssueParser(
+    'link',
+    re.compile(r'^\s*(?P<path>.*?) : (?P<severity>warning|error|fatal error) (?P<code>LNK\d+): (?P<description>.*)'),
+    (' LNK',)))
+
+# /Project/Source/Foo.cpp:12:5: warning: unused variable 'x' [-Wunused-variable]
+register_parser(IssueParser(
+    'clang',
+    re.compile(r'^\s*(?P<path>(?:[A-Za-z]:)?[^:*?"<>|\r\n]+?):(?P<line>\d+):(?:(?P<column>\d+):)? '
+               r'(?P<severity>warning|error|fatal error): (?P<description>.*?)(?: \[(?P<code>-W[^\]]+)\])?\s*$'),
+    (': warning: ', ': error: ', ': fatal error: '),
+    default_code='clang'))
+
+# ld.lld: error: undefined symbol: Bar()
+# /usr/bin/ld: Foo.o: undefined reference to `Bar()'
+register_parser(IssueParser(
+    'ld',
+    re.compile(r'^\s*(?:\S*/)?(?P<code>ld|ld\.lld|lld-link): (?:(?P<severity>error|warning): )?(?P<description>.*)'),
+    ('ld: ', 'ld.lld: ', 'lld-link: '),
+    default_path='ld'))
+
+# UnrealBuildTool : error : Unable to find project
+# ERROR: Unable to instantiate module 'Foo'
+# Lower case messages need the UnrealBuildTool prefix, otherwise they're something like clang's
+# 'error: 3 errors generated.'
+register_parser(IssueParser(
+    'ubt',
+    re.compile(r'^\s*(?:UnrealBuildTool\s*: (?=error|warning)|(?=ERROR|WARNING))'
+               r'(?P<severity>error|warning|ERROR|WARNING)\s*: (?P<description>.*)'),
+    ('UnrealBuildTool', 'ERROR', 'WARNING'),
+    default_code='UBT',
+    default_path='UnrealBuildTool'))
+
+# [2024.01.01-12.00.00:000][  0]LogCook: Error: Failed to load /Game/Maps/Foo
+register_parser(IssueParser(
+    'ue_log',
+    re.compile(r'(?P<code>Log\w+): (?P<severity>Error|Warning): (?P<description>.*)'),
+    (': Error: ', ': Warning: '),
+    default_path='UnrealEditor'))
+
+
+# Absolute roots, such as the engine, mapped to the prefix their paths are reported with, see set_path_prefixes
+_path_prefixes: dict[str, str] = {}
+
+# How many distinct paths to remember. A header included by hundreds of files produces the same path over and over.
+_path_cache_size = 16384
+
+
+def set_path_prefixes(prefixes: dict[str, str]):
+    """
+    Reports paths under the given roots with a prefix rather than relative to the current folder, e.g.
+    {'C:/UE5/Engine': 'Engine'} reports C:/UE5/Engine/Source/Foo.h as Engine/Source/Foo.h.
+    Roots are matched ignoring case and slash direction.
+    """
+    global _path_prefixes
+
+    # Longest first so nested roots win over their parents
+    cleaned = {x.replace('\\', '/').rstrip('/').casefold() + '/': y.rstrip('/') for x, y in prefixes.items()}
+    _path_prefixes = dict(sorted(cleaned.items(), key=lambda x: len(x[0]), reverse=True))
+    _normalize_path.cache_clear()
+
+
+@lru_cache(maxsize=_path_cache_size)
+def _normalize_path(path: str, cwd: str) -> str:
+    # cwd is only there so the cache is keyed on it, relpath is relative to the current folder
+    path = path.strip().replace('\\', '/')
+
+    folded = path.casefold()
+    for root, prefix in _path_prefixes.items():
+        if folded.startswith(root):
+            return f'{prefix}/{path[len(root):]}'
+
+    # Make the path relative to the current folder
+    return os.path.relpath(path, cwd).replace('\\', '/')
+
+
+def get_path_cache_hit_rate() -> float:
+    """
+    Returns the fraction of issue paths that were normalized from the cache, in this process
+    """
+    info = _normalize_path.cache_info()
+    total = info.hits + info.misses
+    return info.hits / total if total else 0.0
+
+
+def _get_fingerprint(code: str, description: str, path: str, line: int) -> str:
+    return hashlib.md5((code + description + path + str(line)).encode()).hexdigest()
+
+
+def _get_stable_fingerprint(code: str, description: str, path: str) -> str:
+    # Without the line number, so it's the same after code above it has changed. Identical messages in the same file
+    # share one, CodeQualityReport tells them apart by their order in the file.
+    return hashlib.md5((code + description + path).encode()).hexdigest()
+
+
+def _make_issue(path: str, line: int, code: str, description: str, column: int = None) -> dict:
+    path = _normalize_path(path, os.getcwd())
+
+    return {
+        'path': path,
+        'line': line,
+        'column': column,
+        'severity': 'minor',
+        'code': code,
+        'description': description,
+        'fingerprint': _get_fingerprint(code, description, path, line),
+    }
+
+
+def _compile_quick_checks(parsers: list[IssueParser]) -> re.Pattern:
+    return re.compile('|'.join(re.escape(x) for parser in parsers for x in parser.quick_checks))
+
+
+class _ParserSet:
+    """
+    The parsers used for a parse, with their quick checks combined into one regex so most lines are ruled out with a
+    single search
+    """
+
+    def __init__(self, parsers: list[IssueParser]):
+        self.parsers = parsers
+        self._any_quick_check = _compile_quick_checks(parsers)
+        self._quick_checks = [(x, _compile_quick_checks([x])) for x in parsers]
+
+    def parse_line(self, line: str) -> dict:
+        if self._any_quick_check.search(line) is None:
+            return None
+
+        return _parse_line(line, self._quick_checks)
+
+
+def _parse_line(line: str, parsers: list[tuple[IssueParser, re.Pattern]]) -> dict:
+    """
+    Returns the issue on the line, or None if there isn't one
+    """
+    for parser, quick_check in parsers:
+        if quick_check.search(line) is None:
+            continue
+
+        match = parser.pattern.search(line)
+        if match is None:
+            continue
+
+        groups = match.groupdict()
+        path = groups.get('path') or parser.default_path or 'unknown'
+        line_number = int(groups['line']) if groups.get('line') else 1
+        column = int(groups['column']) if groups.get('column') else None
+        code = groups.get('code') or parser.default_code or parser.name
+
+        return _make_issue(path, line_number, code, groups['description'].rstrip('\r\n'), column)
+
+    return None
+
+
+def parse_lines(lines: Iterable[str], parsers: list[str] = None) -> Iterator[dict]:
+    """
+    Yields each issue as it's found in the lines, without holding them all in memory
+    :param lines:   Lines of output, such as an open log file
+    :param parsers: Names of the parsers to use, defaults to all of them
+    """
+    parser_set = _ParserSet(get_parsers(parsers))
+    for line in lines:
+        issue = parser_set.parse_line(line)
+        if issue is not None:
+            yield issue
+
+
+def parse_file(filepath: str, parsers: list[str] = None) -> Iterator[dict]:
+    """
+    Yields each issue found in a log file. Compressed process logs are read as they are.
+    """
+    return parse_lines(read_process_log(filepath), parsers)
+
+
+def _parse_file_worker(filepath: str, parsers: list[IssueParser], path_prefixes: dict[str, str]) -> list[dict]:
+    # Can run in a worker process, so it's given the parsers and prefixes rather than using its own module state
+    global _path_prefixes
+    if _path_prefixes != path_prefixes:
+        _path_prefixes = path_prefixes
+        _normalize_path.cache_clear()
+
+    parser_set = _ParserSet(parsers)
+    issues = []
+    for line in read_process_log(filepath):
+        issue = parser_set.parse_line(line)
+        if issue is not None:
+            issues.append(issue)
+    return issues
+
+
+def parse_files(filepaths: list[str], parsers: list[str] = None, max_workers: int = None,
+                use_processes: bool = None) -> Iterator[dict]:
+    """
+    Parses many log files at once, yielding the issues of each file as soon as it's done.
+    :param filepaths:       Log files to parse
+    :param parsers:         Names of the parsers to use, defaults to all of them
+    :param max_workers:     Number of workers, defaults to the number of CPUs
+    :param use_processes:   Parse in processes rather than threads, defaults to processes_are_forked()
+    """
+    parser_list = get_parsers(parsers)
+    if use_processes is None:
+        use_processes = processes_are_forked()
+
+    if len(filepaths) <= 1 or max_workers == 1:
+        for filepath in filepaths:
+            yield from _parse_file_worker(filepath, parser_list, _path_prefixes)
+        return
+
+    executor_type = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor_type(max_workers=max_workers) as executor:
+        futures = [executor.submit(_parse_file_worker, x, parser_list, _path_prefixes) for x in filepaths]
+        for future in as_completed(futures):
+            yield from future.result()
+
+
+class IssueWatcher(OutputWatcher):
+    """
+    Parses issues out of a process's output while it's running, pass it to run_process in watchers.
+    Every issue is kept in issues, and passed to callback(issue) as soon as it's found.
+
+    watcher = ci.IssueWatcher()
+    ci.run_process(build_cmd, watchers=[watcher])
+    report.add_issues(watcher.issues)
+    """
+
+    def __init__(self, callback: Callable[[dict], None] = None, stream: str = None, parsers: list[str] = None):
+        super().__init__(None, stream=stream)
+        self.issue_callback = callback
+        self.issues: list[dict] = []
+        self._parser_set = _ParserSet(get_parsers(parsers))
+
+    def feed(self, stream_name: str, line: str) -> bool:
+        if self.stream is not None and self.stream != stream_name:
+            return False
+
+        issue = self._parser_set.parse_line(line)
+        if issue is None:
+            return False
+
+        self.match_count += 1
+        self.issues.append(issue)
+        if self.issue_callback is not None:
+            self.issue_callback(issue)
+
+        return True
+
+
+def _get_issue_key(issue: dict) -> str:
+    """
+    Fingerprint of a Code Climate issue including its line, whichever fingerprint it was saved with
+    """
+    return _get_fingerprint(issue['check_name'], issue['description'], issue['location']['path'],
+                            issue['location']['lines']['begin'])
+
+
+def _with_stable_fingerprints(issues: list[dict]) -> list[dict]:
     """
-    code_climate_report = []
-    for error in errors:
-        code_climate_issue = {
-            "description": error['description'],
-            "check_name": error['code'],
-            "fingerprint": str(error['fingerprint']),
-            "severity": error['severity'],
-            "location": {
-                "path": error['path'],
-                "lines": {
-                    "begin": error['line']
-                }
+    Returns copies of the Code Climate issues with fingerprints that leave out the line number. Identical issues in
+    the same file are numbered in line order, so a new copy of an existing warning still counts as a new issue.
+    The first keeps the plain stable fingerprint.
+    """
+    groups: dict[tuple, list[int]] = {}
+    for i, issue in enumerate(issues):
+        groups.setdefault((issue['check_name'], issue['description'], issue['location']['path']), []).append(i)
+
+    fingerprints = {}
+    for (code, description, path), indices in groups.items():
+        stable_fingerprint = _get_stable_fingerprint(code, description, path)
+        indices.sort(key=lambda x: issues[x]['location']['lines']['begin'] or 0)
+        for occurrence, i in enumerate(indices):
+            if occurrence == 0:
+                fingerprints[i] = stable_fingerprint
+            else:
+                fingerprints[i] = hashlib.md5(f'{stable_fingerprint}:{occurrence}'.encode()).hexdigest()
+
+    return [dict(x, fingerprint=fingerprints[i]) for i, x in enumerate(issues)]
+
+
+def _extract_errors(compiler_output: str) -> list:
+    return list(parse_lines(compiler_output.splitlines()))
+
+
+def _to_code_climate_issue(error: dict) -> dict:
+    return {
+        "description": error['description'],
+        "check_name": error['code'],
+        "fingerprint": str(error['fingerprint']),
+        "severity": error['severity'],
+        "location": {
+            "path": error['path'],
+            "lines": {
+                "begin": error['line']
             }
         }
-        code_climate_report.append(code_climate_issue)
+    }
 
-    return code_climate_report
+
+def _generate_code_climate_report(errors):
+    """
+    Converts the errors list into code climate format
+    """
+    return [_to_code_climate_issue(x) for x in errors]
 
 
-def generate_report(compiler_output: str) -> list:
+def generate_report(compiler_output: Union[str, Iterable[str]]) -> list:
     """
     Takes the compiler output and returns a list of errors with the code climate spec
-    :param compiler_output: String containing compiler output.
+    :param compiler_output: String containing compiler output, or an iterable of lines such as an open log file.
     :return:                List of errors
     """
-    errors = _extract_errors(compiler_output)
-    code_climate_report = _generate_code_climate_report(errors)
+    if isinstance(compiler_output, str):
+        compiler_output = compiler_output.splitlines()
+
+    return _generate_code_climate_report(parse_lines(compiler_output))
+
+
+def _flatten(items: list) -> Iterator[dict]:
+    # Older versions appended each report as a nested list
+    for item in items:
+        if isinstance(item, list):
+            yield from _flatten(item)
+        else:
+            yield item
+
+
+class CodeQualityReport:
+    """
+    A Code Climate report that issues are merged into, keyed by fingerprint so the same issue is only reported once
+    no matter how many times it's added, e.g. a header warning from every module and config that includes it.
+
+    report = ci.CodeQualityReport('gl-code-quality-report.json')
+    for log in build_logs:
+        report.add_issues(ci.parse_file(log))
+    report.save()
+    """
+
+    def __init__(self, filepath: str, overwrite_existing: bool = False, stable_fingerprints: bool = False):
+        """
+        :param filepath:            File path the report is saved to
+        :param overwrite_existing:  If False, issues already in the file are kept
+        :param stable_fingerprints: Leave the line number out of fingerprints, so issues keep the same fingerprint
+                                    when code above them changes. Use this for reports compared with diff_report.
+                                    Issues are still kept apart by line, identical ones in a file are numbered.
+        """
+        self.filepath = filepath
+        self.stable_fingerprints = stable_fingerprints
+
+        # Keyed by the fingerprint with the line number, stable fingerprints are given out when iterating
+        self._issues: dict[str, dict] = {}
+
+        if not overwrite_existing and os.path.exists(filepath):
+            self._load(filepath)
+
+    def _load(self, filepath: str):
+        with open(filepath, 'r') as file:
+            existing_content = json.load(file)
+
+        for item in _flatten(existing_content):
+            self._issues.setdefault(_get_issue_key(item), item)
+
+    def __len__(self) -> int:
+        return len(self._issues)
+
+    def __iter__(self) -> Iterator[dict]:
+        if self.stable_fingerprints:
+            return iter(_with_stable_fingerprints(list(self._issues.values())))
+        return iter(self._issues.values())
+
+    def add_issues(self, issues: Iterable[dict]) -> int:
+        """
+        Adds issues from parse_lines, parse_file or an IssueWatcher. Returns how many of them were new.
+        """
+        added = 0
+        for issue in issues:
+            if issue['fingerprint'] not in self._issues:
+                self._issues[issue['fingerprint']] = _to_code_climate_issue(issue)
+                added += 1
+
+        return added
+
+    def add_files(self, filepaths: list[str], parsers: list[str] = None, max_workers: int = None,
+                  use_processes: bool = None) -> int:
+        """
+        Parses the log files in parallel, see parse_files, and adds their issues. Returns how many of them were new.
+        """
+        return self.add_issues(parse_files(filepaths, parsers, max_workers, use_processes))
+
+    def add_output(self, compiler_output: Union[str, Iterable[str]]) -> int:
+        """
+        Parses the compiler output and adds its issues. Returns how many of them were new.
+        """
+        if isinstance(compiler_output, str):
+            compiler_output = compiler_output.splitlines()
+
+        return self.add_issues(parse_lines(compiler_output))
 
-    return code_climate_report
+    def save(self):
+        """
+        Writes the report one issue at a time, rather than building the whole JSON document in memory
+        """
+        _write_code_climate_json(self, self.filepath)
 
 
-def write_report(compiler_output: str, filepath: str, overwrite_existing: bool = False):
+def _write_code_climate_json(issues: Iterable[dict], filepath: str):
+    Path(os.path.dirname(os.path.abspath(filepath))).mkdir(parents=True, exist_ok=True)
+
+    # Swapped in once it's complete, so a killed job never leaves a half written report
+    temp_path = f'{filepath}.tmp'
+    with open(temp_path, 'w') as file:
+        file.write('[')
+        for i, issue in enumerate(issues):
+            file.write(',\n  ' if i else '\n  ')
+            file.write(json.dumps(issue))
+        file.write('\n]\n')
+
+    os.replace(temp_path, filepath)
+
+
+# Reports written to by write_report, so calling it for every module doesn't reload the file each time
+_reports: dict[str, CodeQualityReport] = {}
+
+
+def write_report(compiler_output: Union[str, Iterable[str]], filepath: str, overwrite_existing: bool = False):
     """
-    Writes the code quality report to a file
-    :param compiler_output:     String containing compiler output.
+    Writes the code quality report to a file. Issues that are already in the report are not added again.
+    :param compiler_output:     String containing compiler output, or an iterable of lines.
     :param filepath:            File path to write the report to
     :param overwrite_existing:  Whether or not to overwrite the file if it exists.
     """
 
     _logger.info(f'Writing code quality report to {filepath}')
 
-    report = generate_report(compiler_output)
+    key = os.path.abspath(filepath)
+    report = _reports.get(key)
+    if report is None or overwrite_existing or not os.path.exists(filepath):
+        report = CodeQualityReport(filepath, overwrite_existing)
+        _reports[key] = report
 
-    # If we want to overwrite existing, load the previous content into an array
-    existing_content = []
-    if not overwrite_existing and os.path.exists(filepath):
-        with open(filepath, 'r') as file:
-            existing_content = json.load(file)
+    added = report.add_output(compiler_output)
+    _logger.info(f'Added {added} new issues, {len(report)} in total')
+    _logger.debug(f'Path cache hit rate: {get_path_cache_hit_rate():.1%}')
+
+    report.save()
+
+
+def write_baseline(report: Union[CodeQualityReport, Iterable[dict]], filepath: str):
+    """
+    Writes a baseline for diff_report, normally from the reference branch's report.
+    The baseline has one Code Climate issue per line sorted by fingerprint, so it diffs well and can be read
+    without loading a whole JSON document.
+    """
+    issues = sorted(report, key=lambda x: x['fingerprint'])
+
+    Path(os.path.dirname(os.path.abspath(filepath))).mkdir(parents=True, exist_ok=True)
+    temp_path = f'{filepath}.tmp'
+    with open(temp_path, 'w') as file:
+        for issue in issues:
+            file.write(json.dumps(issue) + '\n')
+
+    os.replace(temp_path, filepath)
+    _logger.info(f'Wrote code quality baseline of {len(issues)} issues to {filepath}')
+
+
+def load_baseline(filepath: str) -> dict[str, dict]:
+    """
+    Returns the issues in a baseline keyed by fingerprint
+    """
+    baseline = {}
+    with open(filepath, 'r') as file:
+        for line in file:
+            if line.strip():
+                issue = json.loads(line)
+                baseline[issue['fingerprint']] = issue
+
+    return baseline
+
+
+@dataclass
+class ReportDiff:
+    """
+    Issues that are new since the baseline, and issues in the baseline that have gone
+    """
+    added: list[dict]
+    resolved: list[dict]
+
+    def write_added(self, filepath: str):
+        """
+        Writes only the new issues as a Code Climate report, e.g. for the merge request widget
+        """
+        _write_code_climate_json(self.added, filepath)
+
+
+def diff_report(report: Union[CodeQualityReport, Iterable[dict], str],
+                baseline: Union[dict[str, dict], str]) -> ReportDiff:
+    """
+    Compares a report with a baseline by fingerprint. Both need to use the same fingerprint mode, so use
+    stable_fingerprints=True for both to not count issues that have only moved lines as added and resolved.
+    :param report:      CodeQualityReport, Code Climate issues, or the path to a report file
+    :param baseline:    Baseline from load_baseline, or the path to a baseline file
+    :return:            The added and resolved issues
+    """
+    if isinstance(report, str):
+        report = CodeQualityReport(report)
+    if isinstance(baseline, str):
+        baseline = load_baseline(baseline)
+
+    added = []
+    seen = set()
+    for issue in report:
+        seen.add(issue['fingerprint'])
+        if issue['fingerprint'] not in baseline:
+            added.append(issue)
 
-    existing_content.append(report)
+    resolved = [x for fingerprint, x in baseline.items() if fingerprint not in seen]
 
-    with open(filepath, 'w') as file:
-        json.dump(existing_content, file, indent=2)
+    _logger.info(f'{len(added)} new code quality issues, {len(resolved)} resolved since the baseline')
+    return ReportDiff(added, resolved)
@@ -0,0 +1,250 @@
+"""
+Runs batches of CI steps in parallel.
+
+Each job either runs a command through run_process, or calls a function which wraps something like
+UAT.build_cook_run. Jobs are started as long as there's a free slot and enough of each resource left, so a cook
+that needs 16 GB of RAM will wait until another one has finished on a 32 GB agent.
+"""
+
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from typing import Any, Callable, Union
+
+from .logger import *
+from .process import *
+
+_logger = register_logger('jobs')
+
+# Only one job can print its section at a time
+_section_lock = threading.Lock()
+
+
+@dataclass
+class Job:
+    """
+    A single job for run_jobs.
+    target is either a command list, which is passed to run_process, or a callable taking no arguments.
+    resources is how much of each of run_jobs' resources this job uses, e.g. {'ram_gb': 16}
+    """
+    name: str
+    target: Union[list, Callable[[], Any]]
+    resources: dict[str, float] = field(default_factory=dict)
+    section_header: str = None
+    allow_fail: bool = False
+
+
+@dataclass
+class JobResult:
+    """
+    Result of a single job.
+    result is the (exit code, stdout, stderr) tuple for commands, or the return value for callables.
+    """
+    name: str
+    success: bool
+    result: Any = None
+    exception: BaseException = None
+    duration: float = 0.0
+    log_path: str = None
+
+
+class _JobLogStream:
+    """
+    Text stream which writes a job's console output and log messages into its process log
+    """
+
+    def __init__(self, log: ProcessLog):
+        self._log = log
+        self._lock = threading.Lock()
+
+    def write(self, text: str) -> int:
+        with self._lock:
+            self._log.write('stdout', text)
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+class _TeeStream:
+    """
+    Writes to the console as well as the job's log, for the job whose output is shown as it runs
+    """
+
+    def __init__(self, *streams):
+        self._streams = streams
+
+    def write(self, text: str) -> int:
+        for stream in self._streams:
+            stream.write(text)
+        return len(text)
+
+    def flush(self):
+        for stream in self._streams:
+            stream.flush()
+
+
+def _safe_name(name: str) -> str:
+    """
+    Makes the job name safe to use for file and section names
+    """
+    return ''.join(x if x.isalnum() else '_' for x in name)
+
+
+def _run_job(job: Job, log: ProcessLog, live: bool) -> JobResult:
+    """
+    Runs the job on the current worker thread, with all of its process output and log messages going to its own log.
+    A live job's output goes to the console as it happens too.
+    """
+    start_time = time.monotonic()
+    log_path = log.paths['stdout']
+
+    # Timed here on the worker thread, as the section is only printed once the job has finished
+    begin_span(_safe_name(job.name), job.section_header or job.name)
+
+    log_stream = _JobLogStream(log)
+    console = _TeeStream(sys.stdout, log_stream) if live else log_stream
+
+    try:
+        with redirect_process_console(console), redirect_logging(log_stream, echo=live):
+            try:
+                if callable(job.target):
+                    result = job.target()
+                else:
+                    result = run_process(job.target, allow_fail=job.allow_fail)
+
+                return JobResult(job.name, True, result=result, duration=time.monotonic() - start_time,
+                                 log_path=log_path)
+            except Exception as e:
+                console.write(f'\nJob failed with exception: {e!r}\n')
+                return JobResult(job.name, False, exception=e, duration=time.monotonic() - start_time,
+                                 log_path=log_path)
+            finally:
+                end_span(_safe_name(job.name))
+    finally:
+        log.close()
+
+
+def _log_job_result(job: Job, result: JobResult):
+    if result.success:
+        _logger.info(f'Job {job.name} finished in {result.duration:.1f}s')
+    else:
+        _logger.error(f'Job {job.name} failed after {result.duration:.1f}s: {result.exception!r}')
+
+
+def _print_job_section(job: Job, result: JobResult):
+    """
+    Prints the output of a finished job inside its own collapsible section
+    """
+    section_name = _safe_name(job.name)
+    header = job.section_header or job.name
+
+    with _section_lock:
+        gl_open_block(section_name, f'{header} ({result.duration:.1f}s)', time_section=False)
+        # Lines are kept as they were written, GitLab relies on the carriage returns in section markers
+        for line in read_process_log(result.log_path, newline=''):
+            print(line, end='')
+        gl_close_block(section_name, time_section=False)
+
+    _log_job_result(job, result)
+
+
+def run_jobs(jobs: list[Job], max_concurrency: int = None, resources: dict[str, float] = None,
+             allow_fail: bool = False) -> list[JobResult]:
+    """
+    Runs the given jobs in parallel, and prints the output of each one inside its own GitLab section once it has
+    finished. A job that starts while no others are running has its output shown as it runs instead, so a single
+    long job such as a cook isn't silent until it ends. Each job's output is also kept in the process log store.
+
+    :param jobs:            Jobs to run. They are started in order, but a later job can start first if an earlier
+                            one is waiting on resources.
+    :param max_concurrency: Maximum number of jobs running at once. Defaults to the number of CPUs.
+    :param resources:       Total amount of each resource available, e.g. {'ram_gb': 64}. Resources a job uses that
+                            aren't listed here are not limited.
+    :param allow_fail:      If False, an exception is raised once all jobs have finished if any of them failed.
+    :return:                Results in the same order as jobs
+    """
+
+    if max_concurrency is None:
+        max_concurrency = os.cpu_count() or 1
+
+    available = dict(resources or {})
+    for job in jobs:
+        for name, amount in job.resources.items():
+            if name in available and amount > resources[name]:
+                raise Exception(f'Job {job.name} needs {amount} {name}, but only {resources[name]} is available!')
+
+    def fits(job: Job) -> bool:
+        return all(available[name] >= amount for name, amount in job.resources.items() if name in available)
+
+    def update_resources(job: Job, sign: int):
+        for name, amount in job.resources.items():
+            if name in available:
+                available[name] += sign * amount
+
+    log_store = get_process_log_store()
+
+    _logger.info(f'Running {len(jobs)} jobs with up to {max_concurrency} at once')
+
+    results: dict[int, JobResult] = {}
+    pending = list(enumerate(jobs))
+    running = {}
+
+    # Jobs that finished while the live job was printing, their sections are printed once it's done
+    live_future = None
+    finished_during_live: list[tuple[Job, JobResult]] = []
+
+    with ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='job') as executor:
+        while pending or running:
+            # Start everything that currently fits
+            for index, job in list(pending):
+                if len(running) >= max_concurrency:
+                    break
+                if not fits(job):
+                    continue
+
+                pending.remove((index, job))
+                update_resources(job, -1)
+
+                log = log_store.create_log(f'job_{index}_{_safe_name(job.name)}')
+                live = not running and not finished_during_live
+                if live:
+                    # Nothing else is printing, so open the section now and show the output as it comes
+                    gl_open_block(_safe_name(job.name), job.section_header or job.name, time_section=False)
+
+                _logger.debug(f'Starting job {job.name}')
+                future = executor.submit(_run_job, job, log, live)
+                running[future] = (index, job)
+                if live:
+                    live_future = future
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, job = running.pop(future)
+                update_resources(job, 1)
+                results[index] = future.result()
+
+                if future is live_future:
+                    gl_close_block(_safe_name(job.name), time_section=False)
+                    _log_job_result(job, results[index])
+                    live_future = None
+                elif live_future is not None:
+                    finished_during_live.append((job, results[index]))
+                else:
+                    _print_job_section(job, results[index])
+
+            if live_future is None:
+                for job, result in finished_during_live:
+                    _print_job_section(job, result)
+                finished_during_live.clear()
+
+    ordered_results = [results[i] for i in range(len(jobs))]
+
+    failed = [x.name for x in ordered_results if not x.success]
+    if failed and not allow_fail:
+        raise Exception(f'{len(failed)} job(s) failed: {", ".join(failed)}')
+
+    return ordered_results
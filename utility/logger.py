@@ -1,10 +1,18 @@
 import logging
+import logging.handlers
 import sys
+import re
 import time
 import os
+import queue
+import atexit
+import threading
+import contextlib
+import contextvars
 from enum import Enum
 
 from .variables import *
+from .profiler import *
 
 
 class AnsiColor(Enum):
@@ -32,9 +40,23 @@ _channel_name_length = 8
 _registered_loggers_names: list[str] = []
 _registered_loggers: list[logging.Logger] = []
 
+# Flush the console at least this often while records keep coming in
+_flush_interval = 0.2
+_flush_record_count = 1000
+
+# Rate limiting and collapsing for each channel, see set_log_rate_limit and set_log_collapse
+_channel_limiters: dict[str, '_ChannelLimiter'] = {}
+_channel_limiters_lock = threading.Lock()
+
+# (stream, echo) that records and sections are written to instead of the console, see redirect_logging.
+# A context var so it only follows the thread or task that set it.
+_log_redirect = contextvars.ContextVar('ciscripts_log_redirect', default=None)
+
 
 class ColoredFormatter(logging.Formatter):
-    format_str = f'[%(levelname)-{_level_name_length}s] [%(name)-{_channel_name_length}s] %(message)s'
+    # The precision truncates the level and channel names, so we don't have to change the record to do it
+    format_str = (f'[%(levelname)-{_level_name_length}.{_level_name_length}s] '
+                  f'[%(name)-{_channel_name_length}.{_channel_name_length}s] %(message)s')
 
     colors = {
         logging.INFO: AnsiColor.FG_CYAN,
@@ -45,20 +67,183 @@ class ColoredFormatter(logging.Formatter):
         logging.FATAL: AnsiColor.FG_RED
     }
 
+    def __init__(self):
+        super().__init__(self.format_str)
+
+        # Build the formatter for each level once, rather than for every record
+        self._level_formatters = {level: logging.Formatter(self._clr_fmt(self.format_str, color))
+                                  for level, color in self.colors.items()}
+        self._default_formatter = logging.Formatter(self._clr_fmt(self.format_str, AnsiColor.FG_DEFAULT))
+
     @staticmethod
     def _clr_fmt(msg, color: AnsiColor) -> str:
         return f'\033[0;{str(color.value)}m{msg}\033[0m'
 
     def format(self, record):
-        if len(record.name) > _channel_name_length:
-            record.name = record.name[:_channel_name_length]
+        return self._level_formatters.get(record.levelno, self._default_formatter).format(record)
+
+
+class _BatchedStreamHandler(logging.StreamHandler):
+    """
+    Stream handler that leaves flushing to _BatchingQueueListener, rather than flushing after every record
+    """
+
+    def emit(self, record):
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+
+class _BatchingQueueListener(logging.handlers.QueueListener):
+    """
+    Writes every record on a single background thread, flushing once the queue is empty or every _flush_interval
+    seconds while it's busy.
+    """
+
+    def __init__(self, log_queue: queue.Queue, *handlers):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self._last_flush = time.monotonic()
+        self._unflushed = 0
+
+    def _flush(self):
+        for handler in self.handlers:
+            handler.flush()
+        self._last_flush = time.monotonic()
+        self._unflushed = 0
 
-        if len(record.levelname) > _level_name_length:
-            record.levelname = record.levelname[:_level_name_length]
+    def dequeue(self, block):
+        if self._unflushed >= _flush_record_count or time.monotonic() - self._last_flush >= _flush_interval:
+            self._flush()
 
-        clr_str = self._clr_fmt(self.format_str, color=self.colors.get(record.levelno))
-        formatter = logging.Formatter(clr_str)
-        return formatter.format(record)
+        try:
+            record = self.queue.get_nowait()
+        except queue.Empty:
+            # Caught up, so write out what we have before waiting on more
+            self._flush()
+            record = self.queue.get(block)
+
+        self._unflushed += 1
+        return record
+
+
+class _LoggingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues records for the listener thread. Once logging has been shut down at exit, records are written straight
+    away so nothing logged by later exit handlers is lost.
+    """
+
+    def emit(self, record):
+        redirect = _log_redirect.get()
+        if redirect is not None:
+            stream, echo = redirect
+            try:
+                stream.write(_console_handler.format(record) + '\n')
+            except Exception:
+                self.handleError(record)
+            if not echo:
+                return
+
+        if _logging_stopped:
+            try:
+                _console_handler.handle(self.prepare(record))
+                _console_handler.flush()
+            except Exception:
+                self.handleError(record)
+            return
+
+        super().emit(record)
+
+
+# All channels share one queue, and one thread which writes them to the console
+_log_queue = queue.Queue(-1)
+_console_handler = _BatchedStreamHandler()
+_console_handler.setFormatter(ColoredFormatter())
+_queue_listener = _BatchingQueueListener(_log_queue, _console_handler)
+_queue_listener_lock = threading.Lock()
+_logging_started = False
+_logging_stopped = False
+
+
+def _start_logging():
+    global _logging_started
+    with _queue_listener_lock:
+        if _logging_started or _logging_stopped:
+            return
+
+        _queue_listener.start()
+        _logging_started = True
+        atexit.register(stop_logging)
+
+
+def _wait_for_queued_records():
+    """
+    Blocks until the listener has written every queued record. Cheap when nothing is queued, so run_process calls it
+    before echoing each line to keep the output in the order it happened.
+    """
+    if _logging_started and not _logging_stopped and _log_queue.unfinished_tasks:
+        _log_queue.join()
+        _console_handler.flush()
+
+
+def flush_logging():
+    """
+    Blocks until every record logged so far has been written to the console. Call it before printing to stdout
+    directly, otherwise queued records can come out after the print.
+    """
+    _flush_suppressed_summaries()
+
+    if _logging_started and not _logging_stopped:
+        _log_queue.join()
+    _console_handler.flush()
+
+
+def stop_logging():
+    """
+    Writes out any remaining records and stops the logging thread. Called automatically at exit, including through
+    sys.exit. Anything logged afterwards is written straight to the console.
+    """
+    global _logging_stopped
+    with _queue_listener_lock:
+        if _logging_stopped:
+            return
+
+        _flush_suppressed_summaries()
+
+        _logging_stopped = True
+        if _logging_started:
+            _queue_listener.stop()
+        _console_handler.flush()
+
+
+@contextlib.contextmanager
+def redirect_logging(stream, echo: bool = False):
+    """
+    Writes every record logged within this context, and any GitLab sections opened in it, to the given stream instead
+    of the console. Only affects the current thread or asyncio task. Used by run_jobs to keep each job's log messages
+    in its own section, the same as redirect_process_console does for process output.
+    :param echo:    Also write them to the console as usual
+    """
+    token = _log_redirect.set((stream, echo))
+    try:
+        yield stream
+    finally:
+        _log_redirect.reset(token)
+
+
+def _print_console(text: str):
+    """
+    Prints a line to the console, or to wherever redirect_logging sent this thread's output
+    """
+    redirect = _log_redirect.get()
+    if redirect is not None:
+        redirect[0].write(text + '\n')
+        if not redirect[1]:
+            return
+
+    print(text, flush=True)
 
 
 def register_logger(name: str) -> logging.Logger:
@@ -80,11 +265,12 @@ def register_logger(name: str) -> logging.Logger:
     # Set the default level to be INFO
     logger.setLevel(logging.INFO)
 
-    # Add handler
-    sh = logging.StreamHandler()
-    sh.setLevel(logging.INFO)
-    sh.setFormatter(ColoredFormatter())
-    logger.addHandler(sh)
+    # Add handler. Records are formatted and written to the console on the logging thread.
+    qh = _LoggingQueueHandler(_log_queue)
+    qh.setLevel(logging.INFO)
+    logger.addHandler(qh)
+
+    _start_logging()
 
     # Keep a note that this logger was already registered.
     _registered_loggers_names.append(name)
@@ -107,15 +293,288 @@ def set_logging_level(level):
         logger.handlers[0].setLevel(level)
 
 
-def gl_open_block(section_name: str, section_header: str):
+class _ChannelLimiter(logging.Filter):
+    """
+    Drops records from a noisy channel before they are queued, and logs how many were dropped in their place.
+    Errors are never dropped.
+    """
+
+    # Numbers are the usual difference between otherwise identical messages, e.g. line numbers or file counts
+    _number_regex = re.compile(r'\d+')
+
+    def __init__(self, logger: logging.Logger, handler: logging.Handler):
+        super().__init__()
+        self._logger = logger
+        self._handler = handler
+        self._lock = threading.Lock()
+
+        self.max_per_second: float = None
+        self.burst: float = None
+        self._tokens = 0.0
+        self._last_refill = time.monotonic()
+        self._suppressed_rate = 0
+
+        self.max_repeats: int = None
+        self.window: float = 30.0
+        self._window_start = time.monotonic()
+        self._repeats: dict[tuple, int] = {}
+        self._suppressed_similar = 0
+
+    def _similar_key(self, record: logging.LogRecord) -> tuple:
+        if record.args:
+            return record.levelno, record.msg
+        return record.levelno, self._number_regex.sub('#', record.getMessage())
+
+    def _allow(self, record: logging.LogRecord, now: float) -> bool:
+        if self.max_repeats is not None:
+            key = self._similar_key(record)
+            count = self._repeats.get(key, 0) + 1
+            self._repeats[key] = count
+            if count > self.max_repeats:
+                self._suppressed_similar += 1
+                return False
+
+        if self.max_per_second is not None:
+            self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.max_per_second)
+            self._last_refill = now
+            if self._tokens < 1:
+                self._suppressed_rate += 1
+                return False
+            self._tokens -= 1
+
+        return True
+
+    def _take_summaries(self, similar: bool = True) -> list[logging.LogRecord]:
+        messages = []
+        if similar and self._suppressed_similar:
+            messages.append(f'(suppressed {self._suppressed_similar:,} similar messages)')
+            self._suppressed_similar = 0
+        if self._suppressed_rate:
+            messages.append(f'(suppressed {self._suppressed_rate:,} messages over the limit of '
+                            f'{self.max_per_second:g}/s)')
+            self._suppressed_rate = 0
+
+        records = []
+        for message in messages:
+            record = self._logger.makeRecord(self._logger.name, logging.INFO, __file__, 0, message, None, None)
+            record.ciscripts_summary = True
+            records.append(record)
+        return records
+
+    def _emit_summaries(self, records: list[logging.LogRecord]):
+        for record in records:
+            self._handler.emit(record)
+
+    def flush(self):
+        with self._lock:
+            records = self._take_summaries()
+        self._emit_summaries(records)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, 'ciscripts_summary', False):
+            return True
+
+        with self._lock:
+            now = time.monotonic()
+
+            # Once the window is over, say what was dropped and give every message a fresh set of repeats
+            records = []
+            if now - self._window_start >= self.window:
+                records = self._take_summaries()
+                self._repeats.clear()
+                self._window_start = now
+
+            allowed = record.levelno >= logging.ERROR or self._allow(record, now)
+
+            # Back under the rate limit, so say how many were dropped while we were over it
+            if allowed and self._suppressed_rate:
+                records += self._take_summaries(similar=False)
+
+        # Written before the current record, so the summary follows the messages it's about
+        self._emit_summaries(records)
+        return allowed
+
+
+def _get_channel_limiter(name: str) -> _ChannelLimiter:
+    if name not in _registered_loggers_names:
+        raise Exception(f'Tried to limit the {name} logger, however it has not been registered!')
+
+    with _channel_limiters_lock:
+        if name not in _channel_limiters:
+            logger = logging.getLogger(name)
+            limiter = _ChannelLimiter(logger, logger.handlers[0])
+            logger.handlers[0].addFilter(limiter)
+            _channel_limiters[name] = limiter
+
+        return _channel_limiters[name]
+
+
+def _flush_suppressed_summaries():
+    with _channel_limiters_lock:
+        limiters = list(_channel_limiters.values())
+
+    for limiter in limiters:
+        limiter.flush()
+
+
+def set_log_rate_limit(name: str, max_per_second: float, burst: int = None):
+    """
+    Limits how many records a channel writes per second, anything over is counted and reported as a single line.
+    Errors are never dropped.
+    :param name:            Registered logger name
+    :param max_per_second:  Average number of records allowed per second, None removes the limit
+    :param burst:           Number of records allowed at once before the limit kicks in, defaults to max_per_second
+    """
+    limiter = _get_channel_limiter(name)
+    with limiter._lock:
+        limiter.max_per_second = max_per_second
+        limiter.burst = max(1.0, burst if burst is not None else max_per_second or 0)
+        limiter._tokens = limiter.burst
+        limiter._last_refill = time.monotonic()
+
+
+def set_log_collapse(name: str, max_repeats: int = 3, window: float = 30.0):
+    """
+    Collapses repeated messages on a channel. Once a message has been logged max_repeats times in the window, any
+    more like it are dropped, and a line saying how many were suppressed is written at the end of the window or when
+    the current section is closed. Messages that only differ by numbers count as the same message.
+    Errors are never dropped.
+    :param name:        Registered logger name
+    :param max_repeats: Number of times each message is written per window, None turns collapsing off
+    :param window:      Length of the window in seconds
+    """
+    limiter = _get_channel_limiter(name)
+    with limiter._lock:
+        limiter.max_repeats = max_repeats
+        limiter.window = window
+        limiter._repeats.clear()
+
+
+def _format_bytes(size: float) -> str:
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size) < 1024:
+            return f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} TB'
+
+
+class LogCounter:
+    """
+    Logs running totals every interval seconds, rather than a line for every item. Counters named in byte_counters
+    are shown as sizes.
+
+    with ci.LogCounter(logger, 'Synced') as counter:
+        for file in files:
+            counter.add(files=1, bytes=file.size)
+
+    Synced: 12,431 files (2,486.2/s), 1.2 GB (245.3 MB/s)
+    """
+
+    def __init__(self, logger: logging.Logger, label: str, interval: float = 10.0,
+                 byte_counters: tuple[str] = ('bytes',)):
+        self._logger = logger
+        self.label = label
+        self.interval = interval
+        self.byte_counters = byte_counters
+
+        self.totals: dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._start_time = time.monotonic()
+        self._last_log_time = self._start_time
+        self._last_totals: dict[str, float] = {}
+
+    def _format(self, name: str, amount: float, rate: float) -> str:
+        if name in self.byte_counters:
+            return f'{_format_bytes(amount)} ({_format_bytes(rate)}/s)'
+        return f'{amount:,.0f} {name} ({rate:,.1f}/s)'
+
+    def _log(self, now: float, final: bool):
+        if final:
+            elapsed = max(now - self._start_time, 1e-6)
+            parts = [self._format(x, y, y / elapsed) for x, y in self.totals.items()]
+            message = f'{self.label}: {", ".join(parts)} in {now - self._start_time:.1f}s'
+        else:
+            # Rates are for the last interval, so slowdowns show up straight away
+            elapsed = max(now - self._last_log_time, 1e-6)
+            parts = [self._format(x, y, (y - self._last_totals.get(x, 0)) / elapsed) for x, y in self.totals.items()]
+            message = f'{self.label}: {", ".join(parts)}'
+
+        self._last_log_time = now
+        self._last_totals = dict(self.totals)
+        self._logger.info(message)
+
+    def add(self, **amounts: float):
+        with self._lock:
+            for name, amount in amounts.items():
+                self.totals[name] = self.totals.get(name, 0) + amount
+
+            now = time.monotonic()
+            if now - self._last_log_time >= self.interval:
+                self._log(now, False)
+
+    def close(self):
+        """
+        Logs the final totals, if anything was counted
+        """
+        with self._lock:
+            if self.totals:
+                self._log(time.monotonic(), True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+def gl_open_block(section_name: str, section_header: str, time_section: bool = True):
     """
     Defines the start of a collapsible section in GitLab CI job outputs
+    Unless time_section is False, the section is also timed, see profiler.py
     """
-    print(f'\033[0Ksection_start:{int(time.time())}:{section_name}\r\033[0K{section_header}', flush=True)
+    if time_section:
+        begin_span(section_name, section_header)
+
+    # Make sure anything logged before this ends up outside the section
+    flush_logging()
+    _print_console(f'\033[0Ksection_start:{int(time.time())}:{section_name}\r\033[0K{section_header}')
 
 
-def gl_close_block(section_name: str):
+def gl_close_block(section_name: str, time_section: bool = True):
     """
     Defines the end of a collapsable section in GitLab CI job outputs
     """
-    print(f'\033[0Ksection_end:{int(time.time())}:{section_name}\r\033[0K', flush=True)
+    flush_logging()
+    _print_console(f'\033[0Ksection_end:{int(time.time())}:{section_name}\r\033[0K')
+
+    if time_section:
+        end_span(section_name)
+
+
+class _Section(contextlib.ContextDecorator):
+    def __init__(self, section_name: str, section_header: str = None):
+        self._section_name = section_name
+        self._section_header = section_header or section_name
+
+    def _recreate_cm(self):
+        # Each call of a decorated function gets its own section, so it works with recursion and threads
+        return _Section(self._section_name, self._section_header)
+
+    def __enter__(self):
+        gl_open_block(self._section_name, self._section_header)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        gl_close_block(self._section_name)
+        return False
+
+
+def section(section_name: str, section_header: str = None) -> _Section:
+    """
+    Wraps a block of code, or a function when used as a decorator, in a timed collapsible GitLab section.
+
+    with ci.section('p4_sync', 'Syncing client...'):
+        p4.sync_workspace(client)
+    """
+    return _Section(section_name, section_header)
@@ -1,11 +1,60 @@
 import os
+import io
+import re
+import queue
+import asyncio
+import locale
+import codecs
+import contextlib
+import contextvars
+import sys
+import json
+import signal
+import time
 import subprocess
-from datetime import datetime
+import threading
+import multiprocessing
+from collections import deque
+from dataclasses import dataclass, asdict
 from pathlib import Path
+from typing import Iterator
+
+from .process_logs import *
+from .process_logs import _check_compression
+from .profiler import *
+from .logger import _wait_for_queued_records
 
 _custom_log_dir: str = ""
+
+# Settings for the process log store, see set_process_log_compression and set_process_log_retention
+_log_compression = 'gzip'
+_log_max_total_bytes = 10 * 1024 * 1024 * 1024
+_log_max_age_days = 14
+_log_stores: dict[tuple, ProcessLogStore] = {}
+_log_stores_lock = threading.Lock()
 _ciscripts_root_dir = os.path.abspath(os.path.dirname(os.path.realpath(__file__)) + "/../")
 
+# How long to keep draining output after a process has been killed, its children may still hold the pipes open
+_kill_drain_timeout = 5.0
+
+# How many of the last lines of output are kept to report a timeout
+_timeout_tail_lines = 30
+
+# How much binary mode reads from a pipe at once
+_binary_read_size = 256 * 1024
+
+# How often to sample the memory and CPU time of a running process. Sampling starts at the first interval and doubles
+# up to the second, so short lived tools still get a few samples in.
+_resource_sample_first_interval = 0.02
+_resource_sample_interval = 0.5
+
+# Guards appending to the metrics file from several threads
+_metrics_lock = threading.Lock()
+_metrics_trimmed = False
+
+# Where child output is echoed to. None means sys.stdout. A context var so it follows both threads and asyncio tasks.
+_console_stream = contextvars.ContextVar('ciscripts_process_console', default=None)
+
 
 def get_process_log_dir():
     """
@@ -30,50 +79,984 @@ def set_process_log_dir(new_path: str):
     _custom_log_dir = new_path
 
 
+def set_process_log_compression(compression: str):
+    """
+    Sets how process logs are compressed. 'gzip' (default), 'zstd' (requires zstandard) or None for plain text.
+    Raises if the compression can't be used, e.g. zstd without zstandard installed.
+    """
+    _check_compression(compression)
+
+    global _log_compression
+    _log_compression = compression
+
+
+def set_process_log_retention(max_total_bytes: int = None, max_age_days: float = None):
+    """
+    Sets how much process log history to keep. Defaults to 10 GB and 14 days, None disables that limit.
+    The age limit also applies to process_metrics.jsonl.
+    """
+    global _log_max_total_bytes, _log_max_age_days
+    _log_max_total_bytes = max_total_bytes
+    _log_max_age_days = max_age_days
+
+
+def get_process_log_store() -> ProcessLogStore:
+    """
+    Returns the log store for the current process log dir and settings
+    """
+    key = (get_process_log_dir(), _log_compression, _log_max_total_bytes, _log_max_age_days)
+    with _log_stores_lock:
+        if key not in _log_stores:
+            _log_stores[key] = ProcessLogStore(*key)
+        return _log_stores[key]
+
+
+def processes_are_forked() -> bool:
+    """
+    Returns True if worker processes are started with fork, as they are on Linux. Used to pick process pools over
+    threads for work that holds the GIL. Where workers are spawned instead, e.g. on Windows, each one runs the calling
+    script again, so a process pool is only safe from scripts whose top level code is under
+    if __name__ == '__main__':
+    """
+    method = multiprocessing.get_start_method(allow_none=True) or multiprocessing.get_all_start_methods()[0]
+    return method == 'fork'
+
+
+class ProcessTimeoutError(Exception):
+    """
+    Raised by run_process when a process was killed for running too long or going quiet.
+    result holds the return code and the output captured before it was killed.
+    """
+
+    def __init__(self, message: str, result=None):
+        super().__init__(message)
+        self.result = result
+
+
+def _get_child_pids(pid: int) -> list[int]:
+    """
+    Returns the pids of every descendant of the given process
+    """
+    # Optional, but a lot cheaper than asking the OS ourselves
+    try:
+        import psutil
+        try:
+            return [x.pid for x in psutil.Process(pid).children(recursive=True)]
+        except psutil.Error:
+            return []
+    except ImportError:
+        pass
+
+    parents = {}
+    if os.path.isdir('/proc'):
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/stat', 'r') as f:
+                    # The process name can contain spaces and brackets, so split after the last bracket
+                    stat = f.read().rsplit(')', 1)[1].split()
+                parents.setdefault(int(stat[1]), []).append(int(entry))
+            except (OSError, IndexError, ValueError):
+                # Exited while we were looking
+                continue
+    else:
+        ps = subprocess.run(['ps', '-A', '-o', 'pid=', '-o', 'ppid='], capture_output=True, text=True)
+        for line in ps.stdout.splitlines():
+            child, parent = line.split()
+            parents.setdefault(int(parent), []).append(int(child))
+
+    children = []
+    to_check = [pid]
+    while to_check:
+        for child in parents.get(to_check.pop(), []):
+            children.append(child)
+            to_check.append(child)
+
+    return children
+
+
+def _kill_process_tree(proc):
+    """
+    Kills the process and everything it started. Tools like RunUAT.bat and UnrealEditor-Cmd start children that
+    would otherwise keep running, and keep our output pipes open.
+    """
+    if sys.platform == 'win32':
+        subprocess.run(['taskkill', '/F', '/T', '/PID', str(proc.pid)], capture_output=True)
+        # In case taskkill couldn't
+        proc.kill()
+        return
+
+    # Find the children before killing the parent, as they get re-parented once it has gone
+    children = _get_child_pids(proc.pid)
+    proc.kill()
+    for child in children:
+        try:
+            os.kill(child, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+
+def _get_timeout_reason(handler: '_ProcessOutputHandler', start_counter: float, timeout: float,
+                        inactivity_timeout: float) -> (str, float):
+    """
+    Checks the timeouts for a running process.
+    Returns the reason if one was hit, and how long until the next one can be hit, None if there are no timeouts.
+    """
+    now = time.perf_counter()
+    next_check = None
+
+    if timeout is not None:
+        remaining = start_counter + timeout - now
+        if remaining <= 0:
+            return f'Timed out after {timeout}s', None
+        next_check = remaining
+
+    if inactivity_timeout is not None:
+        remaining = handler.last_output_time + inactivity_timeout - now
+        if remaining <= 0:
+            return f'No output for {inactivity_timeout}s', None
+        next_check = remaining if next_check is None else min(next_check, remaining)
+
+    return None, next_check
+
+
+@contextlib.contextmanager
+def redirect_process_console(stream):
+    """
+    Echoes the console output of any process ran within this context to the given stream instead of stdout.
+    Only affects the current thread or asyncio task. Used by run_jobs to keep parallel output apart.
+    """
+    token = _console_stream.set(stream)
+    try:
+        yield stream
+    finally:
+        _console_stream.reset(token)
+
+
+def _pump_stream(stream, stream_name: str, output_queue: queue.Queue):
+    """
+    Reads lines from a pipe and forwards them to the output queue. Runs on its own thread so both stdout and stderr
+    can be drained at the same time, which stops the child from blocking on a full pipe buffer.
+    A None line is queued once the pipe has closed, errors such as failing to decode the output are queued for the
+    main thread to raise.
+    """
+    try:
+        for line in stream:
+            output_queue.put((stream_name, [line]))
+    except Exception as e:
+        output_queue.put((stream_name, e))
+    finally:
+        output_queue.put((stream_name, None))
+
+
+class _LineDecoder:
+    """
+    Incrementally decodes chunks of bytes into lines, translating newlines the same way universal_newlines does.
+    Characters split across chunks and lines without their line ending are held back until the next chunk.
+    """
+
+    def __init__(self, encoding: str, errors: str):
+        self._decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder(encoding)(errors=errors),
+                                                     translate=True)
+        self._pending = ''
+
+    def decode(self, data, final: bool = False) -> list[str]:
+        *lines, self._pending = (self._pending + self._decoder.decode(data, final=final)).split('\n')
+        lines = [x + '\n' for x in lines]
+
+        if final and self._pending:
+            lines.append(self._pending)
+            self._pending = ''
+
+        return lines
+
+
+def _pump_stream_binary(stream, stream_name: str, output_queue: queue.Queue, handler: '_ProcessOutputHandler',
+                        encoding: str, errors: str):
+    """
+    Binary mode version of _pump_stream. Reads large chunks into a reused buffer, writes the raw bytes straight to
+    the log and only then decodes them into lines for the main thread.
+    """
+    buffer = bytearray(_binary_read_size)
+    view = memoryview(buffer)
+    decoder = _LineDecoder(encoding, errors)
+
+    try:
+        while True:
+            size = stream.readinto(buffer)
+            if not size:
+                break
+
+            handler.handle_raw_output(stream_name, view[:size])
+
+            lines = decoder.decode(view[:size])
+            if lines:
+                output_queue.put((stream_name, lines))
+
+        lines = decoder.decode(b'', final=True)
+        if lines:
+            output_queue.put((stream_name, lines))
+    except Exception as e:
+        output_queue.put((stream_name, e))
+    finally:
+        output_queue.put((stream_name, None))
+
+
+class ProcessOutput(str):
+    """
+    Captured output of a single stream, returned by run_process.
+
+    This is a normal string so it can be searched and parsed like before. When the capture was bounded it only holds
+    the lines that matched one of the capture patterns followed by the tail of the output, in the order they were
+    written. The full output can be found in the process log file.
+    """
+
+    def __new__(cls, text: str = '', matches: list[str] = None, total_lines: int = 0, dropped_lines: int = 0,
+                log_path: str = None):
+        obj = super().__new__(cls, text)
+        obj.matches = matches if matches is not None else []
+        obj.total_lines = total_lines
+        obj.dropped_lines = dropped_lines
+        obj.log_path = log_path
+        return obj
+
+
+@dataclass
+class ProcessMetrics:
+    """
+    Resource usage of a single run_process call.
+    CPU times cover the whole process tree. peak_rss is the most memory the whole tree used at once and
+    peak_process_rss the most any single process in it used, both as seen while it was sampled, see _ResourceSampler.
+    They are None when they couldn't be measured, e.g. on Windows without psutil installed, or for a process that
+    exited before it could be sampled.
+    Output sizes are counted in characters, or in bytes when ran in binary mode.
+    """
+    exe: str
+    pid: int
+    start_time: float
+    wall_time: float = 0.0
+    return_code: int = None
+    user_time: float = None
+    sys_time: float = None
+    peak_rss: int = None
+    peak_process_rss: int = None
+    stdout_bytes: int = 0
+    stderr_bytes: int = 0
+    stop_reason: str = None
+
+
+class ProcessResult(tuple):
+    """
+    Returned by run_process. Unpacks to (return_code, stdout, stderr) like before, with the metrics attached.
+    """
+
+    def __new__(cls, return_code: int, stdout: str, stderr: str, metrics: ProcessMetrics = None):
+        obj = super().__new__(cls, (return_code, stdout, stderr))
+        obj.metrics = metrics
+        return obj
+
+    def __getnewargs__(self):
+        # So results can be pickled, e.g. to come back from a worker process, and deep copied
+        return self[0], self[1], self[2], self.metrics
+
+    @property
+    def return_code(self) -> int:
+        return self[0]
+
+    @property
+    def stdout(self) -> str:
+        return self[1]
+
+    @property
+    def stderr(self) -> str:
+        return self[2]
+
+
+def get_process_metrics_path() -> str:
+    """
+    Returns the JSON lines file every run_process call appends its metrics to
+    """
+    return f'{get_process_log_dir()}/process_metrics.jsonl'
+
+
+def _trim_process_metrics(path: str):
+    """
+    Drops metrics older than the process log retention, the same age limit the logs themselves are kept for
+    """
+    if _log_max_age_days is None or not os.path.exists(path):
+        return
+
+    cutoff = time.time() - _log_max_age_days * 24 * 60 * 60
+    kept = []
+    trimmed = False
+    with open(path, 'r') as f:
+        for line in f:
+            # Lines half written by a process that was killed are dropped too
+            try:
+                if json.loads(line)['start_time'] < cutoff:
+                    trimmed = True
+                    continue
+            except (ValueError, KeyError, TypeError):
+                trimmed = True
+                continue
+            kept.append(line)
+
+    if not trimmed:
+        return
+
+    # Swap the file in one go so readers never see a partial file
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w') as f:
+        f.writelines(kept)
+    os.replace(temp_path, path)
+
+
+def _write_process_metrics(metrics: ProcessMetrics):
+    global _metrics_trimmed
+
+    log_dir = get_process_log_dir()
+    Path(log_dir).mkdir(parents=True, exist_ok=True)
+
+    path = get_process_metrics_path()
+    line = json.dumps(asdict(metrics))
+    with _metrics_lock:
+        # Once per run is enough, it only grows by a line per process
+        if not _metrics_trimmed:
+            _metrics_trimmed = True
+            _trim_process_metrics(path)
+
+        with open(path, 'a') as f:
+            f.write(line + '\n')
+
+
+def _get_children_rusage():
+    """
+    Returns the usage of all reaped child processes, or None where the resource module isn't available
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    return resource.getrusage(resource.RUSAGE_CHILDREN)
+
+
+def _read_proc_memory(pid: int) -> (int, int):
+    """
+    Returns the memory the process is using now and the most it has used since it started, from VmRSS and VmHWM in
+    /proc, or None if they can't be read, e.g. when it has exited
+    """
+    rss = None
+    peak = None
+    try:
+        with open(f'/proc/{pid}/status', 'r') as f:
+            for line in f:
+                # Reported in kB
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith('VmHWM:'):
+                    peak = int(line.split()[1]) * 1024
+    except (OSError, IndexError, ValueError):
+        return None
+    if rss is None or peak is None:
+        return None
+    return rss, peak
+
+
+class _ResourceSampler:
+    """
+    Polls CPU time and memory of a process tree while it runs.
+    The tree's memory is the total RSS of its processes at each sample, e.g. every compiler UBT has running at once.
+    Each process's own peak is its high-water mark from /proc on Linux, elsewhere its RSS each time it's sampled with
+    psutil. CPU times need psutil.
+    Does nothing if psutil isn't installed and there's no /proc.
+    """
+
+    def __init__(self, pid: int):
+        self.available = False
+        self.user_time = None
+        self.sys_time = None
+        self.peak_rss = None
+        self.peak_process_rss = None
+
+        self._pid = pid
+        self._use_proc = sys.platform.startswith('linux') and os.path.isdir('/proc')
+        self._cpu_times = {}
+        self._psutil = None
+        self._process = None
+
+        # Optional, most of our CI agents have it but we don't want to require it
+        try:
+            import psutil
+            self._process = psutil.Process(pid)
+            self._psutil = psutil
+        except ImportError:
+            pass
+        except psutil.Error:
+            return
+
+        self.available = self._psutil is not None or self._use_proc
+
+    def sample(self):
+        if not self.available:
+            return
+
+        if self._psutil is not None:
+            try:
+                tree = [self._process] + self._process.children(recursive=True)
+            except self._psutil.Error:
+                return
+            pids = [x.pid for x in tree]
+        else:
+            tree = []
+            pids = [self._pid] + _get_child_pids(self._pid)
+
+        # (rss, peak) of each process that could be read
+        memory = []
+        if self._use_proc:
+            memory = [x for x in map(_read_proc_memory, pids) if x is not None]
+
+        for proc in tree:
+            try:
+                with proc.oneshot():
+                    if not self._use_proc:
+                        rss = proc.memory_info().rss
+                        memory.append((rss, rss))
+                    cpu = proc.cpu_times()
+                    self._cpu_times[proc.pid] = (cpu.user, cpu.system)
+            except self._psutil.Error:
+                # Exited between listing the tree and sampling it
+                pass
+
+        if memory:
+            process_peak = max(x[1] for x in memory)
+            self.peak_process_rss = max(self.peak_process_rss or 0, process_peak)
+            # The tree used at least as much as its largest process did, even if that peaked between samples
+            self.peak_rss = max(self.peak_rss or 0, sum(x[0] for x in memory), self.peak_process_rss)
+        if self._cpu_times:
+            # Processes that exited keep their last sample
+            self.user_time = sum(x[0] for x in self._cpu_times.values())
+            self.sys_time = sum(x[1] for x in self._cpu_times.values())
+
+    @staticmethod
+    def _intervals() -> Iterator[float]:
+        interval = _resource_sample_first_interval
+        while True:
+            yield interval
+            interval = min(interval * 2, _resource_sample_interval)
+
+    def run_until(self, stop_event: threading.Event):
+        # Sample straight away, a lot of the tools we run exit in well under a second
+        self.sample()
+        for interval in self._intervals():
+            if stop_event.wait(interval):
+                return
+            self.sample()
+
+    async def run_async(self):
+        self.sample()
+        for interval in self._intervals():
+            await asyncio.sleep(interval)
+            self.sample()
+
+
+class _OutputCapture:
+    """
+    Keeps the output of a single stream in memory.
+    Unbounded by default, otherwise it acts as a ring buffer over the last max_lines lines or max_bytes characters.
+    Lines matching any of the patterns are always kept.
+    """
+
+    def __init__(self, max_lines: int = None, max_bytes: int = None, patterns: list = None):
+        self._max_lines = max_lines
+        self._max_bytes = max_bytes
+        self._patterns = [re.compile(x) if isinstance(x, str) else x for x in patterns or []]
+
+        self._lines = deque()
+        self._line_count = 0
+        self._bytes = 0
+        self._matches = []
+
+    @property
+    def _is_bounded(self) -> bool:
+        return self._max_lines is not None or self._max_bytes is not None
+
+    def append(self, line: str):
+        index = self._line_count
+        self._line_count += 1
+
+        for pattern in self._patterns:
+            if pattern.search(line):
+                self._matches.append((index, line))
+                break
+
+        self._lines.append((index, line))
+        if not self._is_bounded:
+            return
+
+        self._bytes += len(line)
+        # Always keep the latest line, even if it's bigger than the byte limit on its own
+        while len(self._lines) > 1 and ((self._max_lines is not None and len(self._lines) > self._max_lines) or
+                                        (self._max_bytes is not None and self._bytes > self._max_bytes)):
+            _, dropped = self._lines.popleft()
+            self._bytes -= len(dropped)
+
+    def get_output(self, log_path: str = None) -> ProcessOutput:
+        tail_start = self._lines[0][0] if self._lines else self._line_count
+
+        # Matches that fell out of the ring buffer go in front of the tail
+        kept = [line for index, line in self._matches if index < tail_start]
+        kept.extend(line for _, line in self._lines)
+
+        return ProcessOutput(''.join(kept), matches=[line for _, line in self._matches],
+                             total_lines=self._line_count, dropped_lines=self._line_count - len(kept),
+                             log_path=log_path)
+
+
+class OutputWatcher:
+    """
+    Watches the output of a process as it streams in, calling callback(match, stream_name) for each matching line.
+    If fatal is True the process is killed on the first match, so a failing step can stop early.
+
+    The first and last matches are kept, so the result can be read after the process has finished without
+    holding the full output, e.g. watcher.last_match.group(1) for a build id.
+    """
+
+    def __init__(self, pattern, callback=None, fatal: bool = False, stream: str = None):
+        """
+        :param pattern:     Regex string or compiled pattern, searched for within each line
+        :param callback:    Optional function called with (match, stream_name) for every match
+        :param fatal:       Kill the process on the first match
+        :param stream:      'stdout' or 'stderr' to only watch one stream, None to watch both
+        """
+        self.pattern = re.compile(pattern) if isinstance(pattern, str) else pattern
+        self.callback = callback
+        self.fatal = fatal
+        self.stream = stream
+
+        self.match_count = 0
+        self.first_match: re.Match = None
+        self.last_match: re.Match = None
+
+    def feed(self, stream_name: str, line: str) -> bool:
+        """
+        Checks the line, returns True if it matched
+        """
+        if self.stream is not None and self.stream != stream_name:
+            return False
+
+        match = self.pattern.search(line)
+        if match is None:
+            return False
+
+        self.match_count += 1
+        if self.first_match is None:
+            self.first_match = match
+        self.last_match = match
+
+        if self.callback is not None:
+            self.callback(match, stream_name)
+
+        return True
+
+
+class _ProcessOutputHandler:
+    """
+    Handles every line a child process writes. Shared by run_process and run_process_async so both behave the same.
+    Lines are echoed to the console, captured in memory and written to the process log files as they arrive.
+    """
+
+    def __init__(self, cmd: list, sup_con_stdout: bool, sup_out_stdout: bool, sup_con_stderr: bool,
+                 sup_out_stderr: bool, log_to_file: bool, max_capture_lines: int, max_capture_bytes: int,
+                 capture_patterns: list, watchers: list, kill, binary_mode: bool = False):
+        self._binary_mode = binary_mode
+        self._watchers = list(watchers or [])
+        self._kill = kill
+        self.stop_reason: str = None
+        self.timed_out = False
+        self.last_output_time = time.perf_counter()
+        self.recent_lines = deque(maxlen=_timeout_tail_lines)
+
+        self._suppress_console = {'stdout': sup_con_stdout, 'stderr': sup_con_stderr}
+        self._suppress_output = {'stdout': sup_out_stdout, 'stderr': sup_out_stderr}
+        self._captures = {
+            'stdout': _OutputCapture(max_capture_lines, max_capture_bytes, capture_patterns),
+            'stderr': _OutputCapture(max_capture_lines, max_capture_bytes, capture_patterns)
+        }
+
+        self._console = _console_stream.get()
+        self.output_sizes = {'stdout': 0, 'stderr': 0}
+
+        self._log = get_process_log_store().create_log(os.path.basename(cmd[0])) if log_to_file else None
+
+    def handle_raw_output(self, stream_name: str, data):
+        """
+        Binary mode only. Counts the raw bytes and writes them to the log without decoding them first.
+        Called from the reader threads, each stream has its own log file so they don't need a lock.
+        """
+        self.output_sizes[stream_name] += len(data)
+        self.last_output_time = time.perf_counter()
+        if self._log is not None:
+            try:
+                self._log.write_bytes(stream_name, data)
+            except ValueError:
+                # The log was closed after we gave up on a killed process
+                pass
+
+    def handle_line(self, stream_name: str, line: str):
+        if not self._binary_mode:
+            self.output_sizes[stream_name] += len(line)
+        self.last_output_time = time.perf_counter()
+        self.recent_lines.append(line)
+        if not self._suppress_console[stream_name]:
+            if self._console is None:
+                # Records logged before this line are still queued for the logging thread, they go out first
+                _wait_for_queued_records()
+            print(line, end='', flush=True, file=self._console)
+        if not self._suppress_output[stream_name]:
+            self._captures[stream_name].append(line)
+        if self._log is not None and not self._binary_mode:
+            self._log.write(stream_name, line)
+
+        for watcher in self._watchers:
+            if watcher.feed(stream_name, line) and watcher.fatal:
+                self.request_stop(f'Output matched fatal pattern: {line.strip()}')
+
+    def request_stop(self, reason: str, timed_out: bool = False):
+        """
+        Kills the process, only the first reason is kept
+        """
+        if self.stop_reason is not None:
+            return
+
+        self.stop_reason = reason
+        self.timed_out = timed_out
+        try:
+            self._kill()
+        except ProcessLookupError:
+            # Already exited
+            pass
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+
+    def get_output(self, stream_name: str) -> ProcessOutput:
+        return self._captures[stream_name].get_output(self._log.paths[stream_name] if self._log else None)
+
+
 def run_process(cmd: list, sup_con_stdout: bool = False, sup_out_stdout: bool = False,
                 sup_con_stderr: bool = False, sup_out_stderr: bool = False,
-                log_to_file: bool = True, allow_fail: bool = False) -> (int, str, str):
+                log_to_file: bool = True, allow_fail: bool = False, max_capture_lines: int = None,
+                max_capture_bytes: int = None, capture_patterns: list = None,
+                watchers: list[OutputWatcher] = None, timeout: float = None,
+                inactivity_timeout: float = None, binary_mode: bool = False, encoding: str = 'utf-8',
+                errors: str = 'replace') -> ProcessResult:
     """
     Executes a subprocess with the given arguments and returns the exit code and stdout
+
+    :param max_capture_lines:   If set, only the last N lines of each stream are kept in memory
+    :param max_capture_bytes:   If set, only the last N characters of each stream are kept in memory
+    :param capture_patterns:    Regex patterns, lines matching any of them are kept even when they fall out of the tail
+    :param watchers:            OutputWatchers to run against each line as it arrives
+    :param timeout:             If set, the process tree is killed after this many seconds
+    :param inactivity_timeout:  If set, the process tree is killed after this many seconds without any output.
+                                Timeouts raise ProcessTimeoutError, unless allow_fail is set.
+    :param binary_mode:         Reads the pipes in large binary chunks, writing the raw bytes to the log and decoding
+                                them with encoding and errors. Invalid output can't raise partway through unless
+                                errors is 'strict'. By default the pipes are read as text in the locale's encoding.
+    :param encoding:            Encoding used to decode output in binary mode
+    :param errors:              Decode error handling used in binary mode, see codecs
+    :return:                    Exit code, stdout and stderr as a ProcessResult. Output is returned as ProcessOutput
     """
 
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    # Set up before the process starts, so if creating the log fails there's nothing running to clean up
+    proc = None
+    handler = _ProcessOutputHandler(cmd, sup_con_stdout, sup_out_stdout, sup_con_stderr, sup_out_stderr,
+                                    log_to_file, max_capture_lines, max_capture_bytes, capture_patterns, watchers,
+                                    lambda: _kill_process_tree(proc), binary_mode)
 
-    command_start_date = datetime.now().strftime('%Y-%m-%d_%H.%M.%S')
+    start_time = time.time()
+    start_counter = time.perf_counter()
+    try:
+        if binary_mode:
+            # Unbuffered so each readinto is a single read from the pipe, and returns as soon as there's output
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0)
+        else:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    except BaseException:
+        handler.close()
+        raise
+    metrics = ProcessMetrics(os.path.basename(cmd[0]), proc.pid, start_time)
 
-    stdout = ""
-    for line in proc.stdout:
-        if not sup_con_stdout:
-            print(line, end='', flush=True)
-        if not sup_out_stdout:
-            stdout += line
+    # On POSIX we get the CPU time of the whole tree from wait4 once it exits, otherwise we have to poll it. Memory is
+    # always polled, as a child inherits its parent's ru_maxrss when it's forked, so wait4 would report ours.
+    use_wait4 = hasattr(os, 'wait4')
+    sampler = _ResourceSampler(proc.pid)
+    sampler_stop = threading.Event()
+    sampler_thread = threading.Thread(target=sampler.run_until, args=(sampler_stop,), daemon=True)
+    if sampler.available:
+        sampler_thread.start()
 
-    stderr = ""
-    for line in proc.stderr:
-        if not sup_con_stderr:
-            print(line, end='', flush=True)
-        if not sup_out_stderr:
-            stderr += line
+    # Drain both pipes at once, lines are queued in the order they arrive so stdout and stderr stay interleaved
+    # the same way the child wrote them.
+    output_queue = queue.Queue()
+    if binary_mode:
+        readers = [
+            threading.Thread(target=_pump_stream_binary,
+                             args=(proc.stdout, 'stdout', output_queue, handler, encoding, errors), daemon=True),
+            threading.Thread(target=_pump_stream_binary,
+                             args=(proc.stderr, 'stderr', output_queue, handler, encoding, errors), daemon=True)
+        ]
+    else:
+        readers = [
+            threading.Thread(target=_pump_stream, args=(proc.stdout, 'stdout', output_queue), daemon=True),
+            threading.Thread(target=_pump_stream, args=(proc.stderr, 'stderr', output_queue), daemon=True)
+        ]
+    for reader in readers:
+        reader.start()
 
-    if log_to_file:
-        log_dir = get_process_log_dir()
-        Path(log_dir).mkdir(parents=True, exist_ok=True)
+    reader_error = None
+    try:
+        open_streams = len(readers)
+        while open_streams > 0:
+            if handler.stop_reason is not None:
+                # Once the process has been killed, don't wait forever on children that kept the pipes open
+                wait_time = _kill_drain_timeout
+            else:
+                reason, wait_time = _get_timeout_reason(handler, start_counter, timeout, inactivity_timeout)
+                if reason is not None:
+                    handler.request_stop(reason, timed_out=True)
+                    continue
 
-        exe_name = os.path.basename(cmd[0])
+            try:
+                stream_name, lines = output_queue.get(timeout=wait_time)
+            except queue.Empty:
+                if handler.stop_reason is not None:
+                    break
+                continue
 
-        f = open(f'{log_dir}/{exe_name}_{command_start_date}_stdout.txt', 'w')
-        f.write(stdout)
-        f.close()
+            if lines is None:
+                open_streams -= 1
+                continue
 
-        f = open(f'{log_dir}/{exe_name}_{command_start_date}_stderr.txt', 'w')
-        f.write(stderr)
-        f.close()
+            if isinstance(lines, Exception):
+                # We can't read the rest of the output, so don't leave the process blocked on a full pipe
+                reader_error = lines
+                handler.request_stop(f'Failed to read {stream_name}: {lines}')
+                continue
+
+            for line in lines:
+                handler.handle_line(stream_name, line)
+    except BaseException:
+        # A watcher callback raised, or we were interrupted. Nothing is reading the output any more, so don't leave
+        # the process running with the reader threads queueing it up.
+        sampler_stop.set()
+        try:
+            _kill_process_tree(proc)
+        except ProcessLookupError:
+            pass
+        proc.wait()
+        raise
+    finally:
+        handler.close()
+
+    if open_streams == 0:
+        for reader in readers:
+            reader.join()
+
+        proc.stdout.close()
+        proc.stderr.close()
+
+    # The pipes have closed, one last look before the process exits catches whatever it used since the last sample
+    sampler_stop.set()
+    if sampler_thread.is_alive():
+        sampler_thread.join()
+    sampler.sample()
+    metrics.peak_rss = sampler.peak_rss
+    metrics.peak_process_rss = sampler.peak_process_rss
+
+    # Popen may have already reaped the process if it was killed
+    if use_wait4 and proc.returncode is None:
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+
+        metrics.user_time = rusage.ru_utime
+        metrics.sys_time = rusage.ru_stime
+    else:
+        metrics.user_time = sampler.user_time
+        metrics.sys_time = sampler.sys_time
 
-    proc.stdout.close()
-    proc.stderr.close()
     return_code = proc.wait()
+    metrics.wall_time = time.perf_counter() - start_counter
+
+    if reader_error is not None:
+        raise reader_error
+
+    return _finish_process(handler, metrics, return_code, allow_fail)
+
+
+def _finish_process(handler: _ProcessOutputHandler, metrics: ProcessMetrics, return_code: int,
+                    allow_fail: bool) -> ProcessResult:
+    """
+    Records the metrics and builds the result, shared by run_process and run_process_async
+    """
+    metrics.return_code = return_code
+    metrics.stdout_bytes = handler.output_sizes['stdout']
+    metrics.stderr_bytes = handler.output_sizes['stderr']
+    metrics.stop_reason = handler.stop_reason
+    _write_process_metrics(metrics)
+
+    # Each process gets its own track in the trace, as several can be running on the same thread at once
+    record_span(metrics.exe, 'process', metrics.start_time, metrics.wall_time, f'{metrics.exe} ({metrics.pid})',
+                {'pid': metrics.pid, 'return_code': return_code, 'peak_rss': metrics.peak_rss,
+                 'stop_reason': metrics.stop_reason})
 
-    if allow_fail is False and return_code != 0:
+    result = ProcessResult(return_code, handler.get_output('stdout'), handler.get_output('stderr'), metrics)
+
+    if allow_fail:
+        return result
+
+    if handler.timed_out:
+        tail = ''.join(handler.recent_lines)
+        raise ProcessTimeoutError(f'Program was killed! {handler.stop_reason}. Last output:\n{tail}', result)
+
+    if handler.stop_reason is not None:
+        raise Exception(f'Program was stopped early! {handler.stop_reason}')
+
+    if return_code != 0:
         raise Exception(f'Program failed with error code: {return_code}!')
 
-    return return_code, stdout, stderr
+    return result
+
+
+async def _pump_stream_async(stream: asyncio.StreamReader, stream_name: str, handler: _ProcessOutputHandler,
+                             binary_mode: bool, encoding: str, errors: str):
+    """
+    Async version of _pump_stream. Reads in chunks rather than with readline so long lines don't hit the
+    StreamReader limit. Outside of binary mode they are decoded the same way universal_newlines does for run_process.
+    """
+    if binary_mode:
+        decoder = _LineDecoder(encoding, errors)
+    else:
+        decoder = _LineDecoder(locale.getpreferredencoding(False), 'strict')
+
+    while True:
+        chunk = await stream.read(_binary_read_size if binary_mode else 64 * 1024)
+        if binary_mode and chunk:
+            handler.handle_raw_output(stream_name, chunk)
+
+        for line in decoder.decode(chunk, final=not chunk):
+            handler.handle_line(stream_name, line)
+
+        if not chunk:
+            break
+
+
+async def run_process_async(cmd: list, sup_con_stdout: bool = False, sup_out_stdout: bool = False,
+                            sup_con_stderr: bool = False, sup_out_stderr: bool = False,
+                            log_to_file: bool = True, allow_fail: bool = False, max_capture_lines: int = None,
+                            max_capture_bytes: int = None, capture_patterns: list = None,
+                            watchers: list[OutputWatcher] = None, timeout: float = None,
+                            inactivity_timeout: float = None, binary_mode: bool = False, encoding: str = 'utf-8',
+                            errors: str = 'replace') -> ProcessResult:
+    """
+    Awaitable version of run_process, takes the same arguments and returns the same values.
+    Lets independent commands run concurrently within one event loop, e.g. with asyncio.gather.
+    """
+
+    proc = None
+    stopped = asyncio.Event()
+
+    def kill():
+        stopped.set()
+        _kill_process_tree(proc)
+
+    # Set up before the process starts, so if creating the log fails there's nothing running to clean up
+    handler = _ProcessOutputHandler(cmd, sup_con_stdout, sup_out_stdout, sup_con_stderr, sup_out_stderr,
+                                    log_to_file, max_capture_lines, max_capture_bytes, capture_patterns, watchers,
+                                    kill, binary_mode)
+
+    start_time = time.time()
+    start_counter = time.perf_counter()
+    try:
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE,
+                                                    stderr=asyncio.subprocess.PIPE)
+    except BaseException:
+        handler.close()
+        raise
+    metrics = ProcessMetrics(os.path.basename(cmd[0]), proc.pid, start_time)
+
+    # asyncio reaps the process itself, so we can only poll the usage. Without psutil we fall back to the CPU time
+    # of all our reaped children, which includes any other processes that finished at the same time.
+    sampler = _ResourceSampler(proc.pid)
+    sampler_task = asyncio.ensure_future(sampler.run_async()) if sampler.available else None
+    children_usage = _get_children_rusage()
+
+    async def watchdog():
+        while True:
+            reason, wait_time = _get_timeout_reason(handler, start_counter, timeout, inactivity_timeout)
+            if reason is not None:
+                handler.request_stop(reason, timed_out=True)
+                return
+            if wait_time is None:
+                return
+            await asyncio.sleep(wait_time)
+
+    # Kept as separate tasks so they can be cancelled, gather doesn't cancel the other one when one of them fails
+    pump_tasks = [
+        asyncio.ensure_future(_pump_stream_async(proc.stdout, 'stdout', handler, binary_mode, encoding, errors)),
+        asyncio.ensure_future(_pump_stream_async(proc.stderr, 'stderr', handler, binary_mode, encoding, errors))
+    ]
+    pumps = asyncio.gather(*pump_tasks)
+    stop_waiter = asyncio.ensure_future(stopped.wait())
+    watchdog_task = asyncio.ensure_future(watchdog())
+    try:
+        await asyncio.wait([pumps, stop_waiter], return_when=asyncio.FIRST_COMPLETED)
+        if not pumps.done():
+            # Once the process has been killed, don't wait forever on children that kept the pipes open
+            try:
+                await asyncio.wait_for(asyncio.shield(pumps), _kill_drain_timeout)
+            except asyncio.TimeoutError:
+                for task in pump_tasks:
+                    task.cancel()
+        else:
+            # Raise any errors from reading the output
+            await pumps
+    except BaseException:
+        # A pump failed, e.g. on a decode error or a watcher callback raising, or we were cancelled. Nothing is
+        # reading the pipes any more, so don't leave the process running and blocked on them.
+        for task in pump_tasks:
+            task.cancel()
+        try:
+            _kill_process_tree(proc)
+        except ProcessLookupError:
+            pass
+        await proc.wait()
+        raise
+    finally:
+        stop_waiter.cancel()
+        watchdog_task.cancel()
+        if sampler_task is not None:
+            sampler_task.cancel()
+        handler.close()
+
+    # The pipes have closed, one last look before the process exits catches whatever it used since the last sample
+    sampler.sample()
+    return_code = await proc.wait()
+    metrics.wall_time = time.perf_counter() - start_counter
+
+    if sampler_task is not None:
+        metrics.peak_rss = sampler.peak_rss
+        metrics.peak_process_rss = sampler.peak_process_rss
+
+    if sampler.user_time is not None:
+        metrics.user_time = sampler.user_time
+        metrics.sys_time = sampler.sys_time
+    elif children_usage is not None:
+        end_usage = _get_children_rusage()
+        metrics.user_time = end_usage.ru_utime - children_usage.ru_utime
+        metrics.sys_time = end_usage.ru_stime - children_usage.ru_stime
+
+    return _finish_process(handler, metrics, return_code, allow_fail)
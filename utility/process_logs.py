@@ -0,0 +1,348 @@
+"""
+Storage for the stdout and stderr logs written by run_process.
+
+Logs are compressed as they are written, every run gets its own uniquely named files, and each finished run is added
+to an index.jsonl manifest in the log dir. Retention sweeps every log file in the dir by its modified time and size,
+so logs of runs that were killed before they finished, and plain text logs from older versions, are removed too.
+Logs modified recently are left alone, as they may belong to a run that's still going.
+"""
+
+import os
+import io
+import gzip
+import uuid
+import json
+import time
+import threading
+import contextlib
+import itertools
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator
+
+_compression_extensions = {
+    None: '.txt',
+    'gzip': '.txt.gz',
+    'zstd': '.txt.zst',
+}
+
+_manifest_name = 'index.jsonl'
+
+# Logs modified more recently than this are never removed, they may still be being written
+_retention_min_age = 60 * 60
+
+# How often each store sweeps its logs for retention
+_retention_interval = 5 * 60
+
+# How long to wait for another process to finish with the manifest, and when its lock is old enough to be left over
+# from a process that was killed
+_manifest_lock_timeout = 10
+_manifest_lock_stale_age = 60
+
+# Makes file names unique within this process, even when runs start in the same microsecond
+_run_counter = itertools.count()
+
+
+def _check_compression(compression: str):
+    """
+    Raises if logs can't be written with the compression, so a bad setting fails straight away rather than part way
+    through a run_process
+    """
+    if compression not in _compression_extensions:
+        raise Exception(f'Unknown process log compression: {compression}')
+
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception('zstd process log compression requires the zstandard package!') from None
+
+
+def _is_log_file(file_name: str) -> bool:
+    return any(file_name.endswith(f'_{x}{y}') for x in ('stdout', 'stderr') for y in _compression_extensions.values())
+
+
+def _open_compressed_writer(path: str, compression: str):
+    if compression is None:
+        return open(path, 'wb')
+
+    if compression == 'gzip':
+        # Level 6 is a fair bit faster than gzip's default of 9 for very little size difference on logs
+        return gzip.open(path, 'wb', compresslevel=6)
+
+    if compression == 'zstd':
+        # Optional, we only need it if someone asks for zstd
+        import zstandard
+        return zstandard.ZstdCompressor(level=3).stream_writer(open(path, 'wb'))
+
+    raise Exception(f'Unknown process log compression: {compression}')
+
+
+def _open_compressed_reader(path: str):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+
+    if path.endswith('.zst'):
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+
+    return open(path, 'rb')
+
+
+def read_process_log(path: str, encoding: str = 'utf-8', errors: str = 'replace', newline: str = None) -> Iterator[str]:
+    """
+    Streams the lines of a process log, no matter how it was compressed
+    :param newline: Passed to TextIOWrapper, '' keeps line endings and carriage returns as they were written
+    """
+    with io.TextIOWrapper(_open_compressed_reader(path), encoding=encoding, errors=errors, newline=newline) as f:
+        for line in f:
+            yield line
+
+
+class ProcessLog:
+    """
+    The log files for a single process run. Created by ProcessLogStore.create_log.
+    """
+
+    def __init__(self, store: 'ProcessLogStore', exe_name: str):
+        self._store = store
+        self.exe_name = exe_name
+        self.start_time = time.time()
+
+        start_date = datetime.fromtimestamp(self.start_time).strftime('%Y-%m-%d_%H.%M.%S.%f')
+        self.run_id = f'{exe_name}_{start_date}_{os.getpid()}_{next(_run_counter)}'
+
+        extension = _compression_extensions[store.compression]
+        self.paths = {x: f'{store.log_dir}/{self.run_id}_{x}{extension}' for x in ('stdout', 'stderr')}
+        self._files = {x: _open_compressed_writer(path, store.compression) for x, path in self.paths.items()}
+        store._open_files.update(os.path.basename(x) for x in self.paths.values())
+
+    def write(self, stream_name: str, line: str):
+        self._files[stream_name].write(line.encode('utf-8', errors='replace'))
+
+    def write_bytes(self, stream_name: str, data):
+        self._files[stream_name].write(data)
+
+    def close(self):
+        if not self._files:
+            return
+
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+        self._store._add_to_manifest(self)
+        self._store._open_files.difference_update(os.path.basename(x) for x in self.paths.values())
+        self._store._maybe_enforce_retention()
+
+
+class ProcessLogStore:
+    """
+    A directory of process logs with a manifest and retention.
+    """
+
+    def __init__(self, log_dir: str, compression: str = 'gzip', max_total_bytes: int = None,
+                 max_age_days: float = None):
+        """
+        :param log_dir:         Directory the logs are written to
+        :param compression:     'gzip', 'zstd' (requires the zstandard package) or None for plain text
+        :param max_total_bytes: Oldest logs are removed once the logs in the dir take up more than this
+        :param max_age_days:    Logs older than this are removed
+        """
+        _check_compression(compression)
+
+        self.log_dir = log_dir
+        self.compression = compression
+        self.max_total_bytes = max_total_bytes
+        self.max_age_days = max_age_days
+
+        self._manifest_path = f'{log_dir}/{_manifest_name}'
+        self._lock = threading.Lock()
+        # Names of the logs this process is still writing
+        self._open_files: set[str] = set()
+        self._last_retention = None
+
+        Path(log_dir).mkdir(parents=True, exist_ok=True)
+
+    def create_log(self, exe_name: str) -> ProcessLog:
+        return ProcessLog(self, exe_name)
+
+    def entries(self) -> list[dict]:
+        """
+        Returns every finished run in the manifest, oldest first
+        """
+        with self._lock:
+            return self._read_manifest()
+
+    def read(self, run_id: str, stream_name: str = 'stdout') -> Iterator[str]:
+        """
+        Streams the lines of a run's log
+        """
+        for entry in self.entries():
+            if entry['run_id'] == run_id:
+                return read_process_log(f'{self.log_dir}/{entry["files"][stream_name]}')
+
+        raise Exception(f'No process log found for {run_id}')
+
+    def _read_manifest(self) -> list[dict]:
+        if not os.path.exists(self._manifest_path):
+            return []
+
+        entries = []
+        with open(self._manifest_path, 'r') as f:
+            for line in f:
+                # Skip anything half written by a process that was killed
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue
+
+        return entries
+
+    @contextlib.contextmanager
+    def _manifest_lock(self):
+        """
+        Stops other threads and processes using the same log dir from changing the manifest at the same time. Yields
+        False if another process held on to it for too long, the caller decides whether to go ahead anyway.
+        """
+        lock_path = f'{self._manifest_path}.lock'
+        with self._lock:
+            deadline = time.monotonic() + _manifest_lock_timeout
+            while True:
+                try:
+                    os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                    break
+                except FileExistsError:
+                    pass
+
+                try:
+                    if time.time() - os.path.getmtime(lock_path) > _manifest_lock_stale_age:
+                        os.remove(lock_path)
+                        continue
+                except OSError:
+                    # Released, or another process removed the stale lock first
+                    continue
+
+                if time.monotonic() > deadline:
+                    yield False
+                    return
+                time.sleep(0.05)
+
+            try:
+                yield True
+            finally:
+                try:
+                    os.remove(lock_path)
+                except OSError:
+                    pass
+
+    def _add_to_manifest(self, log: ProcessLog):
+        entry = {
+            'run_id': log.run_id,
+            'exe': log.exe_name,
+            'start_time': log.start_time,
+            'end_time': time.time(),
+            'compression': self.compression,
+            'files': {x: os.path.basename(path) for x, path in log.paths.items()},
+            'size': sum(os.path.getsize(x) for x in log.paths.values() if os.path.exists(x)),
+        }
+
+        # A single small append, so even without the lock it won't be interleaved with other writers. The run itself
+        # has finished, so a manifest we can't write to isn't worth failing it over.
+        with self._manifest_lock():
+            try:
+                with open(self._manifest_path, 'a') as f:
+                    f.write(json.dumps(entry) + '\n')
+            except OSError:
+                pass
+
+    def _maybe_enforce_retention(self):
+        now = time.monotonic()
+        if self._last_retention is not None and now - self._last_retention < _retention_interval:
+            return
+        self._last_retention = now
+        self.enforce_retention()
+
+    def enforce_retention(self):
+        """
+        Removes the oldest logs in the dir until it's within the size and age limits, then drops the runs whose logs
+        are gone from the manifest. Logs that can't be removed, e.g. ones locked by another process, are skipped.
+        """
+        if self.max_total_bytes is None and self.max_age_days is None:
+            return
+
+        now = time.time()
+        files = []
+        try:
+            with os.scandir(self.log_dir) as it:
+                for x in it:
+                    if not _is_log_file(x.name) or x.name in self._open_files:
+                        continue
+                    try:
+                        stat = x.stat()
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, x.path))
+        except OSError:
+            return
+
+        files.sort()
+
+        expired = []
+        kept = []
+        for mtime, size, path in files:
+            if self.max_age_days is not None and mtime < now - self.max_age_days * 24 * 60 * 60:
+                expired.append(path)
+            else:
+                kept.append((mtime, size, path))
+
+        if self.max_total_bytes is not None:
+            total = sum(x[1] for x in kept)
+            for mtime, size, path in kept:
+                if total <= self.max_total_bytes or mtime > now - _retention_min_age:
+                    break
+                expired.append(path)
+                total -= size
+
+        removed = False
+        for path in expired:
+            try:
+                os.remove(path)
+                removed = True
+            except FileNotFoundError:
+                removed = True
+            except OSError:
+                pass
+
+        if removed:
+            self._prune_manifest()
+
+    def _prune_manifest(self):
+        """
+        Drops the runs whose logs have all been removed from the manifest
+        """
+        with self._manifest_lock() as locked:
+            if not locked:
+                # Another process has it, they're dropped the next time logs are removed
+                return
+
+            try:
+                entries = self._read_manifest()
+            except OSError:
+                return
+            kept = [x for x in entries if any(os.path.exists(f'{self.log_dir}/{y}') for y in x['files'].values())]
+            if len(kept) == len(entries):
+                return
+
+            # Swap the manifest in one go so readers never see a partial file
+            temp_path = f'{self._manifest_path}.{uuid.uuid4().hex}.tmp'
+            try:
+                with open(temp_path, 'w') as f:
+                    for entry in kept:
+                        f.write(json.dumps(entry) + '\n')
+                os.replace(temp_path, self._manifest_path)
+            except OSError:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
@@ -0,0 +1,267 @@
+"""
+Records how long each section of a job takes.
+
+Spans are opened and closed by gl_open_block and gl_close_block (or the section helper), so every step that is
+already wrapped in a GitLab section gets timed. run_process, Perforce and HTTP calls add their own spans too.
+At exit a summary of the slowest sections is printed, the spans are written to JSON, and a Chrome trace of the whole
+run is written which can be opened in Perfetto or chrome://tracing.
+"""
+
+import os
+import json
+import time
+import atexit
+import threading
+import contextlib
+import contextvars
+from dataclasses import dataclass, asdict, field
+from pathlib import Path
+
+_spans_lock = threading.Lock()
+_spans: list['Span'] = []
+_exit_hook_registered = False
+
+# Spans currently open in this thread or task, innermost last
+_open_spans = contextvars.ContextVar('ciscripts_open_spans', default=())
+
+_custom_spans_path: str = None
+_custom_trace_path: str = None
+_print_summary_at_exit = True
+
+
+@dataclass
+class Span:
+    """
+    A single timed section. start_time is a unix timestamp, duration is in seconds and None while it's still open.
+    category is 'section' for GitLab sections, or what recorded it e.g. 'process', 'p4', 'http'.
+    track is the timeline it's drawn on in the trace, the thread name unless set.
+    """
+    name: str
+    header: str
+    start_time: float
+    depth: int
+    parent: str = None
+    thread: str = field(default_factory=lambda: threading.current_thread().name)
+    duration: float = None
+    category: str = 'section'
+    track: str = None
+    args: dict = None
+
+    def __post_init__(self):
+        self._start_counter = time.perf_counter()
+
+
+def set_spans_output_path(path: str, print_summary: bool = True):
+    """
+    Sets where spans are written at exit, defaults to spans.json in the process log dir.
+    :param path:            JSON file path
+    :param print_summary:   Whether to print the timing summary at exit
+    """
+    global _custom_spans_path, _print_summary_at_exit
+    _custom_spans_path = path
+    _print_summary_at_exit = print_summary
+
+
+def set_trace_output_path(path: str):
+    """
+    Sets where the Chrome trace is written at exit, defaults to trace.json in the process log dir.
+    Point this inside your job's artifacts to keep it.
+    """
+    global _custom_trace_path
+    _custom_trace_path = path
+
+
+def _get_default_output_dir() -> str:
+    # Imported here as process.py records its own spans
+    from .process import get_process_log_dir
+    return get_process_log_dir()
+
+
+def get_spans_output_path() -> str:
+    if _custom_spans_path:
+        return _custom_spans_path
+
+    return f'{_get_default_output_dir()}/spans.json'
+
+
+def get_trace_output_path() -> str:
+    if _custom_trace_path:
+        return _custom_trace_path
+
+    return f'{_get_default_output_dir()}/trace.json'
+
+
+def _add_span(span: Span):
+    global _exit_hook_registered
+
+    with _spans_lock:
+        _spans.append(span)
+        if not _exit_hook_registered:
+            atexit.register(_finish_spans)
+            _exit_hook_registered = True
+
+
+def begin_span(name: str, header: str = None, category: str = 'section', args: dict = None) -> Span:
+    """
+    Opens a span nested under whichever span is currently open
+    """
+    open_spans = _open_spans.get()
+    span = Span(name, header or name, time.time(), len(open_spans), open_spans[-1].name if open_spans else None,
+                category=category, args=args)
+    _open_spans.set(open_spans + (span,))
+
+    _add_span(span)
+    return span
+
+
+def record_span(name: str, category: str, start_time: float, duration: float, track: str = None,
+                args: dict = None) -> Span:
+    """
+    Records a span that has already finished, e.g. a process once it has exited
+    """
+    open_spans = _open_spans.get()
+    span = Span(name, name, start_time, len(open_spans), open_spans[-1].name if open_spans else None,
+                duration=duration, category=category, track=track, args=args)
+
+    _add_span(span)
+    return span
+
+
+def end_span(name: str) -> Span:
+    """
+    Closes the innermost open span with the given name, and any spans opened inside it that were never closed.
+    Returns None if there was no open span with that name.
+    """
+    open_spans = _open_spans.get()
+    for i in range(len(open_spans) - 1, -1, -1):
+        if open_spans[i].name != name:
+            continue
+
+        now = time.perf_counter()
+        for span in open_spans[i:]:
+            span.duration = now - span._start_counter
+
+        _open_spans.set(open_spans[:i])
+        return open_spans[i]
+
+    return None
+
+
+class _Traced(contextlib.ContextDecorator):
+    def __init__(self, name: str, category: str, args: dict):
+        self._name = name
+        self._category = category
+        self._args = args
+
+    def _recreate_cm(self):
+        return _Traced(self._name, self._category, self._args)
+
+    def __enter__(self):
+        begin_span(self._name, category=self._category, args=self._args)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        end_span(self._name)
+        return False
+
+
+def trace(name: str, category: str = 'function', args: dict = None) -> _Traced:
+    """
+    Records a span around a block of code, or a function when used as a decorator, without creating a GitLab
+    section. Shows up in the Chrome trace, but not in the section summary.
+    """
+    return _Traced(name, category, args)
+
+
+def get_spans() -> list[Span]:
+    with _spans_lock:
+        return list(_spans)
+
+
+def print_span_summary():
+    """
+    Prints the total time spent in each section, slowest first
+    """
+    totals = {}
+    for span in get_spans():
+        if span.duration is None or span.category != 'section':
+            continue
+
+        count, total, longest = totals.get(span.name, (0, 0.0, 0.0))
+        totals[span.name] = (count + 1, total + span.duration, max(longest, span.duration))
+
+    if not totals:
+        return
+
+    name_width = max(len(x) for x in totals)
+    print(f'{"Section":<{name_width}}  {"Count":>5}  {"Total (s)":>10}  {"Max (s)":>10}')
+    for name, (count, total, longest) in sorted(totals.items(), key=lambda x: x[1][1], reverse=True):
+        print(f'{name:<{name_width}}  {count:>5}  {total:>10.2f}  {longest:>10.2f}')
+
+
+def write_spans_json(path: str = None):
+    """
+    Writes every span to a JSON file, unfinished spans have a duration of null
+    """
+    path = path or get_spans_output_path()
+    Path(os.path.dirname(os.path.abspath(path))).mkdir(parents=True, exist_ok=True)
+
+    with open(path, 'w') as f:
+        json.dump([asdict(x) for x in get_spans()], f, indent=2)
+
+
+def write_chrome_trace(path: str = None):
+    """
+    Writes every span as a Chrome trace event file, which can be opened in Perfetto or chrome://tracing.
+    Each thread gets its own track, so parallel jobs are shown side by side, and every process gets its own track too.
+    Spans that are still open are drawn up to now.
+    """
+    path = path or get_trace_output_path()
+    Path(os.path.dirname(os.path.abspath(path))).mkdir(parents=True, exist_ok=True)
+
+    pid = os.getpid()
+    now = time.time()
+    track_ids = {}
+    events = []
+
+    for span in get_spans():
+        track = span.track or span.thread
+        if track not in track_ids:
+            track_ids[track] = len(track_ids) + 1
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': track_ids[track],
+                           'args': {'name': track}})
+
+        duration = span.duration if span.duration is not None else now - span.start_time
+        event = {
+            'name': span.header,
+            'cat': span.category,
+            'ph': 'X',
+            'ts': span.start_time * 1_000_000,
+            'dur': duration * 1_000_000,
+            'pid': pid,
+            'tid': track_ids[track],
+        }
+        if span.args:
+            event['args'] = span.args
+        events.append(event)
+
+    events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0, 'args': {'name': 'ciscripts'}})
+
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def _finish_spans():
+    if not get_spans():
+        return
+
+    # Imported here as logger.py times its sections with us
+    from .logger import flush_logging
+
+    if _print_summary_at_exit and any(x.category == 'section' for x in get_spans()):
+        flush_logging()
+        print('Section timings:')
+        print_span_summary()
+
+    write_spans_json()
+    write_chrome_trace()
@@ -1,38 +1,412 @@
-import sys
+"""
+Converts Unreal automation test reports to JUnit, so GitLab can show the results.
+
+Reports are read one test at a time, and each test case is written to a spool file as soon as it's read. The JUnit
+file is then written from the spool suite by suite, so neither the report nor the XML tree is ever held in memory in
+full.
+"""
+
+import os
+import re
 import json
-import xml.etree.ElementTree as elemTree
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterator
+from xml.sax.saxutils import escape, quoteattr
+
+from .logger import *
+from .process import processes_are_forked
+
+_logger = register_logger('testconv')
+
+# Top level values of the report we keep, everything else is skipped over while streaming
+_report_summary_keys = ('totalDuration', 'succeeded', 'succeededWithWarnings', 'failed', 'notRun')
+
+# Characters XML 1.0 doesn't allow, even escaped. Test output can contain them.
+_invalid_xml_regex = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+# How much of the report is read at once
+_report_read_size = 1024 * 1024
+
+# How much of the spool is copied into the JUnit file at once
+_spool_copy_size = 1024 * 1024
+
+
+def _xml_attr(value) -> str:
+    return quoteattr(_invalid_xml_regex.sub('', str(value)))
+
+
+def _xml_text(value) -> str:
+    return escape(_invalid_xml_regex.sub('', str(value)))
+
 
+def _get_suite_name(full_test_path: str) -> str:
+    # Everything but the test name, e.g. Project.Functional Tests.Maps for Project.Functional Tests.Maps.Test
+    return '.'.join(full_test_path.split('.')[:-1])
 
-def ue_to_junit(ue_path: str, out_path: str):
+
+class _ReportReader:
+    """
+    Reads a report's tests one at a time. JSONDecoder.raw_decode does the actual parsing, we only walk the top level
+    object and the tests array, reading more of the file whenever a value runs past what's been read so far.
     """
-    Converts UE's test spec to JUnit
+
+    _whitespace_regex = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, file):
+        self._file = file
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        self._read_size = _report_read_size
+
+        # Top level values other than tests, filled in as they're read
+        self.summary = {}
+
+    def _fill(self):
+        data = self._file.read(self._read_size)
+        if not data:
+            self._eof = True
+        self._buffer = self._buffer[self._pos:] + data
+        self._pos = 0
+
+    def _peek(self) -> str:
+        """
+        Skips whitespace and returns the next character without consuming it
+        """
+        while True:
+            self._pos = self._whitespace_regex.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if self._eof:
+                raise Exception('Unexpected end of test report!')
+            self._fill()
+
+    def _expect(self, characters: str) -> str:
+        character = self._peek()
+        if character not in characters:
+            raise Exception(f'Invalid test report, expected one of {characters!r} but got {character!r}!')
+        self._pos += 1
+        return character
+
+    def _decode(self):
+        # raw_decode doesn't skip leading whitespace itself
+        self._peek()
+
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+
+                # A number right at the end of what we've read might carry on past it
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    self._read_size = _report_read_size
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+
+            # The value is cut off, read more. Doubled each time so one huge value doesn't get decoded over and over.
+            self._fill()
+            self._read_size *= 2
+
+    def __iter__(self) -> Iterator[dict]:
+        self._expect('{')
+        if self._peek() == '}':
+            return
+
+        while True:
+            key = self._decode()
+            self._expect(':')
+
+            if key == 'tests':
+                self._expect('[')
+                if self._peek() == ']':
+                    self._pos += 1
+                else:
+                    while True:
+                        yield self._decode()
+                        if self._expect(',]') == ']':
+                            break
+            else:
+                value = self._decode()
+                if key in _report_summary_keys:
+                    self.summary[key] = value
+
+            if self._expect(',}') == '}':
+                return
+
+
+@dataclass
+class _SuiteSpool:
+    """
+    Where a suite's test cases are in the spool file, along with the counts its testsuite element needs
+    """
+    tests: int = 0
+    failures: int = 0
+    errors: int = 0
+    skipped: int = 0
+    time: float = 0.0
+    fragments: list[tuple[int, int]] = field(default_factory=list)
+
+
+@dataclass
+class _ReportSpool:
+    """
+    The converted test cases of a single report. Picklable, so reports can be converted in other processes.
+    """
+    spool_path: str
+    total_time: float = 0.0
+    suites: dict[str, _SuiteSpool] = field(default_factory=dict)
+
+    # (fullTestPath, duration, outcome) of every test, only filled in when they're going to be recorded
+    results: list[tuple[str, float, str]] = None
+
+
+def _get_test_errors(test: dict) -> list[str]:
+    return [x['event']['message'] for x in test.get('entries', []) if x['event']['type'] == 'Error']
+
+
+def _get_test_outcome(test: dict, errors: list[str]) -> str:
+    """
+    Returns 'passed', 'failed', 'error' or 'skipped'
+    """
+    state = test.get('state', 'Success')
+    if state in ('NotRun', 'Skipped'):
+        return 'skipped'
+    if state == 'InProcess':
+        # Never finished, normally because the editor crashed or timed out during it
+        return 'error'
+    if errors or state == 'Fail':
+        return 'failed'
+    return 'passed'
+
+
+def _format_testcase(test: dict, suite: _SuiteSpool) -> tuple[str, str]:
+    """
+    Returns the testcase element and outcome of the test, and adds it to the suite's counts
+    """
+    suite_name = _get_suite_name(test['fullTestPath'])
+    duration = float(test.get('duration', 0))
+    errors = _get_test_errors(test)
+    outcome = _get_test_outcome(test, errors)
+
+    suite.tests += 1
+    suite.time += duration
+
+    parts = [f'<testcase time={_xml_attr(duration)} suite_name={_xml_attr(suite_name)} '
+             f'classname={_xml_attr(suite_name)} name={_xml_attr(test["testDisplayName"])}>']
+
+    if outcome == 'skipped':
+        suite.skipped += 1
+        parts.append('<skipped />')
+    elif outcome == 'error':
+        suite.errors += 1
+        parts.append('<error message="Test did not complete" />')
+    elif outcome == 'failed':
+        suite.failures += 1
+        for message in errors or ['Test failed']:
+            parts.append(f'<failure message={_xml_attr(message)}>{_xml_text(message)}</failure>')
+
+    parts.append('</testcase>\n')
+    return ''.join(parts), outcome
+
+
+def _spool_report(ue_path: str, spool_dir: str, collect_results: bool = False) -> _ReportSpool:
+    """
+    Reads the report one test at a time, writing each test case to a spool file in spool_dir
+    """
+    spool_file = tempfile.NamedTemporaryFile('wb', dir=spool_dir, suffix='.xml', delete=False)
+    report = _ReportSpool(spool_file.name, results=[] if collect_results else None)
+
+    # UE writes the report with a BOM
+    with spool_file, open(ue_path, 'r', encoding='utf-8-sig') as file:
+        reader = _ReportReader(file)
+
+        offset = 0
+        for test in reader:
+            suite = report.suites.setdefault(_get_suite_name(test['fullTestPath']), _SuiteSpool())
+            testcase, outcome = _format_testcase(test, suite)
+            data = testcase.encode('utf-8')
+            spool_file.write(data)
+            suite.fragments.append((offset, len(data)))
+            offset += len(data)
+
+            if collect_results:
+                report.results.append((test['fullTestPath'], float(test.get('duration', 0)), outcome))
+
+    report.total_time = float(reader.summary.get('totalDuration', sum(x.time for x in report.suites.values())))
+    return report
+
+
+def _copy_fragments(spool_file, out_file, fragments: list[tuple[int, int]]):
+    # Test cases of a suite are nearly always next to each other, so merge them into as few reads as possible
+    start, length = fragments[0]
+    for offset, size in fragments[1:]:
+        if offset == start + length:
+            length += size
+            continue
+
+        spool_file.seek(start)
+        _copy_range(spool_file, out_file, length)
+        start, length = offset, size
+
+    spool_file.seek(start)
+    _copy_range(spool_file, out_file, length)
+
+
+def _copy_range(spool_file, out_file, length: int):
+    while length > 0:
+        data = spool_file.read(min(length, _spool_copy_size))
+        out_file.write(data)
+        length -= len(data)
+
+
+def _write_junit(reports: list[_ReportSpool], out_path: str):
+    """
+    Writes the spooled reports as a single JUnit file, merging suites with the same name
+    """
+    suite_names = {}
+    for report in reports:
+        for name in report.suites:
+            suite_names.setdefault(name, None)
+
+    totals = _SuiteSpool()
+    for report in reports:
+        for suite in report.suites.values():
+            totals.tests += suite.tests
+            totals.failures += suite.failures
+            totals.errors += suite.errors
+            totals.skipped += suite.skipped
+
+    Path(os.path.dirname(os.path.abspath(out_path))).mkdir(parents=True, exist_ok=True)
+
+    spool_files = [open(x.spool_path, 'rb') for x in reports]
+    try:
+        with open(out_path, 'wb') as out_file:
+            out_file.write(b"<?xml version='1.0' encoding='utf-8'?>\n")
+            out_file.write(f'<testsuites time={_xml_attr(sum(x.total_time for x in reports))} '
+                           f'tests="{totals.tests}" failures="{totals.failures}" errors="{totals.errors}" '
+                           f'skipped="{totals.skipped}">\n'.encode('utf-8'))
+
+            for name in suite_names:
+                parts = [(spool_file, report.suites[name])
+                         for spool_file, report in zip(spool_files, reports) if name in report.suites]
+
+                out_file.write(f'<testsuite name={_xml_attr(name)} tests="{sum(x.tests for _, x in parts)}" '
+                               f'failures="{sum(x.failures for _, x in parts)}" '
+                               f'errors="{sum(x.errors for _, x in parts)}" '
+                               f'skipped="{sum(x.skipped for _, x in parts)}" '
+                               f'time={_xml_attr(sum(x.time for _, x in parts))}>\n'.encode('utf-8'))
+
+                for spool_file, suite in parts:
+                    _copy_fragments(spool_file, out_file, suite.fragments)
+
+                out_file.write(b'</testsuite>\n')
+
+            out_file.write(b'</testsuites>\n')
+    finally:
+        for spool_file in spool_files:
+            spool_file.close()
+
+
+def ue_to_junit(ue_path: str, out_path: str, history=None):
+    """
+    Converts UE's test spec to JUnit. Test cases are grouped into a testsuite for each fullTestPath prefix.
     :param ue_path:     File path to reports.json output by Unreal
     :param out_path:    File path to place converted test report
+    :param history:     Optional TestHistory to record the test durations and outcomes in
+    """
+
+    ue_reports_to_junit([ue_path], out_path, history=history)
+
+
+def _get_report_path(ue_path: str) -> str:
+    # Unreal writes index.json into the report folder, so accept the folder too
+    if os.path.isdir(ue_path):
+        return os.path.join(ue_path, 'index.json')
+    return ue_path
+
+
+def ue_reports_to_junit(ue_paths: list[str], out_path: str, max_workers: int = None, history=None,
+                        use_processes: bool = None):
+    """
+    Converts many UE test reports, e.g. from sharded or per-map runs, into a single JUnit file. Reports are converted
+    in parallel, and tests from every report are grouped into one testsuite for each fullTestPath prefix.
+    Suite times are the sum of their tests, and the total time is the sum of the reports'.
+    :param ue_paths:        File paths to index.json files output by Unreal, or the folders containing them
+    :param out_path:        File path to place the merged test report
+    :param max_workers:     Number of workers, defaults to the number of CPUs
+    :param history:         Optional TestHistory to record the test durations and outcomes in, as a single run
+    :param use_processes:   Convert in processes rather than threads, defaults to processes_are_forked()
+    """
+    if use_processes is None:
+        use_processes = processes_are_forked()
+
+    report_paths = [_get_report_path(x) for x in ue_paths]
+    collect_results = [history is not None] * len(report_paths)
+
+    spool_dir = tempfile.mkdtemp(prefix='ciscripts_junit_')
+    try:
+        if len(report_paths) <= 1 or max_workers == 1:
+            reports = [_spool_report(x, spool_dir, history is not None) for x in report_paths]
+        else:
+            executor_type = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+            with executor_type(max_workers=max_workers) as executor:
+                # map keeps the reports in order, so suites come out in the same order every time
+                reports = list(executor.map(_spool_report, report_paths, [spool_dir] * len(report_paths),
+                                            collect_results))
+
+        _write_junit(reports, out_path)
+
+        if history is not None:
+            history.add_run(result for x in reports for result in x.results)
+    finally:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+
+    suites = {name for x in reports for name in x.suites}
+    tests = sum(suite.tests for x in reports for suite in x.suites.values())
+    _logger.info(f'Converted {tests} tests in {len(suites)} suites from {len(reports)} reports to {out_path}')
+
+
+def merge_ue_reports(ue_paths: list[str], out_path: str):
+    """
+    Merges several UE test reports, such as the shards of a test run, into a single report in UE's format.
+    Tests are copied one at a time. The test counts are added up, and the total duration is the longest of the
+    reports as they're expected to have run at the same time.
+    :param ue_paths:    File paths to index.json files output by Unreal, or the folders containing them
+    :param out_path:    File path to write the merged index.json to
     """
 
-    with open(ue_path, 'r', encoding='utf-8-sig') as file:
-        unreal_data = json.load(file)
+    summary = {}
+    Path(os.path.dirname(os.path.abspath(out_path))).mkdir(parents=True, exist_ok=True)
 
-    junit_root = elemTree.Element('testsuites')
-    junit_root.set('time', str(unreal_data['totalDuration']))
+    with open(out_path, 'w', encoding='utf-8') as out_file:
+        # The summary goes at the end, as we only know it once every test has been read
+        out_file.write('{"tests": [')
 
-    for test in unreal_data['tests']:
-        full_test_path = test['fullTestPath']
-        test_suite_name = '.'.join(full_test_path.split('.')[:-1])  # Extract test suite name
+        count = 0
+        for ue_path in ue_paths:
+            with open(_get_report_path(ue_path), 'r', encoding='utf-8-sig') as file:
+                reader = _ReportReader(file)
+                for test in reader:
+                    out_file.write(',\n' if count else '\n')
+                    out_file.write(json.dumps(test))
+                    count += 1
 
-        testcase = elemTree.SubElement(junit_root, 'testcase')
-        testcase.set('time', str(test['duration']))
-        testcase.set('suite_name', test_suite_name)
-        testcase.set('classname', test_suite_name)
-        testcase.set('name', test['testDisplayName'])
+            for key, value in reader.summary.items():
+                if key == 'totalDuration':
+                    summary[key] = max(summary.get(key, 0), value)
+                else:
+                    summary[key] = summary.get(key, 0) + value
 
-        for entry in test['entries']:
-            event = entry['event']
-            message = event['message']
-            if event['type'] == 'Error':
-                failure = elemTree.SubElement(testcase, 'failure')
-                failure.text = message
-                failure.set('message', message)
+        out_file.write('\n]')
+        for key, value in summary.items():
+            out_file.write(f', {json.dumps(key)}: {json.dumps(value)}')
+        out_file.write('}\n')
 
-    junit_tree = elemTree.ElementTree(junit_root)
-    junit_tree.write(out_path)
+    _logger.info(f'Merged {count} tests from {len(ue_paths)} reports into {out_path}')
@@ -0,0 +1,245 @@
+"""
+Keeps the duration and outcome of every automation test across runs in SQLite.
+
+Used to find tests that are slow or have got slower, and to split test runs into shards of a similar length.
+Record runs with ue_to_junit(..., history=history) or TestHistory.record_report.
+"""
+
+import time
+import sqlite3
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from .variables import *
+from .logger import *
+from .process import *
+from .test_converter import _ReportReader, _get_report_path, _get_suite_name, _get_test_errors, _get_test_outcome
+
+_logger = register_logger('testhist')
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT,
+    created REAL,
+    commit_sha TEXT,
+    ref_name TEXT
+);
+CREATE TABLE IF NOT EXISTS results (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    test TEXT NOT NULL,
+    suite TEXT NOT NULL,
+    duration REAL NOT NULL,
+    outcome TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_by_test ON results (test, run_id);
+CREATE INDEX IF NOT EXISTS results_by_suite ON results (suite, run_id);
+'''
+
+# Only tests that actually ran count towards durations, skipped tests and crashes would drag them down
+_timed_outcomes = ('passed', 'failed')
+
+
+@dataclass
+class DurationStats:
+    """
+    Duration percentiles in seconds of a test or suite across the runs it was in
+    """
+    name: str
+    runs: int
+    p50: float
+    p95: float
+
+
+@dataclass
+class DurationRegression:
+    """
+    How much slower a test has been in recent runs, compared to the runs before them
+    """
+    name: str
+    previous_p50: float
+    recent_p50: float
+    ratio: float
+
+
+def _percentile(values: list[float], percent: float) -> float:
+    """
+    Linearly interpolated percentile of already sorted values
+    """
+    if len(values) == 1:
+        return values[0]
+
+    position = (len(values) - 1) * percent / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def _group_sorted(rows: Iterable[tuple[str, float]]) -> Iterator[tuple[str, list[float]]]:
+    """
+    Groups (name, duration) rows that are sorted by name, with the durations of each name sorted
+    """
+    name = None
+    durations = []
+    for row_name, duration in rows:
+        if row_name != name:
+            if durations:
+                yield name, sorted(durations)
+            name = row_name
+            durations = []
+        durations.append(duration)
+
+    if durations:
+        yield name, sorted(durations)
+
+
+class TestHistory:
+    """
+    A SQLite database of test results, one row per test per run.
+
+    with ci.TestHistory('Saved/TestHistory.sqlite') as history:
+        ci.ue_to_junit('Saved/Automation/index.json', 'junit.xml', history=history)
+        for x in history.slowest_tests(10):
+            print(f'{x.name}: {x.p50:.1f}s')
+    """
+
+    def __init__(self, db_path: str = None):
+        """
+        :param db_path: Database file, defaults to test_history.sqlite in the process log dir. Keep it somewhere that
+                        survives between jobs, such as the runner's cache, for the history to build up.
+        """
+        self.db_path = db_path or f'{get_process_log_dir()}/test_history.sqlite'
+        Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+
+        self._connection = sqlite3.connect(self.db_path)
+        self._connection.executescript(_schema)
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def add_run(self, results: Iterable[tuple[str, float, str]], name: str = None) -> int:
+        """
+        Records a run and returns its id
+        :param results: (fullTestPath, duration, outcome) of each test, outcome being 'passed', 'failed', 'error'
+                        or 'skipped'
+        :param name:    Name of the run, defaults to the pipeline and job id in CI
+        """
+        if name is None and is_ci():
+            name = f'{ci_pipeline_id()}/{ci_job_id()}'
+
+        with self._connection:
+            cursor = self._connection.execute(
+                'INSERT INTO runs (name, created, commit_sha, ref_name) VALUES (?, ?, ?, ?)',
+                (name, time.time(), ci_commit_sha(), ci_commit_ref_name()))
+            run_id = cursor.lastrowid
+
+            self._connection.executemany(
+                'INSERT INTO results (run_id, test, suite, duration, outcome) VALUES (?, ?, ?, ?, ?)',
+                ((run_id, test, _get_suite_name(test), duration, outcome) for test, duration, outcome in results))
+
+        _logger.info(f'Recorded test run {run_id} in {self.db_path}')
+        return run_id
+
+    def record_report(self, ue_path: str, name: str = None) -> int:
+        """
+        Records the tests of a UE report as a run, reading it one test at a time. Returns the run id.
+        :param ue_path: index.json output by Unreal, or the folder containing it
+        """
+        def iter_results():
+            with open(_get_report_path(ue_path), 'r', encoding='utf-8-sig') as file:
+                for test in _ReportReader(file):
+                    outcome = _get_test_outcome(test, _get_test_errors(test))
+                    yield test['fullTestPath'], float(test.get('duration', 0)), outcome
+
+        return self.add_run(iter_results(), name)
+
+    def _run_filter(self, last_runs: int) -> tuple[str, tuple]:
+        if last_runs is None:
+            return '', ()
+        return 'AND run_id IN (SELECT id FROM runs ORDER BY id DESC LIMIT ?)', (last_runs,)
+
+    def _test_durations(self, last_runs: int = None, tests: list[str] = None) -> Iterator[tuple[str, list[float]]]:
+        run_filter, params = self._run_filter(last_runs)
+        rows = self._connection.execute(
+            f'SELECT test, duration FROM results WHERE outcome IN (?, ?) {run_filter} ORDER BY test',
+            _timed_outcomes + params)
+
+        if tests is not None:
+            wanted = set(tests)
+            rows = (x for x in rows if x[0] in wanted)
+
+        return _group_sorted(rows)
+
+    def test_durations(self, last_runs: int = None, tests: list[str] = None) -> dict[str, DurationStats]:
+        """
+        Returns the p50 and p95 duration of each test, keyed by fullTestPath
+        :param last_runs:   Only look at this many of the most recent runs
+        :param tests:       Only return these tests
+        """
+        return {name: DurationStats(name, len(x), _percentile(x, 50), _percentile(x, 95))
+                for name, x in self._test_durations(last_runs, tests)}
+
+    def suite_durations(self, last_runs: int = None) -> dict[str, DurationStats]:
+        """
+        Returns the p50 and p95 of each suite's total duration per run, keyed by suite name
+        :param last_runs:   Only look at this many of the most recent runs
+        """
+        run_filter, params = self._run_filter(last_runs)
+        rows = self._connection.execute(
+            f'SELECT suite, SUM(duration) FROM results WHERE outcome IN (?, ?) {run_filter} '
+            f'GROUP BY suite, run_id ORDER BY suite',
+            _timed_outcomes + params)
+
+        return {name: DurationStats(name, len(x), _percentile(x, 50), _percentile(x, 95))
+                for name, x in _group_sorted(rows)}
+
+    def slowest_tests(self, limit: int = 20, last_runs: int = None) -> list[DurationStats]:
+        """
+        Returns the tests with the highest p50 duration, slowest first
+        """
+        durations = self.test_durations(last_runs).values()
+        return sorted(durations, key=lambda x: x.p50, reverse=True)[:limit]
+
+    def most_regressed_tests(self, limit: int = 20, recent_runs: int = 5,
+                             min_duration: float = 0.1) -> list[DurationRegression]:
+        """
+        Returns the tests whose p50 duration over the most recent runs has gone up the most compared to all the runs
+        before them, worst first. Only tests that got slower are returned.
+        :param limit:           Maximum number of tests to return
+        :param recent_runs:     Number of most recent runs to compare with the ones before
+        :param min_duration:    Tests quicker than this before are ignored, as tiny timings are mostly noise
+        """
+        rows = self._connection.execute(
+            'SELECT test, duration, run_id IN (SELECT id FROM runs ORDER BY id DESC LIMIT ?) FROM results '
+            'WHERE outcome IN (?, ?) ORDER BY test',
+            (recent_runs,) + _timed_outcomes)
+
+        regressions = []
+        name = None
+        previous, recent = [], []
+
+        def finish():
+            if not previous or not recent:
+                return
+            previous_p50 = _percentile(sorted(previous), 50)
+            recent_p50 = _percentile(sorted(recent), 50)
+            if previous_p50 >= min_duration and recent_p50 > previous_p50:
+                regressions.append(DurationRegression(name, previous_p50, recent_p50, recent_p50 / previous_p50))
+
+        for test, duration, is_recent in rows:
+            if test != name:
+                finish()
+                name = test
+                previous, recent = [], []
+            (recent if is_recent else previous).append(duration)
+        finish()
+
+        return sorted(regressions, key=lambda x: x.ratio, reverse=True)[:limit]
@@ -1,21 +1,116 @@
 from .process import *
+from .profiler import *
 from .logger import *
+from .logger import _format_bytes
 
 """
-A simple class for invoking 7z commands. We're relying on the commandline here to cut
-down on reliance on 3rd party packages. Requires 7zip, obviously.
+Creates zip archives, either with 7z or with the built in writer.
+
+The built in writer compresses on a thread pool, as zlib lets go of the GIL while it works, so it doesn't need 7z
+installed. Big files are split into chunks which are deflated on their own and joined, the same way pigz does it,
+so one huge file still uses every core. Files that are already compressed are stored as they are.
+
+7z is used when args are passed, or when adding to an existing archive.
 https://web.mit.edu/outland/arch/i386_rhel4/build/p7zip-current/DOCS/MANUAL/
 """
 
+import os
+import sys
+import glob
+import mmap
+import stat
+import time
+import zlib
+import struct
+import collections
+from concurrent.futures import ThreadPoolExecutor, Future
+from dataclasses import dataclass
+from pathlib import Path
+
 _logger = register_logger('zipper')
 
-def zip_files(zip_path: str, files: list, args: list = None):
+# Packaged and compressed formats, deflating these again only burns time
+_stored_extensions = {'.pak', '.utoc', '.ucas', '.7z', '.png', '.zip', '.jpg', '.jpeg'}
+
+# Files are compressed in chunks of this size, which is also how much each worker holds at once
+_chunk_size = 4 * 1024 * 1024
+
+# Files at least this big are read through mmap rather than into memory
+_mmap_threshold = 1024 * 1024
+
+# Files bigger than a chunk are stored rather than deflated if this much of their start doesn't shrink by at least
+# _min_deflate_saving, as deflating each chunk of data that's already compressed makes it a little bigger
+_sample_size = 256 * 1024
+_min_deflate_saving = 0.02
+
+# What made the zip, for the central directory. Same as zipfile, DOS on Windows and unix everywhere else.
+_create_system = 0 if sys.platform == 'win32' else 3
+
+_zip64_limit = 0xFFFFFFFF
+_zip64_count_limit = 0xFFFF
+
+_local_header = struct.Struct('<4sHHHHHIIIHH')
+_central_header = struct.Struct('<4sBBHHHHHIIIHHHHHII')
+_end_record = struct.Struct('<4sHHHHIIH')
+_zip64_end_record = struct.Struct('<4sQHHIIQQQQ')
+_zip64_end_locator = struct.Struct('<4sIQI')
+
+_version_default = 20
+_version_zip64 = 45
+_flag_utf8 = 0x800
+_method_stored = 0
+_method_deflated = 8
+
+
+@dataclass
+class _Member:
+    path: str
+    arcname: str
+    size: int
+    mtime: float
+    mode: int
+    is_dir: bool = False
+
+
+@dataclass
+class _Entry:
     """
-    :param zip_path: Path to the zip file we want to create
-    :param files:    List of files, accepts wildcard. use 7z cli docs for reference. Can relative paths to cwd or abs paths
-    :param args:     Additional args to pass to 7z. If supplied, default compression level will be used unless specified otherwise
+    A member once it's been written, what the central directory needs to know about it
     """
+    member: _Member
+    method: int
+    crc: int
+    compress_size: int
+    offset: int
 
+
+def zip_files(zip_path: str, files: list, args: list = None, backend: str = None, compress_level: int = 5,
+              max_workers: int = None):
+    """
+    :param zip_path:        Path to the zip file we want to create
+    :param files:           List of files, accepts wildcard. use 7z cli docs for reference. Can relative paths to cwd or
+                            abs paths. Folders are added with their contents, named relative to the folder's parent.
+    :param args:            Additional args to pass to 7z. If supplied, default compression level will be used unless
+                            specified otherwise
+    :param backend:         '7z' or 'builtin'. By default 7z is used if args are passed or zip_path already exists,
+                            and the built in writer otherwise.
+    :param compress_level:  Deflate level from 0 to 9, the same as 7z's -mx
+    :param max_workers:     Threads to compress with in the built in writer, defaults to one per core
+    """
+    if backend is None:
+        backend = '7z' if args is not None or os.path.exists(zip_path) else 'builtin'
+
+    if backend == '7z':
+        _zip_files_7z(zip_path, files, args, compress_level)
+    elif backend == 'builtin':
+        if args is not None:
+            raise Exception('7z args can\'t be used with the builtin zip backend!')
+        _zip_files_builtin(zip_path, files, compress_level, max_workers)
+    else:
+        raise Exception(f'Unknown zip backend {backend}!')
+
+
+def _zip_files_7z(zip_path: str, files: list, args: list, compress_level: int):
     cmd = [
         '7z',  # 7z exe
         'a',  # Add to archive
@@ -24,7 +119,7 @@ def zip_files(zip_path: str, files: list, args: list = None):
 
     # if no args were passed, assume we're not passing a compression level
     if args is None:
-        cmd.append('-mx=5')
+        cmd.append(f'-mx={compress_level}')
     else:
         cmd.extend(args)
 
@@ -38,3 +133,326 @@ def zip_files(zip_path: str, files: list, args: list = None):
     ret_code, stdout, stderr = run_process(cmd, sup_out_stdout=True)
     if ret_code != 0:
         _logger.fatal(f'Failed to zip archive! Exit code: {ret_code}')
+
+
+def _make_member(path: str, arcname: str) -> _Member:
+    info = os.stat(path)
+    is_dir = stat.S_ISDIR(info.st_mode)
+    return _Member(path, arcname.replace(os.sep, '/') + ('/' if is_dir else ''), 0 if is_dir else info.st_size,
+                   info.st_mtime, info.st_mode, is_dir)
+
+
+def _collect_members(files: list) -> list[_Member]:
+    """
+    Expands wildcards and folders the way 7z does, naming everything relative to the folder the match is in
+    """
+    members = []
+    arcnames = set()
+
+    def add(path: str, base: str):
+        member = _make_member(path, os.path.relpath(path, base))
+        if member.arcname in arcnames:
+            _logger.debug(f'Skipping {path} as {member.arcname} is already in the archive')
+            return
+        arcnames.add(member.arcname)
+        members.append(member)
+
+    for spec in files:
+        spec = str(spec)
+        matches = sorted(glob.glob(spec)) if glob.has_magic(spec) else [spec]
+        if not matches or not os.path.exists(matches[0]):
+            raise Exception(f'Nothing to zip matches {spec}!')
+
+        for match in matches:
+            match = os.path.normpath(match)
+            base = os.path.dirname(os.path.abspath(match))
+            add(match, base)
+
+            if not os.path.isdir(match):
+                continue
+
+            for root, dirs, filenames in os.walk(match):
+                dirs.sort()
+                for name in dirs + sorted(filenames):
+                    add(os.path.join(root, name), base)
+
+    return members
+
+
+def _dos_time(mtime: float) -> tuple[int, int]:
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), \
+        ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+def _compress_chunk(data, level: int, last: bool) -> bytes:
+    # Raw deflate, each chunk ends on a byte boundary so they can be joined back together
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def _deflate_shrinks(sample, level: int) -> bool:
+    size = len(sample)
+    compressed = len(_compress_chunk(sample, level, True))
+    if isinstance(sample, memoryview):
+        # A view into the mmap, which can't be closed while it's held
+        sample.release()
+    return compressed <= size * (1 - _min_deflate_saving)
+
+
+class _MemberReader:
+    """
+    Reads a member's data, through mmap for big files so chunks are handed to zlib without being copied
+    """
+
+    def __init__(self, member: _Member):
+        self.member = member
+        self._file = None
+        self._mmap = None
+
+        if member.is_dir or member.size == 0:
+            self.data = b''
+        elif member.size < _mmap_threshold:
+            with open(member.path, 'rb') as file:
+                self.data = file.read()
+        else:
+            self._file = open(member.path, 'rb')
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.data = memoryview(self._mmap)
+
+    def chunks(self):
+        for start in range(0, len(self.data), _chunk_size):
+            yield self.data[start:start + _chunk_size]
+
+    def close(self):
+        if self._mmap is not None:
+            self.data.release()
+            self._mmap.close()
+            self._file.close()
+
+
+class _ZipWriter:
+    """
+    Writes a zip one member at a time, with zip64 records when sizes, offsets or the number of members need them
+    """
+
+    def __init__(self, file):
+        self._file = file
+        self._entries: list[_Entry] = []
+
+    def begin_member(self, member: _Member, method: int):
+        """
+        Writes the local header, the sizes and CRC are filled in by end_member once the data has been written
+        """
+        self._offset = self._file.tell()
+        self._member = member
+        self._method = method
+        self._crc = 0
+        self._compress_size = 0
+
+        name = member.arcname.encode('utf-8')
+        flags = 0 if member.arcname.isascii() else _flag_utf8
+        dos_time, dos_date = _dos_time(member.mtime)
+
+        # Leave room for the zip64 sizes if the file might get near the limit, deflate can grow data a little
+        self._zip64 = member.size * 1.05 > _zip64_limit
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0) if self._zip64 else b''
+        version = _version_zip64 if self._zip64 else _version_default
+
+        self._file.write(_local_header.pack(b'PK\x03\x04', version, flags, method, dos_time, dos_date, 0, 0, 0,
+                                            len(name), len(extra)))
+        self._file.write(name)
+        self._file.write(extra)
+        self._sizes_offset = self._offset + _local_header.size + len(name) + 4
+
+    def write_chunk(self, uncompressed, data):
+        """
+        :param uncompressed:    The chunk as it is in the file, for the CRC
+        :param data:            What's written to the zip, the chunk itself if it's stored
+        """
+        self._crc = zlib.crc32(uncompressed, self._crc)
+        self._compress_size += len(data)
+        self._file.write(data)
+
+    def end_member(self) -> _Entry:
+        end = self._file.tell()
+        self._file.seek(self._offset + 14)
+        if self._zip64:
+            self._file.write(struct.pack('<III', self._crc, _zip64_limit, _zip64_limit))
+            self._file.seek(self._sizes_offset)
+            self._file.write(struct.pack('<QQ', self._member.size, self._compress_size))
+        else:
+            if self._compress_size > _zip64_limit:
+                raise Exception(f'{self._member.path} grew past 4 GB when compressed!')
+            self._file.write(struct.pack('<III', self._crc, self._compress_size, self._member.size))
+        self._file.seek(end)
+
+        entry = _Entry(self._member, self._method, self._crc, self._compress_size, self._offset)
+        self._entries.append(entry)
+        return entry
+
+    def close(self):
+        """
+        Writes the central directory and end records
+        """
+        cd_offset = self._file.tell()
+
+        for entry in self._entries:
+            member = entry.member
+            name = member.arcname.encode('utf-8')
+            flags = 0 if member.arcname.isascii() else _flag_utf8
+            dos_time, dos_date = _dos_time(member.mtime)
+
+            zip64_fields = []
+            size, compress_size, offset = member.size, entry.compress_size, entry.offset
+            if size >= _zip64_limit:
+                zip64_fields.append(size)
+                size = _zip64_limit
+            if compress_size >= _zip64_limit:
+                zip64_fields.append(compress_size)
+                compress_size = _zip64_limit
+            if offset >= _zip64_limit:
+                zip64_fields.append(offset)
+                offset = _zip64_limit
+
+            extra = b''
+            if zip64_fields:
+                extra = struct.pack(f'<HH{len(zip64_fields)}Q', 1, 8 * len(zip64_fields), *zip64_fields)
+            version = _version_zip64 if zip64_fields else _version_default
+
+            # The mode is kept for unix tools like zipfile does, with the DOS directory bit for tools that only look
+            # at that
+            external_attr = (member.mode & 0xFFFF) << 16 | (0x10 if member.is_dir else 0)
+
+            self._file.write(_central_header.pack(b'PK\x01\x02', version, _create_system, version, flags, entry.method, dos_time,
+                                                  dos_date, entry.crc, compress_size, size, len(name), len(extra), 0,
+                                                  0, 0, external_attr, offset))
+            self._file.write(name)
+            self._file.write(extra)
+
+        cd_end = self._file.tell()
+        cd_size = cd_end - cd_offset
+        count = len(self._entries)
+
+        if count >= _zip64_count_limit or cd_offset >= _zip64_limit or cd_size >= _zip64_limit:
+            self._file.write(_zip64_end_record.pack(b'PK\x06\x06', _zip64_end_record.size - 12, _version_zip64,
+                                                    _version_zip64, 0, 0, count, count, cd_size, cd_offset))
+            self._file.write(_zip64_end_locator.pack(b'PK\x06\x07', 0, cd_end, 1))
+            count = min(count, _zip64_count_limit)
+            cd_size = min(cd_size, _zip64_limit)
+            cd_offset = min(cd_offset, _zip64_limit)
+
+        self._file.write(_end_record.pack(b'PK\x05\x06', 0, 0, count, count, cd_size, cd_offset, 0))
+
+
+def _iter_member_chunks(members: list[_Member], compress_level: int):
+    """
+    Opens each member in turn and yields (reader, method, chunk, is_last_chunk), every member has at least one chunk
+    """
+    for member in members:
+        reader = _MemberReader(member)
+        stored = member.is_dir or compress_level == 0 or Path(member.path).suffix.lower() in _stored_extensions
+        if not stored and member.size > _chunk_size:
+            # Single chunk members are checked once they've been deflated, bigger ones have to be decided up front
+            stored = not _deflate_shrinks(reader.data[:_sample_size], compress_level)
+        method = _method_stored if stored else _method_deflated
+
+        chunks = list(reader.chunks()) or [reader.data]
+        for i, chunk in enumerate(chunks):
+            yield reader, method, chunk, i == len(chunks) - 1
+
+
+def _zip_files_builtin(zip_path: str, files: list, compress_level: int, max_workers: int):
+    start_time = time.perf_counter()
+    members = _collect_members(files)
+    max_workers = max_workers or os.cpu_count() or 1
+
+    # Enough chunks in flight to keep every worker busy while the oldest is written, without reading the whole build
+    # into memory ahead of the writer
+    max_pending = max_workers * 4
+
+    Path(os.path.dirname(os.path.abspath(zip_path))).mkdir(parents=True, exist_ok=True)
+    temp_path = f'{zip_path}.tmp'
+
+    total_size = 0
+    total_compressed = 0
+    pending: collections.deque[tuple[_MemberReader, int, bytes, bool, Future]] = collections.deque()
+    current = None
+    chunks = None
+
+    try:
+        with trace(f'Zip {os.path.basename(zip_path)}', 'zip', {'files': len(members)}), \
+                ThreadPoolExecutor(max_workers, thread_name_prefix='zip') as executor, \
+                LogCounter(_logger, 'Zipped') as counter, \
+                open(temp_path, 'wb') as file:
+            writer = _ZipWriter(file)
+            chunks = _iter_member_chunks(members, compress_level)
+
+            def fill():
+                while len(pending) < max_pending:
+                    item = next(chunks, None)
+                    if item is None:
+                        return
+                    reader, method, chunk, last = item
+                    future = None
+                    if method == _method_deflated:
+                        future = executor.submit(_compress_chunk, chunk, compress_level, last)
+                    pending.append((reader, method, chunk, last, future))
+
+            try:
+                fill()
+                first_chunk = True
+                while pending:
+                    current = pending.popleft()
+                    reader, method, chunk, last, future = current
+                    fill()
+
+                    data = chunk if future is None else future.result()
+                    if first_chunk:
+                        # Store small files that deflate doesn't shrink, e.g. compressed formats we don't know about
+                        if last and method == _method_deflated and len(data) >= len(chunk):
+                            method, data = _method_stored, chunk
+                        writer.begin_member(reader.member, method)
+
+                    writer.write_chunk(chunk, data)
+                    if isinstance(chunk, memoryview):
+                        # Views into the mmap have to be let go of before it can be closed
+                        chunk.release()
+
+                    first_chunk = last
+                    if last:
+                        entry = writer.end_member()
+                        reader.close()
+                        total_size += reader.member.size
+                        total_compressed += entry.compress_size
+                        counter.add(files=1, bytes=reader.member.size)
+                    current = None
+            except BaseException:
+                # Drop the chunks no worker has started on, rather than compressing them while the executor shuts down
+                executor.shutdown(cancel_futures=True)
+                raise
+
+            writer.close()
+    except BaseException:
+        # Every worker has stopped by now, so the views into the mmaps can be let go of and the files closed
+        if chunks is not None:
+            chunks.close()
+        unwritten = list(pending) if current is None else [current, *pending]
+        for _, _, chunk, _, _ in unwritten:
+            if isinstance(chunk, memoryview):
+                chunk.release()
+        for reader, _, _, _, _ in unwritten:
+            reader.close()
+
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    os.replace(temp_path, zip_path)
+
+    duration = time.perf_counter() - start_time
+    ratio = total_compressed / total_size if total_size else 1.0
+    _logger.info(f'Wrote {zip_path} in {duration:.1f}s, {_format_bytes(total_size)} compressed to '
+                 f'{_format_bytes(total_compressed)} ({ratio:.0%})')